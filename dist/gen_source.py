@@ -14,6 +14,17 @@ replace_symbols_re = re.compile(r'(.*)@(.*)@(.*)')
 func_def_parts_re = re.compile(r'(?P<ret_type>.+)\((?P<name>\w+)\)\((?P<args>[^)]*)')
 param_names_re = re.compile(r'(\w+)(?:,|$)')
 
+# Functions returning a new descriptor, with the expression giving the
+# descriptor from their result, and functions releasing one. The path filter
+# remembers which descriptors refer to matching paths.
+fd_openers = {
+    'open': 'result',
+    'open64': 'result',
+    'fopen': 'result == NULL ? -1 : fileno(result)',
+    'opendir': 'result == NULL ? -1 : dirfd(result)',
+}
+fd_closers = ['close', 'fclose', 'closedir']
+
 # compare_srcfile --
 #   Compare two files, and if they differ, update the source file.
 # Copied from WiredTiger dist/dist.py
@@ -57,6 +68,22 @@ def generate_typedef_content():
         content = content + new_def
     return content  
 
+def generate_function_id_content():
+    content = 'enum {\n'
+    for func_def in func_list:
+        match = func_def_parts_re.match(func_def)
+        content += '\tFI_FUNC_{upper_name},\n'.format(
+            upper_name=match.group('name').upper())
+    content += '\tFI_FUNC_COUNT\n};'
+    return content
+
+def generate_function_name_content():
+    content = ''
+    for func_def in func_list:
+        match = func_def_parts_re.match(func_def)
+        content += '\t"{name}",\n'.format(name=match.group('name'))
+    return content.rstrip('\n')
+
 def generate_function_declaration_content():
     content = ''
     for func_def in func_list:
@@ -80,57 +107,6 @@ def generate_constructor_assignment_content():
         content += new_def
     return content
 
-def generate_global_config_declaration_content():
-    content = ''
-    for func_def in func_list:
-        match = func_def_parts_re.match(func_def)
-        new_config = '''
-static uint64_t g_max_{name}_op_count = 0;
-static uint64_t g_{name}_op_count = 0;
-'''.format(name=match.group('name'))
-        content += new_config
-    return content
-
-def generate_constructor_config_content():
-    content = ''
-    for func_def in func_list:
-        match = func_def_parts_re.match(func_def)
-        new_config = '''
-	if ((env_string = getenv("FAULTINJECT_{upper_name}_COUNT")) != NULL &&
-	    strlen(env_string) != 0) {{
-		errno = 0;
-		g_max_{name}_op_count = strtoull(env_string, NULL, 10);
-#ifdef HAVE_TRACE
-		printf("Set max {name} op count to: %d\\n", (int)g_max_{name}_op_count);
-#endif
-		if (errno != 0) {{
-			fprintf(stderr, "Failed to parse environment variable\\n");
-			g_max_{name}_op_count = 0;
-		}}
-	}}
-'''.format(upper_name=match.group('name').upper(), name=match.group('name'))
-        content += new_config
-    return content
-
-# For now never fail an operation check.
-def generate_operation_check_content():
-    content = ''
-    for func_def in func_list:
-        match = func_def_parts_re.match(func_def)
-        new_config = '''
-	else if (g_max_{name}_op_count > 0 &&
-        ++g_{name}_op_count > g_max_{name}_op_count) {{
-#ifdef HAVE_TRACE
-		printf("failing {name} with op count: %d\\n", (int)g_{name}_op_count);
-#endif
-                dump_backtrace();
-		return (EFAULT);
-	}}'''.format(name=match.group('name'))
-        content += new_config
-    # Trim the first else from the content.
-    content = content.replace('else ', '', 1)
-    return content
-
 def generate_function_definition_content():
     content = ''
     for func_def in func_list:
@@ -139,32 +115,57 @@ def generate_function_definition_content():
         outargs = param_names_re.findall(match.group('args'))
         for outarg in outargs:
             outargs_str = outargs_str + outarg + ', '
-        # Generate code to print out function parameters based on the
-        # argument types.
-        param_prints_str = ''
+        # Generate code to record function parameters in the trace based
+        # on the argument types. Integers and pointers are stored as
+        # numbers, the first few strings are copied into the record.
+        param_records_str = ''
+        arg_slot = 0
+        str_slot = 0
+        # The path filter looks at path arguments, else at the descriptor
+        # behind an fd, FILE * or DIR * argument.
+        path_checks = []
+        fd_expr = None
         for param in match.group('args').split(','):
             # Make sure there is a single space between words
             param = ' '.join(param.strip().replace(
                 '*', ' * ').split())
+            if param == '...':
+                continue
             pname = param.split()[-1]
-            output_type = ''
+            if param == 'int fd':
+                fd_expr = pname
+            elif param.startswith('FILE *'):
+                fd_expr = 'fileno({0})'.format(pname)
+            elif param.startswith('DIR *'):
+                fd_expr = 'dirfd({0})'.format(pname)
             if param.startswith('char *') or    \
                 param.startswith('const char *'):
-                output_type = 's'
-            elif param.startswith('int') or     \
-                param.startswith('long'):
-                output_type = 'd'
-            if output_type != '':
-                param_prints_str += '''
-        fprintf(log_fd, "{name}:%{type}, ", {name});'''.format(
-                    name=pname, type=output_type)
-            elif param == '...':
-                param_prints_str += '''
-        fprintf(log_fd, "...");'''
+                # Every string but fopen's mode is a path
+                if pname != 'mode':
+                    path_checks.append(
+                        'faultinject_path_interesting({0})'.format(pname))
+                if str_slot < 2:
+                    param_records_str += '''
+                faultinject_trace_string(trace_rec, {slot}, {name});'''.format(
+                        name=pname, slot=str_slot)
+                    str_slot += 1
+                value = '(uint64_t)(uintptr_t){0}'.format(pname)
+            elif param.find('*') != -1:
+                value = '(uint64_t)(uintptr_t){0}'.format(pname)
             else:
-                param_prints_str += '''
-        fprintf(log_fd, "{name}:{type}, ");'''.format(
-                    name=pname, type=param.rsplit(' ', 1)[0])
+                value = '(uint64_t){0}'.format(pname)
+            param_records_str += '''
+                trace_rec->args[{slot}] = {value};'''.format(
+                slot=arg_slot, value=value)
+            arg_slot += 1
+        if len(path_checks) > 0:
+            target_check = ' ||\n        '.join(path_checks)
+            if len(path_checks) > 1:
+                target_check = '(' + target_check + ')'
+        elif fd_expr != None:
+            target_check = 'faultinject_fd_interesting({0})'.format(fd_expr)
+        else:
+            target_check = 'faultinject_path_interesting(NULL)'
         # Trim our trailing comma
         outargs_str = outargs_str[:-2]
         open_vararg_str = ''
@@ -202,45 +203,61 @@ def generate_function_definition_content():
         return ({retval});
     }}
 '''.format(name=match.group('name'), retval=ret_value)
+        # Functions creating or releasing descriptors keep the path filter's
+        # descriptor table up to date.
+        fd_closed_str = ''
+        if match.group('name') in fd_closers:
+            fd_closed_str = '''
+    faultinject_fd_closed({0});'''.format(fd_expr)
+        libc_call_str = 'return (*libc_{name})({outargs});'.format(
+            name=match.group('name'), outargs=outargs_str)
+        result_decl_str = ''
+        if match.group('name') in fd_openers:
+            result_decl_str = '''
+    {ret} result;'''.format(ret=match.group('ret_type').strip())
+            libc_call_str = '''result = (*libc_{name})({outargs});
+    faultinject_fd_opened({fd}, {path});
+    return (result);'''.format(name=match.group('name'),
+                outargs=outargs_str,
+                fd=fd_openers[match.group('name')],
+                path=outargs_str.split(',')[0])
         new_def = '''
 FAULT_INJECT_API {ret} {name}({args})
 {{
-    int ret;
-    FILE *log_fd;
-    char tmp_file[256];
-
+    int ret;{result_decl}
+#ifdef HAVE_TRACE
+    struct fi_trace_record *trace_rec;
+    uint64_t trace_seq;
+#endif
 {open_vararg}
-    if (faultinject_caller_interesting()) {{
+    FI_STATS_INC(FI_FUNC_{upper_name}, intercepted);
+    if ({target_check} &&
+        faultinject_caller_interesting(FI_FUNC_{upper_name})) {{
+            ret = faultinject_fail_operation(FI_FUNC_{upper_name});
         #ifdef HAVE_TRACE
-            if (faultinject_trace_operation()) {{
-                /* Log the operation */
-                (void)snprintf(tmp_file, 256,
-                    "%s/fi_pid_%d_{name}.log", g_library_trace_tmpdir,
-                    g_trace_pid);
-                log_fd = (*libc_fopen)(tmp_file, "a");
-                if (log_fd != NULL) {{
-                    fprintf(log_fd, "Intercepted call to: {name}(");
-                    {param_prints}
-                    fprintf(log_fd, ");\\n");
-                    (*libc_fclose)(log_fd);
-                }}
+            /* Log the operation, once it has been counted */
+            if ((trace_rec = faultinject_trace_begin(
+                FI_FUNC_{upper_name}, &trace_seq)) != NULL) {{{param_records}
+                faultinject_trace_commit(trace_rec, trace_seq);
             }}
-        #else
-            log_fd = NULL; log_fd = log_fd;
         #endif
-            if ((ret = faultinject_fail_operation()) != 0) {{
+            if (ret != 0) {{
                 errno = ret;
                 return ({retval});
             }}
-    }}
-    return (*libc_{name})({outargs});
+    }}{fd_closed}
+    {libc_call}
 }}
         '''.format(name=match.group('name'),
+            upper_name=match.group('name').upper(),
             ret=match.group('ret_type'),
             open_vararg=open_vararg_str,
-            param_prints=param_prints_str,
+            param_records=param_records_str,
             retval=ret_value,
-            outargs=outargs_str,
+            result_decl=result_decl_str,
+            target_check=target_check,
+            fd_closed=fd_closed_str,
+            libc_call=libc_call_str,
             args=match.group('args'))
         content += new_def
     return content
@@ -249,16 +266,14 @@ def generate_output(match):
     content_string = ''
     if match == 'CONSTRUCTOR_ASSIGNMENTS':
         content_string = generate_constructor_assignment_content()
-    elif match == 'CONSTRUCTOR_CONFIG':
-        content_string = generate_constructor_config_content()
     elif match == 'FUNCTION_DECLARATIONS':
         content_string = generate_function_declaration_content()
+    elif match == 'FUNCTION_NAMES':
+        content_string = generate_function_name_content()
+    elif match == 'FUNCTION_IDS':
+        content_string = generate_function_id_content()
     elif match == 'FUNCTION_DEFINITIONS':
         content_string = generate_function_definition_content()
-    elif match == 'GLOBAL_CONFIG_DECLARATIONS':
-        content_string = generate_global_config_declaration_content()
-    elif match == 'OPERATION_CHECK':
-        content_string = generate_operation_check_content()
     elif match == 'TYPEDEFS':
         content_string = generate_typedef_content()
     else:
@@ -6,28 +6,52 @@
 #undef __USE_FILE_OFFSET64
 #undef _GNU_SOURCE
 #define _GNU_SOURCE
+#include <ctype.h>
 #include <dirent.h>
 #include <dlfcn.h>
 #include <errno.h>
 #include <execinfo.h>
 #include <fcntl.h>
+#include <fnmatch.h>
+#include <inttypes.h>
+#include <limits.h>
 
 /* Need to tell libunwind to provide local only functionality */
 #define UNW_LOCAL_ONLY
 #include <libunwind.h>
 
+#include <link.h>
+#include <math.h>
 #include <pthread.h>
+#include <semaphore.h>
+#include <signal.h>
 #include <stdarg.h>
+#include <stddef.h>
 #include <stdio.h>
 #include <stdlib.h>
 #include <string.h>
 #include <sys/mman.h>
+#include <sys/prctl.h>
+#include <sys/resource.h>
 #include <sys/stat.h>
+#include <sys/syscall.h>
 #include <sys/types.h>
+#include <sys/wait.h>
+#include <time.h>
 #include <unistd.h>
 
 #define	FAULT_INJECT_API	__attribute__ ((visibility("default")))
 
+/*
+ * Intercepted calls arrive on many threads at once. Counters are updated
+ * with relaxed atomics, nothing on the I/O path takes a lock, and state
+ * private to a call in progress is thread local.
+ */
+#define	FI_THREAD_LOCAL		__thread
+#define	FI_ATOMIC_INC(v)	__atomic_add_fetch(&(v), 1, __ATOMIC_RELAXED)
+#define	FI_ATOMIC_LOAD(v)	__atomic_load_n(&(v), __ATOMIC_RELAXED)
+#define	FI_ATOMIC_STORE(v, val)	__atomic_store_n(&(v), (val), __ATOMIC_RELAXED)
+
 /*
  * Save references to the C library implementations of the functions we are
  * overriding.
@@ -70,78 +94,423 @@ static libc_readdir_t libc_readdir = NULL;
 static libc_remove_t libc_remove = NULL;
 static libc_rename_t libc_rename = NULL;
 
+/* Identifiers for the intercepted functions, in function.list order. */
+enum {
+	FI_FUNC_CLOSE,
+	FI_FUNC_CLOSEDIR,
+	FI_FUNC_FCLOSE,
+	FI_FUNC_FSYNC,
+	FI_FUNC_FDATASYNC,
+	FI_FUNC_FOPEN,
+	FI_FUNC_TRUNCATE,
+	FI_FUNC_FTRUNCATE,
+	FI_FUNC_MMAP,
+	FI_FUNC_MUNMAP,
+	FI_FUNC_OPEN,
+	FI_FUNC_OPEN64,
+	FI_FUNC_OPENDIR,
+	FI_FUNC_PREAD,
+	FI_FUNC_PWRITE,
+	FI_FUNC_READDIR,
+	FI_FUNC_REMOVE,
+	FI_FUNC_RENAME,
+	FI_FUNC_COUNT
+};
+static const char *g_func_names[FI_FUNC_COUNT] = {
+	"close",
+	"closedir",
+	"fclose",
+	"fsync",
+	"fdatasync",
+	"fopen",
+	"truncate",
+	"ftruncate",
+	"mmap",
+	"munmap",
+	"open",
+	"open64",
+	"opendir",
+	"pread",
+	"pwrite",
+	"readdir",
+	"remove",
+	"rename",};
+
 static char *g_library_trace_substring = NULL;
 static char *g_library_trace_tmpdir = NULL;
 
-static uint64_t g_op_count = 0;
-static uint64_t g_max_op_count = 0;
 static pid_t g_trace_pid = 0;
 
-static char g_backtrace_info[20][256];
+/* The number of callers inspected, and the space reserved for each name. */
+#define	FI_BACKTRACE_DEPTH	20
+#define	FI_BACKTRACE_NAME_LEN	256
+
+static FI_THREAD_LOCAL
+    char g_backtrace_info[FI_BACKTRACE_DEPTH][FI_BACKTRACE_NAME_LEN];
 /*
  * points to the index where last valid backtrace function with valid tracing
  * substring is identified
  */
-static int g_backtrace_counter;
-
-static void dump_backtrace(void);
-
-
-static uint64_t g_max_close_op_count = 0;
-static uint64_t g_close_op_count = 0;
+static FI_THREAD_LOCAL int g_backtrace_counter;
 
-static uint64_t g_max_closedir_op_count = 0;
-static uint64_t g_closedir_op_count = 0;
-
-static uint64_t g_max_fclose_op_count = 0;
-static uint64_t g_fclose_op_count = 0;
+/*
+ * Set while the fault injector is itself walking the stack, libunwind may
+ * open and map files, those calls must not be intercepted. Thread local so
+ * other threads are still intercepted in the meantime.
+ */
+static FI_THREAD_LOCAL int g_in_fi_func = 0;
 
-static uint64_t g_max_fsync_op_count = 0;
-static uint64_t g_fsync_op_count = 0;
+/*
+ * Hash of the return address chain of the most recent interesting call on
+ * this thread, zero if the stack wasn't walked.
+ */
+static FI_THREAD_LOCAL uint64_t g_caller_hash = 0;
 
-static uint64_t g_max_fdatasync_op_count = 0;
-static uint64_t g_fdatasync_op_count = 0;
+/*
+ * Number the most recent interesting operation on this thread was counted
+ * as, zero if it wasn't counted.
+ */
+static FI_THREAD_LOCAL uint64_t g_op_count = 0;
 
-static uint64_t g_max_fopen_op_count = 0;
-static uint64_t g_fopen_op_count = 0;
+/*
+ * Cache of caller verdicts, keyed by a hash of the raw return address chain,
+ * so that only call stacks we haven't seen before are symbolized. Each slot
+ * holds the hash with the verdict in the low bit, zero marks an empty slot.
+ * Colliding chains evict each other. Slots are a single word, so threads can
+ * read and replace them without tearing.
+ */
+#define	FI_CALLER_CACHE_SIZE	4096	/* Must be a power of two */
+/* Bit 0 of a key is always clear, it holds the verdict in a slot. */
+#define	FI_CALLER_CACHE_SLOT(key)					\
+	((int)(((key) >> 1) & (FI_CALLER_CACHE_SIZE - 1)))
+static uint64_t g_caller_cache[FI_CALLER_CACHE_SIZE];
+static int g_caller_cache_enabled = 1;
+static uint64_t g_caller_cache_hits = 0;
+static uint64_t g_caller_cache_misses = 0;
+static uint64_t g_caller_cache_evictions = 0;
 
-static uint64_t g_max_truncate_op_count = 0;
-static uint64_t g_truncate_op_count = 0;
+/*
+ * Executable segments of the shared object named by FAULTINJECT_LIBRARY_OBJECT.
+ * A caller is interesting if any of its return addresses falls inside one of
+ * these ranges. The ranges are resolved at startup, and again whenever the
+ * loader's counts of objects added and removed change, which picks up objects
+ * loaded late, for example WiredTiger loaded by Python, and drops unloaded
+ * ones. Reading the counts takes the loader's lock, so they are only checked
+ * when the verdict for a chain of callers isn't in the caller cache; the
+ * cache is keyed by the generation of the ranges too, so a new set starts
+ * over. Each set is allocated, filled in and published with a single store,
+ * and never changed or freed after, as a reader may still be scanning it. The
+ * main program has no name in the loader's list, it goes by the name of
+ * /proc/self/exe.
+ */
+#define	FI_MAX_OBJECT_RANGES	64
+struct fi_addr_range {
+	uintptr_t start;
+	uintptr_t end;
+};
+struct fi_object_ranges {
+	uint64_t generation;
+	unsigned long long adds;	/* Loader counters at the time */
+	unsigned long long subs;
+	int count;
+	struct fi_addr_range ranges[FI_MAX_OBJECT_RANGES];
+};
+static char *g_library_object = NULL;
+static char g_exe_name[PATH_MAX];
+static struct fi_object_ranges *g_object_ranges = NULL;
+static uint64_t g_object_ranges_generation = 0;
+static pthread_mutex_t g_object_range_lock = PTHREAD_MUTEX_INITIALIZER;
 
-static uint64_t g_max_ftruncate_op_count = 0;
-static uint64_t g_ftruncate_op_count = 0;
+/*
+ * Glob patterns from FAULTINJECT_PATH_FILTER, separated by colons. When set,
+ * only operations on a matching path, or on a descriptor opened from one,
+ * are candidates for failure. The descriptor table holds one flag per
+ * possible descriptor, set when it is opened from a matching path and
+ * cleared when it is closed.
+ */
+#define	FI_MAX_PATH_PATTERNS	32
+#define	FI_MAX_FD_TABLE		(1 << 20)
+static char *g_path_patterns[FI_MAX_PATH_PATTERNS];
+static int g_path_pattern_count = 0;
+static uint8_t *g_fd_table = NULL;
+static int g_fd_table_size = 0;
 
-static uint64_t g_max_mmap_op_count = 0;
-static uint64_t g_mmap_op_count = 0;
+#ifdef HAVE_TRACE
+/*
+ * Intercepted calls are traced as fixed size binary records appended to a
+ * memory mapped ring buffer, one per process, in fi_pid_<pid>_trace.bin under
+ * FAULTINJECT_TMP_DIR. A writer reserves a slot by bumping the head of the
+ * buffer, fills it in and finally publishes the slot by storing its sequence
+ * number (the reservation number plus one). Once the buffer wraps, the oldest
+ * records are overwritten. test/fi_trace_decode.py turns the records back
+ * into the human readable per-function logs.
+ */
+#define	FI_TRACE_MAGIC		0x4543415254494646ULL	/* "FFITRACE" */
+#define	FI_TRACE_VERSION	1
+#define	FI_TRACE_MAX_ARGS	6
+#define	FI_TRACE_MAX_STRINGS	2
+#define	FI_TRACE_STR_LEN	80
+#define	FI_TRACE_DEFAULT_RECORDS	16384
+
+struct fi_trace_header {
+	uint64_t magic;
+	uint32_t version;
+	uint32_t record_size;
+	uint64_t capacity;		/* Number of record slots */
+	uint64_t head;			/* Number of records ever reserved */
+	uint32_t pid;
+	uint32_t func_count;
+	uint8_t pad[24];		/* Header is 64 bytes */
+};
+
+struct fi_trace_record {
+	uint64_t seq;			/* Reservation number + 1, 0 if unused */
+	uint32_t func_id;
+	uint32_t tid;
+	uint64_t timestamp;		/* CLOCK_MONOTONIC nanoseconds */
+	uint64_t op_count;
+	uint64_t stack_hash;
+	uint64_t args[FI_TRACE_MAX_ARGS];
+	uint64_t reserved;
+					/* Record is 256 bytes */
+	char str[FI_TRACE_MAX_STRINGS][FI_TRACE_STR_LEN];
+};
+
+static int g_trace_enabled = 1;
+static uint64_t g_trace_capacity = FI_TRACE_DEFAULT_RECORDS;
+static struct fi_trace_header *g_trace_header = NULL;
+static struct fi_trace_record *g_trace_records = NULL;
+static FI_THREAD_LOCAL uint32_t g_trace_tid = 0;
+
+static void faultinject_trace_init(void);
+#endif
 
-static uint64_t g_max_munmap_op_count = 0;
-static uint64_t g_munmap_op_count = 0;
+/*
+ * Fork sweep: rather than rerunning the target once per fail count, a single
+ * run forks at each interesting operation. The child fails that operation and
+ * everything after it, as if it had been started with the matching
+ * FAULTINJECT_FAIL_COUNT, while the parent performs the real call and moves
+ * on. The parent bounds the number of live children, kills those running
+ * past the timeout and records the exit code of each one in
+ * FAULTINJECT_TMP_DIR/fi_sweep_<parent pid>_<child pid>.res.
+ *
+ * The lock protects the table of children only. It is dropped while waiting
+ * for a free slot and while forking, so no thread sits on it while another
+ * sleeps or forks; a slot is reserved for the child being forked meanwhile.
+ */
+#define	FI_SWEEP_FORKING	((pid_t)-1)
+struct fi_sweep_child {
+	pid_t pid;			/* 0 if free, or FI_SWEEP_FORKING */
+	uint64_t fail_count;
+	time_t start;
+	int signalled;
+};
+static uint64_t g_fork_sweep_max_children = 0;	/* 0 if not sweeping */
+static uint64_t g_fork_sweep_end = 0;		/* Last fail count, 0 for none */
+static uint64_t g_fork_sweep_timeout = 0;	/* Seconds, 0 for none */
+static int g_fork_sweep_child = 0;
+static struct fi_sweep_child *g_fork_sweep_children = NULL;
+static pthread_mutex_t g_fork_sweep_lock = PTHREAD_MUTEX_INITIALIZER;
 
-static uint64_t g_max_open_op_count = 0;
-static uint64_t g_open_op_count = 0;
+/*
+ * Hung process backtraces: FAULTINJECT_BACKTRACE_SIGNAL wakes a thread of
+ * ours, which sends the signal to each of the other threads in turn. Each
+ * records the raw return addresses of its own stack into a slot, and the
+ * dumping thread names their functions and appends one sample of them to
+ * FAULTINJECT_TMP_DIR/fi_pid_<pid>_hung_btt.log in the collapsed format of
+ * test/pmp.sh, "<count>:<innermost>,...,<outermost>" lines, most common
+ * first, followed by an empty line. The handler makes async signal safe
+ * calls only, memory is allocated at startup.
+ *
+ * A thread answering after the dumping thread gave up on it must not write
+ * into a slot that has since been handed to another thread: each request is
+ * a word holding a ticket, the slot and the thread asked, stored in the slot
+ * and sent along with the signal, and a thread only writes after claiming
+ * the slot by swapping in that request with FI_DUMP_CLAIMED set. The dumping
+ * thread revokes requests that time out the same way. Only a signal from
+ * outside the process asks for a sample, so a late answer is dropped rather
+ * than taken for one.
+ *
+ * A forked child starts its own dumping thread on its first interesting
+ * operation, not in the fork handler, as a child about to exec has no use
+ * for one.
+ */
+#define	FI_DUMP_MAX_THREADS	256
+#define	FI_DUMP_DEPTH		64
+#define	FI_DUMP_LINE_LEN	4096
+#define	FI_DUMP_WAIT_MS		200	/* For each thread to answer */
+#define	FI_DUMP_CLAIMED		(1ULL << 63)
+#define	FI_DUMP_REQUEST(ticket, slot, tid)				\
+	(((uint64_t)(ticket) & 0x7fffff) << 40 |			\
+	(uint64_t)(slot) << 32 | (uint64_t)(uint32_t)(tid))
+#define	FI_DUMP_REQUEST_SLOT(request)	((int)(((request) >> 32) & 0xff))
+#define	FI_DUMP_REQUEST_TID(request)	((pid_t)((request) & 0xffffffff))
+struct fi_dump_slot {
+	uint64_t request;		/* Request answered, 0 if revoked */
+	int done;			/* Set once pcs is filled in */
+	int npcs;
+	uintptr_t pcs[FI_DUMP_DEPTH];	/* Innermost first */
+	char line[FI_DUMP_LINE_LEN];	/* Comma separated frame names */
+	int count;			/* Threads with this stack */
+};
+static int g_dump_signal = 0;			/* 0 if not installed */
+static sem_t g_dump_sem;			/* Posted to ask for a sample */
+static pid_t g_dump_tid = 0;			/* The dumping thread */
+static int g_dump_start_pending = 0;		/* Forked, not started yet */
+static struct fi_dump_slot *g_dump_slots = NULL;
+static char *g_dump_buf = NULL;
 
-static uint64_t g_max_open64_op_count = 0;
-static uint64_t g_open64_op_count = 0;
+/*
+ * Count only mode injects nothing, it counts the interesting operations,
+ * overall and per function, and writes the totals to
+ * FAULTINJECT_TMP_DIR/fi_pid_<pid>_op_count.log at exit. A driver uses this
+ * to learn the range of fail counts worth running.
+ */
+#define	FI_MODE_FAIL	0
+#define	FI_MODE_COUNT	1
 
-static uint64_t g_max_opendir_op_count = 0;
-static uint64_t g_opendir_op_count = 0;
+/*
+ * With FAULTINJECT_SITES set as well, count only mode writes the injection
+ * site of each interesting operation to fi_pid_<pid>_sites.log, as
+ * "<op count> <site>" lines. A site is a hash of the call stack made up of
+ * object file names and offsets into them, so the same code path has the
+ * same site in every run of the same binaries.
+ */
+static FILE *g_sites_log = NULL;
+static pthread_mutex_t g_sites_lock = PTHREAD_MUTEX_INITIALIZER;
 
-static uint64_t g_max_pread_op_count = 0;
-static uint64_t g_pread_op_count = 0;
+/*
+ * Per-function configuration and counters, indexed by the FI_FUNC_* id each
+ * wrapper passes in, so checking a call costs the same however many
+ * functions are wrapped.
+ */
+struct fi_func {
+	uint64_t max_op_count;	/* FAULTINJECT_<FN>_COUNT, 0 for none */
+	uint64_t op_count;	/* Interesting calls counted against it */
+};
 
-static uint64_t g_max_pwrite_op_count = 0;
-static uint64_t g_pwrite_op_count = 0;
+/*
+ * The settings and counters deciding which operations fail. They are private
+ * to the process unless FAULTINJECT_CONTROL_SHM names a POSIX shared memory
+ * object, in which case they are mapped from it, and a driver can re-arm,
+ * disarm or reset a running process and read its counters, see
+ * test/fi_control.py, which shares this layout. All fields are read and
+ * written with relaxed atomics.
+ */
+#define	FI_CONTROL_MAGIC	0x4c52544e4f434946ULL	/* "FICONTRL" */
+#define	FI_CONTROL_VERSION	1
+struct fi_control {
+	uint64_t magic;
+	uint32_t version;
+	uint32_t func_count;	/* FI_FUNC_COUNT */
+	uint64_t pid;		/* Last process to attach */
+	uint64_t enabled;	/* 0 lets every operation through uncounted */
+	uint64_t mode;		/* FI_MODE_FAIL or FI_MODE_COUNT */
+	uint64_t op_count;	/* Interesting operations counted */
+	uint64_t max_op_count;	/* FAULTINJECT_FAIL_COUNT, 0 for none */
+	/*
+	 * The shape of the failures past the fail count: every fail_every'th
+	 * interesting operation fails, and after fail_window failures
+	 * operations succeed again, 0 fails for good.
+	 */
+	uint64_t fail_window;
+	uint64_t fail_every;
+	uint64_t failed;	/* Operations failed */
+	struct fi_func funcs[FI_FUNC_COUNT];
+};
+static struct fi_control g_control_local = {
+	FI_CONTROL_MAGIC, FI_CONTROL_VERSION, FI_FUNC_COUNT, 0, 1,
+	FI_MODE_FAIL, 0, 0, 0, 1, 0, { { 0, 0 } } };
+static struct fi_control *g_control = &g_control_local;
 
-static uint64_t g_max_readdir_op_count = 0;
-static uint64_t g_readdir_op_count = 0;
+/*
+ * Latency injection: interesting operations are delayed before the real call
+ * is made, to see how the target copes with slow storage. The delay is fixed,
+ * or drawn from a uniform distribution between 0 and twice the mean or an
+ * exponential one with the given mean, and is injected on every Nth call.
+ * FAULTINJECT_DELAY_USEC, _DIST and _EVERY configure every function,
+ * FAULTINJECT_<FN>_DELAY_USEC, _DIST and _EVERY override them for one. The
+ * delays injected are measured and written to
+ * FAULTINJECT_TMP_DIR/fi_pid_<pid>_delay.log at exit.
+ */
+#define	FI_DELAY_FIXED		0
+#define	FI_DELAY_UNIFORM	1
+#define	FI_DELAY_EXPONENTIAL	2
+struct fi_delay {
+	uint64_t usec;		/* Delay or mean delay, 0 for none */
+	uint64_t every;		/* Delay every Nth interesting call */
+	int dist;		/* FI_DELAY_* */
+	uint64_t calls;		/* Interesting calls seen */
+	uint64_t delays;	/* Delays injected */
+	uint64_t total_usec;	/* Time spent in them */
+	uint64_t max_usec;
+};
+static struct fi_delay g_delays[FI_FUNC_COUNT];
+static int g_delay_enabled = 0;
+static uint64_t g_delay_seed = 0;		/* FAULTINJECT_DELAY_SEED */
+static uint64_t g_delay_threads = 0;
+static uint64_t g_delay_oversleep = 50;		/* Average, in usec */
+static FI_THREAD_LOCAL uint64_t g_delay_rng = 0;
 
-static uint64_t g_max_remove_op_count = 0;
-static uint64_t g_remove_op_count = 0;
+/*
+ * Interception statistics: with FAULTINJECT_STATS set, per-function counters
+ * are kept in FAULTINJECT_TMP_DIR/fi_pid_<pid>_stats.bin, mapped shared so
+ * test/fi_stats.py can sample them while the process runs. The layout is
+ * shared with that script. Counters are updated with relaxed atomics, and
+ * not at all without the file.
+ */
+#define	FI_STATS_MAGIC		0x0053544154534946ULL	/* "FISTATS" */
+#define	FI_STATS_VERSION	1
+struct fi_func_stats {
+	uint64_t intercepted;	/* Calls to the wrapper */
+	uint64_t interesting;	/* Calls the caller check picked */
+	uint64_t failed;	/* Calls failed */
+	uint64_t recursed;	/* Calls skipped by the recursion guard */
+	uint64_t checks;	/* Caller checks made */
+	uint64_t check_ns;	/* Time spent in them, unwinding mostly */
+};
+struct fi_stats {
+	uint64_t magic;
+	uint32_t version;
+	uint32_t func_count;	/* FI_FUNC_COUNT */
+	uint64_t pid;
+	struct fi_func_stats funcs[FI_FUNC_COUNT];
+};
+static struct fi_stats *g_stats = NULL;
+#define	FI_STATS_INC(func_id, field) do {				\
+	if (g_stats != NULL)						\
+		(void)FI_ATOMIC_INC(g_stats->funcs[func_id].field);	\
+} while (0)
 
-static uint64_t g_max_rename_op_count = 0;
-static uint64_t g_rename_op_count = 0;
+static void dump_backtrace(void);
+static void faultinject_record_site(uint64_t op_count);
+static uint64_t faultinject_hash_pcs(void **pcs, int npcs);
+static void faultinject_control_attach(const char *name);
+static void faultinject_delay_init(void);
+static void faultinject_stats_init(void);
+static void faultinject_dump_install(int sig);
+static void faultinject_dump_restart(void);
+static void faultinject_path_filter_init(char *filter);
+static void faultinject_resolve_object_ranges(void);
+static void faultinject_sweep_wait(int max_running);
 
 void __attribute__ ((constructor)) faultinject_constructor(void);
+void __attribute__ ((destructor)) faultinject_destructor(void);
+
+/*
+ * Look up the FAULTINJECT_<FN>_<setting> environment variable of a function.
+ */
+static char *faultinject_func_getenv(int func_id, const char *setting)
+{
+	char env_name[128];
+	size_t i, len;
+
+	len = (size_t)snprintf(env_name, sizeof(env_name),
+	    "FAULTINJECT_%s_%s", g_func_names[func_id], setting);
+	for (i = strlen("FAULTINJECT_"); i < len && i < sizeof(env_name); i++)
+		env_name[i] = (char)toupper((unsigned char)env_name[i]);
+	return (getenv(env_name));
+}
 
 /*
  * Setup pointers to the C library version of functions we are overriding,
@@ -150,6 +519,8 @@ void __attribute__ ((constructor)) faultinject_constructor(void);
 void __attribute__ ((constructor)) faultinject_constructor(void)
 {
 	char *env_string, *err_string;
+	char tmp_file[256];
+	int i;
 
 	env_string = err_string = NULL;
 	errno = 0;
@@ -268,462 +639,1557 @@ void __attribute__ ((constructor)) faultinject_constructor(void)
 	    strlen(env_string) != 0) {
 		g_library_trace_substring = env_string;
 	}
+	if ((env_string = getenv("FAULTINJECT_LIBRARY_OBJECT")) != NULL &&
+	    strlen(env_string) != 0) {
+		g_library_object = env_string;
+		faultinject_resolve_object_ranges();
+	}
+	if ((env_string = getenv("FAULTINJECT_PATH_FILTER")) != NULL &&
+	    strlen(env_string) != 0)
+		faultinject_path_filter_init(env_string);
 	if ((env_string = getenv("FAULTINJECT_TMP_DIR")) != NULL &&
 	    strlen(env_string) != 0) {
 		g_library_trace_tmpdir = env_string; }
-	if ((env_string = getenv("FAULTINJECT_FAIL_COUNT")) != NULL &&
+#ifdef HAVE_TRACE
+	if ((env_string = getenv("FAULTINJECT_TRACE")) != NULL &&
+	    strlen(env_string) != 0)
+		g_trace_enabled = strtol(env_string, NULL, 10) != 0;
+	if ((env_string = getenv("FAULTINJECT_TRACE_RECORDS")) != NULL &&
 	    strlen(env_string) != 0) {
 		errno = 0;
-		g_max_op_count = strtoull(env_string, NULL, 10);
-		printf("Set max op count to: %d\n", (int)g_max_op_count);
-		if (errno != 0) {
+		g_trace_capacity = strtoull(env_string, NULL, 10);
+		if (errno != 0 || g_trace_capacity == 0) {
 			fprintf(stderr, "Failed to parse environment variable\n");
-			g_max_op_count = 0;
+			g_trace_capacity = FI_TRACE_DEFAULT_RECORDS;
 		}
 	}
-	g_trace_pid = getpid();
-	/* Function specific environment variable configuration parsing. */
-
-	if ((env_string = getenv("FAULTINJECT_CLOSE_COUNT")) != NULL &&
+#endif
+	if ((env_string = getenv("FAULTINJECT_CALLER_CACHE")) != NULL &&
+	    strlen(env_string) != 0)
+		g_caller_cache_enabled = strtol(env_string, NULL, 10) != 0;
+	if ((env_string = getenv("FAULTINJECT_FAIL_COUNT")) != NULL &&
 	    strlen(env_string) != 0) {
 		errno = 0;
-		g_max_close_op_count = strtoull(env_string, NULL, 10);
-#ifdef HAVE_TRACE
-		printf("Set max close op count to: %d\n", (int)g_max_close_op_count);
-#endif
+		g_control->max_op_count = strtoull(env_string, NULL, 10);
+		printf("Set max op count to: %d\n", (int)g_control->max_op_count);
 		if (errno != 0) {
 			fprintf(stderr, "Failed to parse environment variable\n");
-			g_max_close_op_count = 0;
+			g_control->max_op_count = 0;
 		}
 	}
-
-	if ((env_string = getenv("FAULTINJECT_CLOSEDIR_COUNT")) != NULL &&
+	if ((env_string = getenv("FAULTINJECT_FAIL_WINDOW")) != NULL &&
 	    strlen(env_string) != 0) {
 		errno = 0;
-		g_max_closedir_op_count = strtoull(env_string, NULL, 10);
-#ifdef HAVE_TRACE
-		printf("Set max closedir op count to: %d\n", (int)g_max_closedir_op_count);
-#endif
+		g_control->fail_window = strtoull(env_string, NULL, 10);
 		if (errno != 0) {
 			fprintf(stderr, "Failed to parse environment variable\n");
-			g_max_closedir_op_count = 0;
+			g_control->fail_window = 0;
 		}
 	}
-
-	if ((env_string = getenv("FAULTINJECT_FCLOSE_COUNT")) != NULL &&
+	if ((env_string = getenv("FAULTINJECT_FAIL_EVERY")) != NULL &&
 	    strlen(env_string) != 0) {
 		errno = 0;
-		g_max_fclose_op_count = strtoull(env_string, NULL, 10);
-#ifdef HAVE_TRACE
-		printf("Set max fclose op count to: %d\n", (int)g_max_fclose_op_count);
-#endif
-		if (errno != 0) {
+		g_control->fail_every = strtoull(env_string, NULL, 10);
+		if (errno != 0 || g_control->fail_every == 0) {
 			fprintf(stderr, "Failed to parse environment variable\n");
-			g_max_fclose_op_count = 0;
+			g_control->fail_every = 1;
 		}
 	}
-
-	if ((env_string = getenv("FAULTINJECT_FSYNC_COUNT")) != NULL &&
+	if (g_control->fail_window != 0 || g_control->fail_every != 1)
+		printf("Failing every %d op(s), %d time(s) (0 for no end)\n",
+		    (int)g_control->fail_every, (int)g_control->fail_window);
+	if ((env_string = getenv("FAULTINJECT_COUNT_ONLY")) != NULL &&
+	    strlen(env_string) != 0 && strtol(env_string, NULL, 10) != 0)
+		g_control->mode = FI_MODE_COUNT;
+	if ((env_string = getenv("FAULTINJECT_FORK_SWEEP")) != NULL &&
 	    strlen(env_string) != 0) {
 		errno = 0;
-		g_max_fsync_op_count = strtoull(env_string, NULL, 10);
-#ifdef HAVE_TRACE
-		printf("Set max fsync op count to: %d\n", (int)g_max_fsync_op_count);
-#endif
+		g_fork_sweep_max_children = strtoull(env_string, NULL, 10);
 		if (errno != 0) {
 			fprintf(stderr, "Failed to parse environment variable\n");
-			g_max_fsync_op_count = 0;
+			g_fork_sweep_max_children = 0;
+		}
+		if (g_fork_sweep_max_children > 0 &&
+		    (g_fork_sweep_children = calloc(g_fork_sweep_max_children,
+		    sizeof(struct fi_sweep_child))) == NULL) {
+			fprintf(stderr, "Failed to allocate fork sweep children\n");
+			g_fork_sweep_max_children = 0;
 		}
 	}
-
-	if ((env_string = getenv("FAULTINJECT_FDATASYNC_COUNT")) != NULL &&
+	if ((env_string = getenv("FAULTINJECT_FORK_SWEEP_END")) != NULL &&
 	    strlen(env_string) != 0) {
 		errno = 0;
-		g_max_fdatasync_op_count = strtoull(env_string, NULL, 10);
-#ifdef HAVE_TRACE
-		printf("Set max fdatasync op count to: %d\n", (int)g_max_fdatasync_op_count);
-#endif
+		g_fork_sweep_end = strtoull(env_string, NULL, 10);
 		if (errno != 0) {
 			fprintf(stderr, "Failed to parse environment variable\n");
-			g_max_fdatasync_op_count = 0;
+			g_fork_sweep_end = 0;
 		}
 	}
-
-	if ((env_string = getenv("FAULTINJECT_FOPEN_COUNT")) != NULL &&
+	if ((env_string = getenv("FAULTINJECT_FORK_SWEEP_TIMEOUT")) != NULL &&
 	    strlen(env_string) != 0) {
 		errno = 0;
-		g_max_fopen_op_count = strtoull(env_string, NULL, 10);
-#ifdef HAVE_TRACE
-		printf("Set max fopen op count to: %d\n", (int)g_max_fopen_op_count);
-#endif
+		g_fork_sweep_timeout = strtoull(env_string, NULL, 10);
 		if (errno != 0) {
 			fprintf(stderr, "Failed to parse environment variable\n");
-			g_max_fopen_op_count = 0;
+			g_fork_sweep_timeout = 0;
 		}
 	}
-
-	if ((env_string = getenv("FAULTINJECT_TRUNCATE_COUNT")) != NULL &&
-	    strlen(env_string) != 0) {
-		errno = 0;
-		g_max_truncate_op_count = strtoull(env_string, NULL, 10);
+	if (g_fork_sweep_max_children > 0)
+		printf("Fork sweep from op count %d with up to %d children\n",
+		    (int)g_control->max_op_count,
+		    (int)g_fork_sweep_max_children);
+	g_trace_pid = getpid();
+	if (g_control->mode == FI_MODE_COUNT &&
+	    g_library_trace_tmpdir != NULL &&
+	    (env_string = getenv("FAULTINJECT_SITES")) != NULL &&
+	    strtol(env_string, NULL, 10) != 0) {
+		(void)snprintf(tmp_file, 256, "%s/fi_pid_%d_sites.log",
+		    g_library_trace_tmpdir, g_trace_pid);
+		if ((g_sites_log = (*libc_fopen)(tmp_file, "w")) == NULL)
+			fprintf(stderr, "Failed to create %s\n", tmp_file);
+	}
+	/* Function specific environment variable configuration parsing. */
+	for (i = 0; i < FI_FUNC_COUNT; i++) {
+		if ((env_string = faultinject_func_getenv(i, "COUNT")) != NULL &&
+		    strlen(env_string) != 0) {
+			errno = 0;
+			g_control->funcs[i].max_op_count =
+			    strtoull(env_string, NULL, 10);
 #ifdef HAVE_TRACE
-		printf("Set max truncate op count to: %d\n", (int)g_max_truncate_op_count);
+			printf("Set max %s op count to: %d\n", g_func_names[i],
+			    (int)g_control->funcs[i].max_op_count);
 #endif
-		if (errno != 0) {
-			fprintf(stderr, "Failed to parse environment variable\n");
-			g_max_truncate_op_count = 0;
+			if (errno != 0) {
+				fprintf(stderr,
+				    "Failed to parse environment variable\n");
+				g_control->funcs[i].max_op_count = 0;
+			}
 		}
 	}
-
-	if ((env_string = getenv("FAULTINJECT_FTRUNCATE_COUNT")) != NULL &&
+	if ((env_string = getenv("FAULTINJECT_BACKTRACE_SIGNAL")) != NULL &&
 	    strlen(env_string) != 0) {
 		errno = 0;
-		g_max_ftruncate_op_count = strtoull(env_string, NULL, 10);
-#ifdef HAVE_TRACE
-		printf("Set max ftruncate op count to: %d\n", (int)g_max_ftruncate_op_count);
-#endif
-		if (errno != 0) {
+		i = (int)strtol(env_string, NULL, 10);
+		if (errno != 0 || i <= 0 || i >= NSIG)
 			fprintf(stderr, "Failed to parse environment variable\n");
-			g_max_ftruncate_op_count = 0;
-		}
+		else
+			faultinject_dump_install(i);
 	}
-
-	if ((env_string = getenv("FAULTINJECT_MMAP_COUNT")) != NULL &&
-	    strlen(env_string) != 0) {
-		errno = 0;
-		g_max_mmap_op_count = strtoull(env_string, NULL, 10);
+	faultinject_delay_init();
+	if (g_library_trace_tmpdir != NULL &&
+	    (env_string = getenv("FAULTINJECT_STATS")) != NULL &&
+	    strtol(env_string, NULL, 10) != 0)
+		faultinject_stats_init();
+	/* Everything parsed so far seeds a new control block. */
+	if ((env_string = getenv("FAULTINJECT_CONTROL_SHM")) != NULL &&
+	    strlen(env_string) != 0)
+		faultinject_control_attach(env_string);
 #ifdef HAVE_TRACE
-		printf("Set max mmap op count to: %d\n", (int)g_max_mmap_op_count);
+	faultinject_trace_init();
 #endif
-		if (errno != 0) {
-			fprintf(stderr, "Failed to parse environment variable\n");
-			g_max_mmap_op_count = 0;
+}
+
+/*
+ * Report how well the caller cache did on the way out.
+ */
+void __attribute__ ((destructor)) faultinject_destructor(void)
+{
+	char tmp_file[256];
+	FILE *log_fd;
+	int i;
+
+	if (FI_ATOMIC_LOAD(g_control->mode) == FI_MODE_COUNT) {
+		(void)snprintf(tmp_file, 256, "%s/fi_pid_%d_op_count.log",
+		    g_library_trace_tmpdir, g_trace_pid);
+		log_fd = (*libc_fopen)(tmp_file, "w");
+		if (log_fd != NULL) {
+			fprintf(log_fd, "total=%" PRIu64 "\n",
+			    FI_ATOMIC_LOAD(g_control->op_count));
+			for (i = 0; i < FI_FUNC_COUNT; i++)
+				fprintf(log_fd, "%s=%" PRIu64 "\n", g_func_names[i],
+				    FI_ATOMIC_LOAD(g_control->funcs[i].op_count));
+			(*libc_fclose)(log_fd);
+		}
+		if (g_sites_log != NULL) {
+			(void)pthread_mutex_lock(&g_sites_lock);
+			(*libc_fclose)(g_sites_log);
+			g_sites_log = NULL;
+			(void)pthread_mutex_unlock(&g_sites_lock);
 		}
 	}
 
-	if ((env_string = getenv("FAULTINJECT_MUNMAP_COUNT")) != NULL &&
-	    strlen(env_string) != 0) {
-		errno = 0;
-		g_max_munmap_op_count = strtoull(env_string, NULL, 10);
-#ifdef HAVE_TRACE
-		printf("Set max munmap op count to: %d\n", (int)g_max_munmap_op_count);
-#endif
-		if (errno != 0) {
-			fprintf(stderr, "Failed to parse environment variable\n");
-			g_max_munmap_op_count = 0;
+	if (g_delay_enabled && g_library_trace_tmpdir != NULL) {
+		(void)snprintf(tmp_file, 256, "%s/fi_pid_%d_delay.log",
+		    g_library_trace_tmpdir, g_trace_pid);
+		log_fd = (*libc_fopen)(tmp_file, "w");
+		if (log_fd != NULL) {
+			for (i = 0; i < FI_FUNC_COUNT; i++)
+				if (g_delays[i].usec != 0)
+					fprintf(log_fd, "%s=%" PRIu64 ",%" PRIu64
+					    ",%" PRIu64 "\n", g_func_names[i],
+					    FI_ATOMIC_LOAD(g_delays[i].delays),
+					    FI_ATOMIC_LOAD(g_delays[i].total_usec),
+					    FI_ATOMIC_LOAD(g_delays[i].max_usec));
+			(*libc_fclose)(log_fd);
 		}
 	}
 
-	if ((env_string = getenv("FAULTINJECT_OPEN_COUNT")) != NULL &&
-	    strlen(env_string) != 0) {
-		errno = 0;
-		g_max_open_op_count = strtoull(env_string, NULL, 10);
+	/* A sweeping parent waits for the verdicts of all its children. */
+	if (g_fork_sweep_max_children > 0 && !g_fork_sweep_child) {
+		faultinject_sweep_wait(0);
+		(void)pthread_mutex_unlock(&g_fork_sweep_lock);
+	}
 #ifdef HAVE_TRACE
-		printf("Set max open op count to: %d\n", (int)g_max_open_op_count);
+	printf("Caller cache hits: %" PRIu64 ", misses: %" PRIu64
+	    ", evictions: %" PRIu64 "\n", g_caller_cache_hits,
+	    g_caller_cache_misses, g_caller_cache_evictions);
 #endif
-		if (errno != 0) {
-			fprintf(stderr, "Failed to parse environment variable\n");
-			g_max_open_op_count = 0;
+}
+
+/*
+ * Record the exit code of a sweep child, in the form Python reports it:
+ * negative signal numbers for children killed by a signal.
+ */
+static void faultinject_sweep_record(struct fi_sweep_child *child, int status)
+{
+	char tmp_file[256];
+	FILE *log_fd;
+	int exit_code;
+
+	if (WIFEXITED(status))
+		exit_code = WEXITSTATUS(status);
+	else if (WIFSIGNALED(status))
+		exit_code = -WTERMSIG(status);
+	else
+		exit_code = status;
+
+	(void)snprintf(tmp_file, 256, "%s/fi_sweep_%d_%d.res",
+	    g_library_trace_tmpdir, g_trace_pid, (int)child->pid);
+	log_fd = (*libc_fopen)(tmp_file, "w");
+	if (log_fd != NULL) {
+		fprintf(log_fd, "failcount=%" PRIu64 "\n", child->fail_count);
+		fprintf(log_fd, "exitcode=%d\n", exit_code);
+		(*libc_fclose)(log_fd);
+	}
+	child->pid = 0;
+}
+
+/*
+ * Reap sweep children that have finished, and kill those that have run past
+ * the timeout: first with SIGQUIT to get a core, and if that doesn't stop
+ * them, with SIGKILL. Returns the number of children still running, counting
+ * those being forked. Called with the lock held.
+ */
+static int faultinject_sweep_reap(void)
+{
+	struct fi_sweep_child *child;
+	uint64_t i;
+	time_t now;
+	pid_t pid;
+	int running, status;
+
+	running = 0;
+	now = time(NULL);
+	for (i = 0; i < g_fork_sweep_max_children; i++) {
+		child = &g_fork_sweep_children[i];
+		if (child->pid == 0)
+			continue;
+		if (child->pid == FI_SWEEP_FORKING) {
+			++running;
+			continue;
+		}
+		if ((pid = waitpid(child->pid, &status, WNOHANG)) == child->pid) {
+			faultinject_sweep_record(child, status);
+			continue;
 		}
+		if (pid < 0) {
+			/* Someone else reaped it, we can't know the verdict. */
+			child->pid = 0;
+			continue;
+		}
+		++running;
+		if (g_fork_sweep_timeout == 0 ||
+		    (uint64_t)(now - child->start) <=
+		    g_fork_sweep_timeout * (uint64_t)(child->signalled + 1))
+			continue;
+		(void)kill(child->pid, child->signalled ? SIGKILL : SIGQUIT);
+		child->signalled = 1;
+	}
+	return (running);
+}
+
+/*
+ * Wait until no more than the given number of sweep children are running.
+ * Returns with the lock held, which is dropped while sleeping.
+ */
+static void faultinject_sweep_wait(int max_running)
+{
+	struct timespec ts;
+
+	ts.tv_sec = 0;
+	ts.tv_nsec = 10000000;
+	(void)pthread_mutex_lock(&g_fork_sweep_lock);
+	while (faultinject_sweep_reap() > max_running) {
+		(void)pthread_mutex_unlock(&g_fork_sweep_lock);
+		(void)nanosleep(&ts, NULL);
+		(void)pthread_mutex_lock(&g_fork_sweep_lock);
 	}
+}
 
-	if ((env_string = getenv("FAULTINJECT_OPEN64_COUNT")) != NULL &&
-	    strlen(env_string) != 0) {
-		errno = 0;
-		g_max_open64_op_count = strtoull(env_string, NULL, 10);
+/*
+ * Called by a sweeping parent for each interesting operation. Returns 1 in
+ * a child forked to fail the operation, 0 in the parent.
+ */
+static int faultinject_fork_sweep(void)
+{
+	struct fi_sweep_child *child;
+	uint64_t fail_count, i;
+	pid_t parent, pid;
+
+	g_op_count = FI_ATOMIC_INC(g_control->op_count);
+	fail_count = g_op_count - 1;
+	if (fail_count == 0 ||
+	    fail_count < FI_ATOMIC_LOAD(g_control->max_op_count) ||
+	    (g_fork_sweep_end != 0 && fail_count > g_fork_sweep_end))
+		return (0);
+
+	faultinject_sweep_wait((int)g_fork_sweep_max_children - 1);
+	for (i = 0; g_fork_sweep_children[i].pid != 0; i++)
+		;
+	child = &g_fork_sweep_children[i];
+	child->pid = FI_SWEEP_FORKING;
+	(void)pthread_mutex_unlock(&g_fork_sweep_lock);
+
+	/* Don't let the child repeat output buffered by the parent. */
+	(void)fflush(NULL);
+	parent = getpid();
+	if ((pid = fork()) == 0) {
+		/*
+		 * Only this thread exists in the child, the lock another
+		 * thread may have held is never looked at again.
+		 */
+		g_fork_sweep_child = 1;
+		/*
+		 * Nobody times or reaps us once the parent is gone, e.g. killed
+		 * for running past its own timeout: go with it.
+		 */
+		(void)prctl(PR_SET_PDEATHSIG, SIGKILL);
+		if (getppid() != parent)
+			_exit(1);
+		g_trace_pid = getpid();
 #ifdef HAVE_TRACE
-		printf("Set max open64 op count to: %d\n", (int)g_max_open64_op_count);
+		faultinject_trace_init();
 #endif
-		if (errno != 0) {
-			fprintf(stderr, "Failed to parse environment variable\n");
-			g_max_open64_op_count = 0;
+		/*
+		 * Carry on as if started with FAULTINJECT_FAIL_COUNT, with
+		 * counters of our own.
+		 */
+		if (g_control != &g_control_local) {
+			g_control_local = *g_control;
+			g_control = &g_control_local;
 		}
+		g_control->max_op_count = fail_count;
+		g_control->op_count = fail_count;
+		return (1);
 	}
+	(void)pthread_mutex_lock(&g_fork_sweep_lock);
+	if (pid < 0) {
+		fprintf(stderr, "Fork sweep failed to fork for fail count %d\n",
+		    (int)fail_count);
+		child->pid = 0;
+	} else {
+		child->pid = pid;
+		child->fail_count = fail_count;
+		child->start = time(NULL);
+		child->signalled = 0;
+	}
+	(void)pthread_mutex_unlock(&g_fork_sweep_lock);
+	return (0);
+}
 
-	if ((env_string = getenv("FAULTINJECT_OPENDIR_COUNT")) != NULL &&
-	    strlen(env_string) != 0) {
+/*
+ * Map the control block from the named shared memory object. An object
+ * created by a driver beforehand, or left by an earlier process, is used as
+ * it is; a new one is filled in from the environment. Failing to attach
+ * leaves the process with its private settings.
+ */
+static void faultinject_control_attach(const char *name)
+{
+	struct fi_control *control;
+	struct stat sb;
+	char shm_name[256];
+	int fd, fresh;
+
+	(void)snprintf(shm_name, sizeof(shm_name), "%s%s",
+	    name[0] == '/' ? "" : "/", name);
+	if ((fd = shm_open(shm_name, O_RDWR | O_CREAT, 0600)) < 0) {
+		fprintf(stderr, "Failed to open control block %s: %s\n",
+		    shm_name, strerror(errno));
+		return;
+	}
+	fresh = fstat(fd, &sb) != 0 || sb.st_size != sizeof(struct fi_control);
+	if (fresh && (*libc_ftruncate)(fd, sizeof(struct fi_control)) != 0) {
+		fprintf(stderr, "Failed to size control block %s: %s\n",
+		    shm_name, strerror(errno));
+		(void)(*libc_close)(fd);
+		return;
+	}
+	control = (*libc_mmap)(NULL, sizeof(struct fi_control),
+	    PROT_READ | PROT_WRITE, MAP_SHARED, fd, 0);
+	(void)(*libc_close)(fd);
+	if (control == MAP_FAILED) {
+		fprintf(stderr, "Failed to map control block %s: %s\n",
+		    shm_name, strerror(errno));
+		return;
+	}
+	if (!fresh && (control->magic != FI_CONTROL_MAGIC ||
+	    control->version != FI_CONTROL_VERSION ||
+	    control->func_count != FI_FUNC_COUNT)) {
+		fprintf(stderr, "Reinitializing mismatched control block %s\n",
+		    shm_name);
+		fresh = 1;
+	}
+	if (fresh) {
+		*control = g_control_local;
+		__atomic_store_n(&control->magic, FI_CONTROL_MAGIC,
+		    __ATOMIC_RELEASE);
+	}
+	FI_ATOMIC_STORE(control->pid, (uint64_t)getpid());
+	g_control = control;
+	printf("Attached control block %s\n", shm_name);
+}
+
+/*
+ * Create and map the statistics file. In a process forked by the target the
+ * counters carry on in the parent's file.
+ */
+static void faultinject_stats_init(void)
+{
+	struct fi_stats *stats;
+	char tmp_file[256];
+	int fd;
+
+	(void)snprintf(tmp_file, 256, "%s/fi_pid_%d_stats.bin",
+	    g_library_trace_tmpdir, (int)getpid());
+	if ((fd = (*libc_open)(tmp_file, O_RDWR | O_CREAT | O_TRUNC, 0644)) < 0) {
+		fprintf(stderr, "Failed to create %s\n", tmp_file);
+		return;
+	}
+	if ((*libc_ftruncate)(fd, sizeof(struct fi_stats)) != 0 ||
+	    (stats = (*libc_mmap)(NULL, sizeof(struct fi_stats),
+	    PROT_READ | PROT_WRITE, MAP_SHARED, fd, 0)) == MAP_FAILED) {
+		fprintf(stderr, "Failed to map %s\n", tmp_file);
+		(void)(*libc_close)(fd);
+		return;
+	}
+	(void)(*libc_close)(fd);
+	stats->version = FI_STATS_VERSION;
+	stats->func_count = FI_FUNC_COUNT;
+	stats->pid = (uint64_t)getpid();
+	__atomic_store_n(&stats->magic, FI_STATS_MAGIC, __ATOMIC_RELEASE);
+	g_stats = stats;
+}
+
+/*
+ * Parse one set of delay settings, any of which may be missing, into a delay.
+ */
+static void faultinject_delay_parse(struct fi_delay *delay,
+    const char *usec, const char *dist, const char *every)
+{
+	if (usec != NULL && strlen(usec) != 0) {
 		errno = 0;
-		g_max_opendir_op_count = strtoull(env_string, NULL, 10);
-#ifdef HAVE_TRACE
-		printf("Set max opendir op count to: %d\n", (int)g_max_opendir_op_count);
-#endif
+		delay->usec = strtoull(usec, NULL, 10);
 		if (errno != 0) {
 			fprintf(stderr, "Failed to parse environment variable\n");
-			g_max_opendir_op_count = 0;
+			delay->usec = 0;
 		}
 	}
-
-	if ((env_string = getenv("FAULTINJECT_PREAD_COUNT")) != NULL &&
-	    strlen(env_string) != 0) {
+	if (dist != NULL && strlen(dist) != 0) {
+		if (strcmp(dist, "fixed") == 0)
+			delay->dist = FI_DELAY_FIXED;
+		else if (strcmp(dist, "uniform") == 0)
+			delay->dist = FI_DELAY_UNIFORM;
+		else if (strcmp(dist, "exponential") == 0)
+			delay->dist = FI_DELAY_EXPONENTIAL;
+		else
+			fprintf(stderr, "Unknown delay distribution %s\n", dist);
+	}
+	if (every != NULL && strlen(every) != 0) {
 		errno = 0;
-		g_max_pread_op_count = strtoull(env_string, NULL, 10);
-#ifdef HAVE_TRACE
-		printf("Set max pread op count to: %d\n", (int)g_max_pread_op_count);
-#endif
-		if (errno != 0) {
+		delay->every = strtoull(every, NULL, 10);
+		if (errno != 0 || delay->every == 0) {
 			fprintf(stderr, "Failed to parse environment variable\n");
-			g_max_pread_op_count = 0;
+			delay->every = 1;
 		}
 	}
+}
 
-	if ((env_string = getenv("FAULTINJECT_PWRITE_COUNT")) != NULL &&
-	    strlen(env_string) != 0) {
-		errno = 0;
-		g_max_pwrite_op_count = strtoull(env_string, NULL, 10);
-#ifdef HAVE_TRACE
-		printf("Set max pwrite op count to: %d\n", (int)g_max_pwrite_op_count);
-#endif
-		if (errno != 0) {
-			fprintf(stderr, "Failed to parse environment variable\n");
-			g_max_pwrite_op_count = 0;
+/*
+ * Read the delay settings of every function, the global ones first.
+ */
+static void faultinject_delay_init(void)
+{
+	struct fi_delay defaults;
+	char *env_string;
+	int i;
+
+	memset(&defaults, 0, sizeof(defaults));
+	defaults.every = 1;
+	faultinject_delay_parse(&defaults, getenv("FAULTINJECT_DELAY_USEC"),
+	    getenv("FAULTINJECT_DELAY_DIST"), getenv("FAULTINJECT_DELAY_EVERY"));
+	for (i = 0; i < FI_FUNC_COUNT; i++) {
+		g_delays[i] = defaults;
+		faultinject_delay_parse(&g_delays[i],
+		    faultinject_func_getenv(i, "DELAY_USEC"),
+		    faultinject_func_getenv(i, "DELAY_DIST"),
+		    faultinject_func_getenv(i, "DELAY_EVERY"));
+		if (g_delays[i].usec != 0) {
+			g_delay_enabled = 1;
+			printf("Delaying every %d %s by %d usec\n",
+			    (int)g_delays[i].every, g_func_names[i],
+			    (int)g_delays[i].usec);
 		}
 	}
+	if ((env_string = getenv("FAULTINJECT_DELAY_SEED")) != NULL &&
+	    strlen(env_string) != 0)
+		g_delay_seed = strtoull(env_string, NULL, 10);
+	else
+		g_delay_seed = (uint64_t)time(NULL) ^ (uint64_t)getpid();
+}
 
-	if ((env_string = getenv("FAULTINJECT_READDIR_COUNT")) != NULL &&
-	    strlen(env_string) != 0) {
-		errno = 0;
-		g_max_readdir_op_count = strtoull(env_string, NULL, 10);
+/*
+ * Return a random number in [0, 1) from a per thread xorshift64* generator.
+ * Threads are seeded in the order they first draw one.
+ */
+static double faultinject_delay_random(void)
+{
+	uint64_t x;
+
+	if ((x = g_delay_rng) == 0)
+		x = (g_delay_seed + FI_ATOMIC_INC(g_delay_threads)) *
+		    0x9e3779b97f4a7c15ULL | 1;
+	x ^= x >> 12;
+	x ^= x << 25;
+	x ^= x >> 27;
+	g_delay_rng = x;
+	return ((double)((x * 0x2545f4914f6cdd1dULL) >> 11) / 9007199254740992.0);
+}
+
+/*
+ * Add microseconds to a time.
+ */
+static void faultinject_timespec_add(struct timespec *ts, uint64_t usec)
+{
+	ts->tv_sec += (time_t)(usec / 1000000);
+	ts->tv_nsec += (long)(usec % 1000000) * 1000;
+	if (ts->tv_nsec >= 1000000000) {
+		ts->tv_sec++;
+		ts->tv_nsec -= 1000000000;
+	}
+}
+
+/*
+ * Wait for a number of microseconds. Sleeping overshoots, by tens to hundreds
+ * of microseconds depending on the system, so sleep until the average
+ * overshoot before the deadline and spin the rest of the way.
+ */
+static void faultinject_delay_wait(uint64_t usec)
+{
+	struct timespec deadline, now, wake;
+	uint64_t oversleep;
+	int64_t late;
+
+	(void)clock_gettime(CLOCK_MONOTONIC, &deadline);
+	wake = deadline;
+	faultinject_timespec_add(&deadline, usec);
+	if (usec > (oversleep = FI_ATOMIC_LOAD(g_delay_oversleep))) {
+		faultinject_timespec_add(&wake, usec - oversleep);
+		while (clock_nanosleep(CLOCK_MONOTONIC,
+		    TIMER_ABSTIME, &wake, NULL) == EINTR)
+			;
+		(void)clock_gettime(CLOCK_MONOTONIC, &now);
+		late = ((int64_t)now.tv_sec - wake.tv_sec) * 1000000 +
+		    ((int64_t)now.tv_nsec - wake.tv_nsec) / 1000;
+		FI_ATOMIC_STORE(g_delay_oversleep,
+		    (oversleep * 7 + (uint64_t)(late > 0 ? late : 0)) / 8);
+	}
+	do {
+		(void)clock_gettime(CLOCK_MONOTONIC, &now);
+	} while (now.tv_sec < deadline.tv_sec || (now.tv_sec == deadline.tv_sec &&
+	    now.tv_nsec < deadline.tv_nsec));
+}
+
+/*
+ * Delay an interesting call if it is one of every Nth, and account for the
+ * time taken.
+ */
+static void faultinject_delay_operation(struct fi_delay *delay)
+{
+	struct timespec start, end;
+	uint64_t max, taken, usec;
+
+	if (FI_ATOMIC_INC(delay->calls) % delay->every != 0)
+		return;
+	switch (delay->dist) {
+	case FI_DELAY_UNIFORM:
+		usec = (uint64_t)(faultinject_delay_random() *
+		    (double)(2 * delay->usec + 1));
+		break;
+	case FI_DELAY_EXPONENTIAL:
+		usec = (uint64_t)(-log(1.0 - faultinject_delay_random()) *
+		    (double)delay->usec);
+		break;
+	default:
+		usec = delay->usec;
+		break;
+	}
+
+	(void)clock_gettime(CLOCK_MONOTONIC, &start);
+	faultinject_delay_wait(usec);
+	(void)clock_gettime(CLOCK_MONOTONIC, &end);
+	taken = (uint64_t)(((int64_t)end.tv_sec - start.tv_sec) * 1000000 +
+	    ((int64_t)end.tv_nsec - start.tv_nsec) / 1000);
+	(void)FI_ATOMIC_INC(delay->delays);
+	(void)__atomic_add_fetch(&delay->total_usec, taken, __ATOMIC_RELAXED);
+	max = FI_ATOMIC_LOAD(delay->max_usec);
+	while (taken > max && !__atomic_compare_exchange_n(&delay->max_usec,
+	    &max, taken, 0, __ATOMIC_RELAXED, __ATOMIC_RELAXED))
+		;
+}
+
+/*
+ * Whether the operation counted as op_count, against a fail count of
+ * max_op_count, falls inside the failure shape.
+ */
+static int faultinject_fail_shape(uint64_t op_count, uint64_t max_op_count)
+{
+	uint64_t every, past, window;
+
+	if (op_count <= max_op_count)
+		return (0);
+	past = op_count - max_op_count - 1;
+	if ((every = FI_ATOMIC_LOAD(g_control->fail_every)) == 0)
+		every = 1;
+	if (past % every != 0)
+		return (0);
+	window = FI_ATOMIC_LOAD(g_control->fail_window);
+	return (window == 0 || past / every < window);
+}
+
+static int faultinject_fail_operation(int func_id)
+{
+	struct fi_func *func;
+	uint64_t max_op_count, op_count;
+
+	if (!libc_open)
+		faultinject_constructor();
+
+	if (__atomic_load_n(&g_dump_start_pending, __ATOMIC_RELAXED))
+		faultinject_dump_restart();
+
+	g_op_count = 0;
+	if (!FI_ATOMIC_LOAD(g_control->enabled))
+		return (0);
+
+	if (FI_ATOMIC_LOAD(g_control->mode) == FI_MODE_COUNT) {
+		g_op_count = op_count = FI_ATOMIC_INC(g_control->op_count);
+		(void)FI_ATOMIC_INC(g_control->funcs[func_id].op_count);
+		if (g_sites_log != NULL)
+			faultinject_record_site(op_count);
+		return (0);
+	}
+
+	if (g_delay_enabled && g_delays[func_id].usec != 0)
+		faultinject_delay_operation(&g_delays[func_id]);
+
+	if (g_fork_sweep_max_children > 0 && !g_fork_sweep_child &&
+	    !faultinject_fork_sweep())
+		return (0);
+
+	/* Count every operation, the trace records its number. */
+	g_op_count = op_count = FI_ATOMIC_INC(g_control->op_count);
+	if ((max_op_count = FI_ATOMIC_LOAD(g_control->max_op_count)) > 0 &&
+	    faultinject_fail_shape(op_count, max_op_count)) {
+		printf("failing with op count: %d\n", (int)op_count);
+		(void)FI_ATOMIC_INC(g_control->failed);
+		FI_STATS_INC(func_id, failed);
+		dump_backtrace();
+		return (EFAULT);
+	}
+
+	func = &g_control->funcs[func_id];
+	if ((max_op_count = FI_ATOMIC_LOAD(func->max_op_count)) > 0 &&
+	    faultinject_fail_shape((op_count =
+	    FI_ATOMIC_INC(func->op_count)), max_op_count)) {
 #ifdef HAVE_TRACE
-		printf("Set max readdir op count to: %d\n", (int)g_max_readdir_op_count);
+		printf("failing %s with op count: %d\n",
+		    g_func_names[func_id], (int)op_count);
 #endif
-		if (errno != 0) {
-			fprintf(stderr, "Failed to parse environment variable\n");
-			g_max_readdir_op_count = 0;
-		}
+		(void)FI_ATOMIC_INC(g_control->failed);
+		FI_STATS_INC(func_id, failed);
+		dump_backtrace();
+		return (EFAULT);
 	}
 
-	if ((env_string = getenv("FAULTINJECT_REMOVE_COUNT")) != NULL &&
-	    strlen(env_string) != 0) {
-		errno = 0;
-		g_max_remove_op_count = strtoull(env_string, NULL, 10);
+	return (0);
+}
+
 #ifdef HAVE_TRACE
-		printf("Set max remove op count to: %d\n", (int)g_max_remove_op_count);
+/*
+ * Create and map the trace ring buffer. Tracing is skipped if there is no
+ * temporary directory to put it in.
+ */
+static void faultinject_trace_init(void)
+{
+	char tmp_file[256];
+	size_t len;
+	void *addr;
+	int fd;
+
+	if (!g_trace_enabled || g_library_trace_tmpdir == NULL)
+		return;
+
+	(void)snprintf(tmp_file, 256, "%s/fi_pid_%d_trace.bin",
+	    g_library_trace_tmpdir, g_trace_pid);
+	len = sizeof(struct fi_trace_header) +
+	    g_trace_capacity * sizeof(struct fi_trace_record);
+	if ((fd = (*libc_open)(tmp_file, O_CREAT | O_TRUNC | O_RDWR, 0644)) < 0) {
+		fprintf(stderr, "Failed to create trace file %s\n", tmp_file);
+		return;
+	}
+	addr = MAP_FAILED;
+	if ((*libc_ftruncate)(fd, (off_t)len) == 0)
+		addr = (*libc_mmap)(
+		    NULL, len, PROT_READ | PROT_WRITE, MAP_SHARED, fd, 0);
+	(void)(*libc_close)(fd);
+	if (addr == MAP_FAILED) {
+		fprintf(stderr, "Failed to map trace file %s\n", tmp_file);
+		return;
+	}
+
+	g_trace_records = (struct fi_trace_record *)
+	    ((struct fi_trace_header *)addr + 1);
+	g_trace_header = addr;
+	g_trace_header->version = FI_TRACE_VERSION;
+	g_trace_header->record_size = sizeof(struct fi_trace_record);
+	g_trace_header->capacity = g_trace_capacity;
+	g_trace_header->head = 0;
+	g_trace_header->pid = (uint32_t)g_trace_pid;
+	g_trace_header->func_count = FI_FUNC_COUNT;
+	__atomic_store_n(&g_trace_header->magic, FI_TRACE_MAGIC, __ATOMIC_RELEASE);
+}
+
+/*
+ * Reserve and fill in the common part of a trace record, returns NULL if
+ * tracing is off. The caller adds the arguments and commits the record.
+ * The stack is hashed here unless checking the caller already did.
+ */
+static struct fi_trace_record *faultinject_trace_begin(
+    uint32_t func_id, uint64_t *seqp)
+{
+	struct fi_trace_record *rec;
+	struct timespec ts;
+	uint64_t hash, seq;
+	void *pcs[FI_BACKTRACE_DEPTH + 1];
+
+	if (g_trace_header == NULL)
+		return (NULL);
+
+	/* libunwind may open and map files, those calls aren't traced. */
+	if ((hash = g_caller_hash) == 0 && g_in_fi_func == 0) {
+		g_in_fi_func = 1;
+		hash = faultinject_hash_pcs(
+		    pcs, unw_backtrace(pcs, FI_BACKTRACE_DEPTH + 1));
+		g_in_fi_func = 0;
+	}
+
+	seq = __atomic_fetch_add(&g_trace_header->head, 1, __ATOMIC_RELAXED);
+	rec = &g_trace_records[seq % g_trace_capacity];
+	FI_ATOMIC_STORE(rec->seq, 0);
+
+	if (g_trace_tid == 0)
+		g_trace_tid = (uint32_t)syscall(SYS_gettid);
+	(void)clock_gettime(CLOCK_MONOTONIC, &ts);
+	rec->func_id = func_id;
+	rec->tid = g_trace_tid;
+	rec->timestamp = (uint64_t)ts.tv_sec * 1000000000 + (uint64_t)ts.tv_nsec;
+	rec->op_count = g_op_count;
+	rec->stack_hash = hash;
+	memset(rec->args, 0, sizeof(rec->args));
+	memset(rec->str, 0, sizeof(rec->str));
+
+	*seqp = seq;
+	return (rec);
+}
+
+/*
+ * Copy a string argument into a trace record, truncating it if needed.
+ */
+static void faultinject_trace_string(
+    struct fi_trace_record *rec, int slot, const char *str)
+{
+	if (str != NULL)
+		(void)strncpy(rec->str[slot], str, FI_TRACE_STR_LEN - 1);
+}
+
+/*
+ * Publish a completed trace record.
+ */
+static void faultinject_trace_commit(struct fi_trace_record *rec, uint64_t seq)
+{
+	__atomic_store_n(&rec->seq, seq + 1, __ATOMIC_RELEASE);
+}
 #endif
-		if (errno != 0) {
-			fprintf(stderr, "Failed to parse environment variable\n");
-			g_max_remove_op_count = 0;
+
+/*
+ * Fill in the backtrace names starting with the frame the cursor is on.
+ */
+static void faultinject_symbolize_backtrace(unw_cursor_t *cursor)
+{
+	unw_word_t offp;
+	char *name;
+
+	g_backtrace_counter = 0;
+	do {
+		name = g_backtrace_info[g_backtrace_counter];
+		name[0] = '\0';
+		if (0 != unw_get_proc_name(cursor,
+		    name, FI_BACKTRACE_NAME_LEN, &offp) || 0 == strlen(name))
+			break;
+		g_backtrace_counter++;
+	} while (g_backtrace_counter < FI_BACKTRACE_DEPTH &&
+	    unw_step(cursor) > 0);
+}
+
+/*
+ * Symbolize the stack of the intercepted call we are about to fail. The
+ * frames belonging to the fault injector itself are skipped, so the first
+ * name is that of the intercepted function.
+ */
+static void faultinject_symbolize_current_backtrace(void)
+{
+	unw_cursor_t cursor;
+	unw_context_t uc;
+	unw_word_t offp;
+	char name[FI_BACKTRACE_NAME_LEN];
+
+	g_backtrace_counter = 0;
+	if (g_in_fi_func == 1)
+		return;
+	g_in_fi_func = 1;
+
+	if (0 != unw_getcontext(&uc) || 0 != unw_init_local(&cursor, &uc))
+		goto end;
+	for (;;) {
+		if (unw_step(&cursor) <= 0 || 0 != unw_get_proc_name(
+		    &cursor, name, FI_BACKTRACE_NAME_LEN, &offp))
+			goto end;
+		if (strncmp(name, "faultinject_", strlen("faultinject_")) != 0 &&
+		    strcmp(name, "dump_backtrace") != 0)
+			break;
+	}
+	faultinject_symbolize_backtrace(&cursor);
+
+end:
+	g_in_fi_func = 0;
+}
+
+static void dump_backtrace(void)
+{
+	int i;
+	char tmp_file[256];
+	FILE *log_fd;
+
+	/*
+	 * The caller cache means the backtrace may not have been symbolized
+	 * when deciding whether the caller was interesting, do it now.
+	 */
+	faultinject_symbolize_current_backtrace();
+
+	/* Log the backtrace */
+	(void)snprintf(tmp_file, 256, "%s/fi_pid_%d_inject_bt.log",
+	    g_library_trace_tmpdir, g_trace_pid);
+	log_fd = (*libc_fopen)(tmp_file, "a");
+        if (log_fd != NULL) {
+		fprintf(log_fd, "Induced fault in following backtrace:\n");
+		for(i = 0; i < g_backtrace_counter; i++)
+			fprintf(log_fd, "%s\n", g_backtrace_info[i]);
+		fprintf(log_fd, "\n");
+		(*libc_fclose)(log_fd);
+	}
+}
+
+/*
+ * Record the return addresses of the calling thread, from the code the signal
+ * interrupted outwards. Return their number.
+ */
+static int faultinject_dump_collect(uintptr_t *pcs)
+{
+	unw_context_t uc;
+	unw_cursor_t cursor, start;
+	unw_word_t ip;
+	int depth, npcs;
+
+	if (unw_getcontext(&uc) != 0 || unw_init_local(&cursor, &uc) != 0)
+		return (0);
+
+	/*
+	 * Skip our own frames: the first frame unwound through the signal
+	 * context is the interrupted code.
+	 */
+	start = cursor;
+	for (depth = 0; depth < FI_DUMP_DEPTH; depth++) {
+		if (unw_step(&cursor) <= 0)
+			break;
+		if (unw_is_signal_frame(&cursor) > 0) {
+			start = cursor;
+			break;
 		}
 	}
+	cursor = start;
+
+	for (npcs = 0; npcs < FI_DUMP_DEPTH; ) {
+		if (unw_get_reg(&cursor, UNW_REG_IP, &ip) != 0)
+			break;
+		pcs[npcs++] = (uintptr_t)ip;
+		if (unw_step(&cursor) <= 0)
+			break;
+	}
+	return (npcs);
+}
+
+/*
+ * Name the functions of a slot's return addresses, outside of any signal
+ * handler. A cursor of our own is pointed at each address in turn.
+ */
+static void faultinject_dump_symbolize(struct fi_dump_slot *slot)
+{
+	unw_context_t uc;
+	unw_cursor_t cursor;
+	unw_word_t offp;
+	size_t len, name_len;
+	char name[FI_BACKTRACE_NAME_LEN];
+	int i;
+
+	slot->line[0] = '\0';
+	if (unw_getcontext(&uc) != 0 || unw_init_local(&cursor, &uc) != 0)
+		return;
+	len = 0;
+	for (i = 0; i < slot->npcs; i++) {
+		/* A return address may be past the end of its function. */
+		if (unw_set_reg(&cursor, UNW_REG_IP,
+		    (unw_word_t)(slot->pcs[i] - (i == 0 ? 0 : 1))) != 0 ||
+		    unw_get_proc_name(&cursor, name, sizeof(name), &offp) != 0 ||
+		    name[0] == '\0')
+			(void)strcpy(name, "??");
+		name_len = strlen(name);
+		if (len + name_len + 2 > FI_DUMP_LINE_LEN)
+			break;
+		if (len != 0)
+			slot->line[len++] = ',';
+		memcpy(slot->line + len, name, name_len + 1);
+		len += name_len;
+	}
+}
+
+/*
+ * Ask every other thread of the process for its stack, then append them to
+ * the hung backtrace log, identical stacks collapsed into one line.
+ */
+static void faultinject_dump_sample(void)
+{
+	struct {
+		uint64_t d_ino;
+		int64_t d_off;
+		unsigned short d_reclen;
+		unsigned char d_type;
+		char d_name[];
+	} *entry;
+	struct fi_dump_slot *slot, tmp;
+	struct timespec ts;
+	siginfo_t info;
+	char dents[4096], path[256];
+	uint64_t request;
+	pid_t pid, tid;
+	size_t len;
+	long n, off;
+	int fd, i, j, nslots, waited;
+	static uint32_t ticket = 0;
+
+	pid = getpid();
+	nslots = 0;
+	if ((fd = (*libc_open)("/proc/self/task", O_RDONLY | O_DIRECTORY)) < 0)
+		return;
+	while ((n = syscall(SYS_getdents64, fd, dents, sizeof(dents))) > 0)
+		for (off = 0; off < n; off += entry->d_reclen) {
+			entry = (void *)(dents + off);
+			if (entry->d_name[0] == '.' ||
+			    (tid = (pid_t)strtol(entry->d_name, NULL, 10)) ==
+			    g_dump_tid || nslots == FI_DUMP_MAX_THREADS)
+				continue;
+			slot = &g_dump_slots[nslots];
+			request = FI_DUMP_REQUEST(++ticket, nslots, tid);
+			slot->done = 0;
+			slot->count = 1;
+			__atomic_store_n(&slot->request, request, __ATOMIC_RELEASE);
+			memset(&info, 0, sizeof(info));
+			info.si_signo = g_dump_signal;
+			info.si_code = SI_QUEUE;
+			info.si_pid = pid;
+			info.si_uid = getuid();
+			info.si_value.sival_ptr = (void *)(uintptr_t)request;
+			if (syscall(SYS_rt_tgsigqueueinfo,
+			    pid, tid, g_dump_signal, &info) != 0)
+				continue;
+			ts.tv_sec = 0;
+			ts.tv_nsec = 1000000;
+			for (waited = 0; waited < FI_DUMP_WAIT_MS &&
+			    !__atomic_load_n(&slot->done, __ATOMIC_ACQUIRE);
+			    waited++)
+				(void)nanosleep(&ts, NULL);
+			/*
+			 * Give up on a thread that hasn't answered, unless it
+			 * just claimed the slot, then it is about to finish.
+			 */
+			if (!__atomic_load_n(&slot->done, __ATOMIC_ACQUIRE) &&
+			    __atomic_compare_exchange_n(&slot->request, &request,
+			    0, 0, __ATOMIC_ACQ_REL, __ATOMIC_ACQUIRE))
+				continue;
+			while (!__atomic_load_n(&slot->done, __ATOMIC_ACQUIRE))
+				(void)nanosleep(&ts, NULL);
+			nslots++;
+		}
+	(void)(*libc_close)(fd);
+	for (i = 0; i < nslots; i++)
+		faultinject_dump_symbolize(&g_dump_slots[i]);
+
+	/* Collapse identical stacks, then order by count, most first. */
+	for (i = 0; i < nslots; i++)
+		for (j = i + 1; j < nslots; j++)
+			if (g_dump_slots[j].count != 0 &&
+			    strcmp(g_dump_slots[i].line, g_dump_slots[j].line) == 0) {
+				g_dump_slots[i].count += g_dump_slots[j].count;
+				g_dump_slots[j].count = 0;
+			}
+	for (i = 1; i < nslots; i++)
+		for (j = i; j > 0 &&
+		    g_dump_slots[j].count > g_dump_slots[j - 1].count; j--) {
+			tmp = g_dump_slots[j];
+			g_dump_slots[j] = g_dump_slots[j - 1];
+			g_dump_slots[j - 1] = tmp;
+		}
 
-	if ((env_string = getenv("FAULTINJECT_RENAME_COUNT")) != NULL &&
-	    strlen(env_string) != 0) {
-		errno = 0;
-		g_max_rename_op_count = strtoull(env_string, NULL, 10);
-#ifdef HAVE_TRACE
-		printf("Set max rename op count to: %d\n", (int)g_max_rename_op_count);
-#endif
-		if (errno != 0) {
-			fprintf(stderr, "Failed to parse environment variable\n");
-			g_max_rename_op_count = 0;
+	/* A single append, so a reader never sees half a sample. */
+	len = 0;
+	for (i = 0; i < nslots && g_dump_slots[i].count != 0; i++)
+		len += (size_t)snprintf(g_dump_buf + len,
+		    (size_t)FI_DUMP_MAX_THREADS * (FI_DUMP_LINE_LEN + 16) - len,
+		    "%d:%s\n", g_dump_slots[i].count, g_dump_slots[i].line);
+	g_dump_buf[len++] = '\n';
+	(void)snprintf(path, sizeof(path), "%s/fi_pid_%d_hung_btt.log",
+	    g_library_trace_tmpdir == NULL ? "." : g_library_trace_tmpdir,
+	    (int)pid);
+	if ((fd = (*libc_open)(path,
+	    O_WRONLY | O_CREAT | O_APPEND, 0644)) < 0)
+		return;
+	(void)write(fd, g_dump_buf, len);
+	(void)(*libc_close)(fd);
+}
+
+/*
+ * The signal either carries a request of the dumping thread for this
+ * thread's stack, or comes from outside and asks for a sample, which is left
+ * to the dumping thread.
+ */
+static void faultinject_dump_handler(int sig, siginfo_t *info, void *context)
+{
+	struct fi_dump_slot *slot;
+	uintptr_t pcs[FI_DUMP_DEPTH];
+	uint64_t request;
+	int npcs, saved_errno, saved_in_fi_func;
+
+	(void)sig;
+	(void)context;
+	saved_errno = errno;
+	/* Unwinding reads object files, don't fail those operations. */
+	saved_in_fi_func = g_in_fi_func;
+	g_in_fi_func = 1;
+	request = 0;
+	if (info->si_code == SI_QUEUE && info->si_pid == getpid())
+		request = (uint64_t)(uintptr_t)info->si_value.sival_ptr;
+	if (request == 0)
+		(void)sem_post(&g_dump_sem);
+	else if (FI_DUMP_REQUEST_TID(request) ==
+	    (pid_t)syscall(SYS_gettid)) {
+		npcs = faultinject_dump_collect(pcs);
+		slot = &g_dump_slots[FI_DUMP_REQUEST_SLOT(request)];
+		if (__atomic_compare_exchange_n(&slot->request, &request,
+		    request | FI_DUMP_CLAIMED, 0,
+		    __ATOMIC_ACQ_REL, __ATOMIC_ACQUIRE)) {
+			memcpy(slot->pcs, pcs, (size_t)npcs * sizeof(pcs[0]));
+			slot->npcs = npcs;
+			__atomic_store_n(&slot->done, 1, __ATOMIC_RELEASE);
 		}
 	}
+	g_in_fi_func = saved_in_fi_func;
+	errno = saved_errno;
 }
 
-static int faultinject_fail_operation(void)
+/*
+ * The dumping thread takes a sample each time it is asked. Its own file
+ * operations are never interesting.
+ */
+static void *faultinject_dump_thread(void *arg)
 {
-	if (!libc_open)
-		faultinject_constructor();
+	(void)arg;
+	g_in_fi_func = 1;
+	__atomic_store_n(&g_dump_tid, (pid_t)syscall(SYS_gettid),
+	    __ATOMIC_RELEASE);
+	for (;;)
+		if (sem_wait(&g_dump_sem) == 0)
+			faultinject_dump_sample();
+	return (NULL);
+}
 
-	if (g_max_op_count > 0 && ++g_op_count > g_max_op_count) {
-		printf("failing with op count: %d\n", (int)g_op_count);
-		dump_backtrace();
-		return (EFAULT);
-	}
+/*
+ * Start the dumping thread with every signal blocked, so that none meant for
+ * the target are delivered to it.
+ */
+static int faultinject_dump_start(void)
+{
+	pthread_t thread;
+	sigset_t all, saved;
+	int ret;
+
+	if (sem_init(&g_dump_sem, 0, 0) != 0)
+		return (errno);
+	(void)sigfillset(&all);
+	(void)pthread_sigmask(SIG_SETMASK, &all, &saved);
+	ret = pthread_create(&thread, NULL, faultinject_dump_thread, NULL);
+	(void)pthread_sigmask(SIG_SETMASK, &saved, NULL);
+	if (ret == 0)
+		(void)pthread_detach(thread);
+	return (ret);
+}
 
+/*
+ * Only the forking thread survives a fork, the child needs a new dumping
+ * thread.
+ */
+static void faultinject_dump_atfork_child(void)
+{
+	g_dump_tid = 0;
+	g_dump_start_pending = 1;
+}
 
-	if (g_max_close_op_count > 0 &&
-        ++g_close_op_count > g_max_close_op_count) {
-#ifdef HAVE_TRACE
-		printf("failing close with op count: %d\n", (int)g_close_op_count);
-#endif
-                dump_backtrace();
-		return (EFAULT);
-	}
-	else if (g_max_closedir_op_count > 0 &&
-        ++g_closedir_op_count > g_max_closedir_op_count) {
-#ifdef HAVE_TRACE
-		printf("failing closedir with op count: %d\n", (int)g_closedir_op_count);
-#endif
-                dump_backtrace();
-		return (EFAULT);
-	}
-	else if (g_max_fclose_op_count > 0 &&
-        ++g_fclose_op_count > g_max_fclose_op_count) {
-#ifdef HAVE_TRACE
-		printf("failing fclose with op count: %d\n", (int)g_fclose_op_count);
-#endif
-                dump_backtrace();
-		return (EFAULT);
-	}
-	else if (g_max_fsync_op_count > 0 &&
-        ++g_fsync_op_count > g_max_fsync_op_count) {
-#ifdef HAVE_TRACE
-		printf("failing fsync with op count: %d\n", (int)g_fsync_op_count);
-#endif
-                dump_backtrace();
-		return (EFAULT);
-	}
-	else if (g_max_fdatasync_op_count > 0 &&
-        ++g_fdatasync_op_count > g_max_fdatasync_op_count) {
-#ifdef HAVE_TRACE
-		printf("failing fdatasync with op count: %d\n", (int)g_fdatasync_op_count);
-#endif
-                dump_backtrace();
-		return (EFAULT);
-	}
-	else if (g_max_fopen_op_count > 0 &&
-        ++g_fopen_op_count > g_max_fopen_op_count) {
-#ifdef HAVE_TRACE
-		printf("failing fopen with op count: %d\n", (int)g_fopen_op_count);
-#endif
-                dump_backtrace();
-		return (EFAULT);
-	}
-	else if (g_max_truncate_op_count > 0 &&
-        ++g_truncate_op_count > g_max_truncate_op_count) {
-#ifdef HAVE_TRACE
-		printf("failing truncate with op count: %d\n", (int)g_truncate_op_count);
-#endif
-                dump_backtrace();
-		return (EFAULT);
-	}
-	else if (g_max_ftruncate_op_count > 0 &&
-        ++g_ftruncate_op_count > g_max_ftruncate_op_count) {
-#ifdef HAVE_TRACE
-		printf("failing ftruncate with op count: %d\n", (int)g_ftruncate_op_count);
-#endif
-                dump_backtrace();
-		return (EFAULT);
-	}
-	else if (g_max_mmap_op_count > 0 &&
-        ++g_mmap_op_count > g_max_mmap_op_count) {
-#ifdef HAVE_TRACE
-		printf("failing mmap with op count: %d\n", (int)g_mmap_op_count);
-#endif
-                dump_backtrace();
-		return (EFAULT);
+/* Start the dumping thread of a forked child, once. */
+static void faultinject_dump_restart(void)
+{
+	if (!__atomic_exchange_n(&g_dump_start_pending, 0, __ATOMIC_ACQ_REL))
+		return;
+	if (faultinject_dump_start() != 0)
+		g_dump_signal = 0;
+}
+
+/*
+ * Install the backtrace handler. The output buffer holds a line per thread
+ * plus its count.
+ */
+static void faultinject_dump_install(int sig)
+{
+	struct sigaction sa;
+	int ret;
+
+	if ((g_dump_slots = calloc(FI_DUMP_MAX_THREADS,
+	    sizeof(struct fi_dump_slot))) == NULL ||
+	    (g_dump_buf = malloc((size_t)FI_DUMP_MAX_THREADS *
+	    (FI_DUMP_LINE_LEN + 16) + 1)) == NULL) {
+		fprintf(stderr, "Failed to allocate backtrace buffers\n");
+		free(g_dump_slots);
+		g_dump_slots = NULL;
+		return;
 	}
-	else if (g_max_munmap_op_count > 0 &&
-        ++g_munmap_op_count > g_max_munmap_op_count) {
-#ifdef HAVE_TRACE
-		printf("failing munmap with op count: %d\n", (int)g_munmap_op_count);
-#endif
-                dump_backtrace();
-		return (EFAULT);
+	if ((ret = faultinject_dump_start()) != 0) {
+		fprintf(stderr, "Failed to start the backtrace thread: %s\n",
+		    strerror(ret));
+		return;
 	}
-	else if (g_max_open_op_count > 0 &&
-        ++g_open_op_count > g_max_open_op_count) {
-#ifdef HAVE_TRACE
-		printf("failing open with op count: %d\n", (int)g_open_op_count);
-#endif
-                dump_backtrace();
-		return (EFAULT);
+	(void)pthread_atfork(NULL, NULL, faultinject_dump_atfork_child);
+	memset(&sa, 0, sizeof(sa));
+	sa.sa_sigaction = faultinject_dump_handler;
+	sa.sa_flags = SA_RESTART | SA_SIGINFO;
+	(void)sigemptyset(&sa.sa_mask);
+	if (sigaction(sig, &sa, NULL) != 0) {
+		fprintf(stderr, "Failed to install backtrace handler: %s\n",
+		    strerror(errno));
+		return;
 	}
-	else if (g_max_open64_op_count > 0 &&
-        ++g_open64_op_count > g_max_open64_op_count) {
-#ifdef HAVE_TRACE
-		printf("failing open64 with op count: %d\n", (int)g_open64_op_count);
-#endif
-                dump_backtrace();
-		return (EFAULT);
+	g_dump_signal = sig;
+}
+
+/*
+ * Hash a chain of return addresses (FNV-1a). The low bit is kept clear for
+ * the verdict stored alongside the hash in the caller cache, and zero is
+ * reserved for empty cache slots.
+ */
+static uint64_t faultinject_hash_pcs(void **pcs, int npcs)
+{
+	uint64_t hash;
+	uintptr_t pc;
+	int i, j;
+
+	hash = 14695981039346656037ULL;
+	for (i = 0; i < npcs; i++) {
+		pc = (uintptr_t)pcs[i];
+		for (j = 0; j < (int)sizeof(pc); j++) {
+			hash ^= (pc >> (j * 8)) & 0xff;
+			hash *= 1099511628211ULL;
+		}
 	}
-	else if (g_max_opendir_op_count > 0 &&
-        ++g_opendir_op_count > g_max_opendir_op_count) {
-#ifdef HAVE_TRACE
-		printf("failing opendir with op count: %d\n", (int)g_opendir_op_count);
-#endif
-                dump_backtrace();
-		return (EFAULT);
+	hash &= ~(uint64_t)1;
+	return (hash == 0 ? 2 : hash);
+}
+
+/*
+ * Key a chain of callers by the generation of the library object's ranges
+ * as well, so verdicts from an earlier set of ranges no longer match.
+ */
+static uint64_t faultinject_hash_generation(uint64_t hash, uint64_t generation)
+{
+	hash ^= generation * 0x9e3779b97f4a7c15ULL;
+	hash &= ~(uint64_t)1;
+	return (hash == 0 ? 2 : hash);
+}
+
+/* Store the verdict for a chain of callers in the caller cache. */
+static void faultinject_caller_cache_insert(uint64_t key, int ret)
+{
+	uint64_t entry;
+
+	/* Another thread may have just stored the same chain. */
+	entry = __atomic_exchange_n(&g_caller_cache[FI_CALLER_CACHE_SLOT(key)],
+	    key | (uint64_t)ret, __ATOMIC_RELAXED);
+	if (entry != 0 && (entry & ~(uint64_t)1) != key)
+		(void)FI_ATOMIC_INC(g_caller_cache_evictions);
+}
+
+/*
+ * Write the injection site of an operation to the sites log. Return
+ * addresses are hashed as the base name of the object they fall in and
+ * their offset from its load address, which don't change between runs.
+ */
+static void faultinject_record_site(uint64_t op_count)
+{
+	Dl_info info;
+	const char *name;
+	uint64_t hash, offset;
+	void *pcs[FI_BACKTRACE_DEPTH + 1];
+	int i, npcs;
+
+	/* libunwind may open and map files, those calls aren't counted. */
+	if (g_in_fi_func == 1)
+		return;
+	g_in_fi_func = 1;
+
+	hash = 14695981039346656037ULL;
+	npcs = unw_backtrace(pcs, FI_BACKTRACE_DEPTH + 1);
+	for (i = 0; i < npcs; i++) {
+		offset = (uint64_t)(uintptr_t)pcs[i];
+		if (dladdr(pcs[i], &info) != 0 && info.dli_fname != NULL) {
+			if ((name = strrchr(info.dli_fname, '/')) == NULL)
+				name = info.dli_fname;
+			for (; *name != '\0'; name++) {
+				hash ^= (unsigned char)*name;
+				hash *= 1099511628211ULL;
+			}
+			offset -= (uint64_t)(uintptr_t)info.dli_fbase;
+		}
+		for (; offset != 0; offset >>= 8) {
+			hash ^= offset & 0xff;
+			hash *= 1099511628211ULL;
+		}
 	}
-	else if (g_max_pread_op_count > 0 &&
-        ++g_pread_op_count > g_max_pread_op_count) {
-#ifdef HAVE_TRACE
-		printf("failing pread with op count: %d\n", (int)g_pread_op_count);
-#endif
-                dump_backtrace();
-		return (EFAULT);
+
+	(void)pthread_mutex_lock(&g_sites_lock);
+	if (g_sites_log != NULL)
+		fprintf(g_sites_log, "%" PRIu64 " %016" PRIx64 "\n",
+		    op_count, hash);
+	(void)pthread_mutex_unlock(&g_sites_lock);
+
+	g_in_fi_func = 0;
+}
+
+/*
+ * Whether the loader's counters of objects added and removed come with each
+ * object it reports.
+ */
+#define	FI_PHDR_HAS_COUNTERS(size)					\
+	((size) >= offsetof(struct dl_phdr_info, dlpi_subs) +		\
+	    sizeof(((struct dl_phdr_info *)NULL)->dlpi_subs))
+
+/*
+ * Collect the executable segments of a loaded object if its file name
+ * contains the configured library object name.
+ */
+static int faultinject_phdr_callback(
+    struct dl_phdr_info *info, size_t size, void *data)
+{
+	struct fi_object_ranges *found;
+	const char *name;
+	int i;
+
+	found = data;
+
+	if (FI_PHDR_HAS_COUNTERS(size)) {
+		found->adds = info->dlpi_adds;
+		found->subs = info->dlpi_subs;
 	}
-	else if (g_max_pwrite_op_count > 0 &&
-        ++g_pwrite_op_count > g_max_pwrite_op_count) {
-#ifdef HAVE_TRACE
-		printf("failing pwrite with op count: %d\n", (int)g_pwrite_op_count);
-#endif
-                dump_backtrace();
-		return (EFAULT);
+	name = info->dlpi_name;
+	if (name == NULL || strlen(name) == 0)
+		name = g_exe_name;
+	if (strrchr(name, '/') != NULL)
+		name = strrchr(name, '/') + 1;
+	if (strlen(name) == 0 || strstr(name, g_library_object) == NULL)
+		return (0);
+
+	for (i = 0; i < info->dlpi_phnum; i++) {
+		if (info->dlpi_phdr[i].p_type != PT_LOAD ||
+		    (info->dlpi_phdr[i].p_flags & PF_X) == 0)
+			continue;
+		if (found->count == FI_MAX_OBJECT_RANGES)
+			return (1);
+		found->ranges[found->count].start =
+		    info->dlpi_addr + info->dlpi_phdr[i].p_vaddr;
+		found->ranges[found->count].end =
+		    found->ranges[found->count].start +
+		    info->dlpi_phdr[i].p_memsz;
+		++found->count;
 	}
-	else if (g_max_readdir_op_count > 0 &&
-        ++g_readdir_op_count > g_max_readdir_op_count) {
+	return (0);
+}
+
+/*
+ * Resolve the address ranges of the library object into a new set, then
+ * publish it.
+ */
+static void faultinject_resolve_object_ranges(void)
+{
+	struct fi_object_ranges *found;
+	ssize_t len;
+
+	if ((found = calloc(1, sizeof(*found))) == NULL)
+		return;
+	(void)pthread_mutex_lock(&g_object_range_lock);
+	if (g_exe_name[0] == '\0' && (len = readlink("/proc/self/exe",
+	    g_exe_name, sizeof(g_exe_name) - 1)) > 0)
+		g_exe_name[len] = '\0';
+	found->generation = ++g_object_ranges_generation;
+	(void)dl_iterate_phdr(faultinject_phdr_callback, found);
+	__atomic_store_n(&g_object_ranges, found, __ATOMIC_RELEASE);
+	(void)pthread_mutex_unlock(&g_object_range_lock);
 #ifdef HAVE_TRACE
-		printf("failing readdir with op count: %d\n", (int)g_readdir_op_count);
+	printf("Library object %s resolved to %d address ranges\n",
+	    g_library_object, found->count);
 #endif
-                dump_backtrace();
-		return (EFAULT);
+}
+
+/* Read the loader's counters of objects added and removed. */
+static int faultinject_phdr_counters(
+    struct dl_phdr_info *info, size_t size, void *data)
+{
+	unsigned long long *counters;
+
+	counters = data;
+	if (FI_PHDR_HAS_COUNTERS(size)) {
+		counters[0] = info->dlpi_adds;
+		counters[1] = info->dlpi_subs;
 	}
-	else if (g_max_remove_op_count > 0 &&
-        ++g_remove_op_count > g_max_remove_op_count) {
-#ifdef HAVE_TRACE
-		printf("failing remove with op count: %d\n", (int)g_remove_op_count);
-#endif
-                dump_backtrace();
-		return (EFAULT);
+	return (1);
+}
+
+/*
+ * Return the address ranges of the library object, resolving them again
+ * first if objects were loaded or unloaded since they were. NULL if they
+ * couldn't be resolved.
+ */
+static struct fi_object_ranges *faultinject_object_ranges(void)
+{
+	struct fi_object_ranges *current;
+	unsigned long long counters[2];
+
+	counters[0] = counters[1] = 0;
+	(void)dl_iterate_phdr(faultinject_phdr_counters, counters);
+	current = __atomic_load_n(&g_object_ranges, __ATOMIC_ACQUIRE);
+	if (current == NULL ||
+	    counters[0] != current->adds || counters[1] != current->subs) {
+		faultinject_resolve_object_ranges();
+		current = __atomic_load_n(&g_object_ranges, __ATOMIC_ACQUIRE);
 	}
-	else if (g_max_rename_op_count > 0 &&
-        ++g_rename_op_count > g_max_rename_op_count) {
-#ifdef HAVE_TRACE
-		printf("failing rename with op count: %d\n", (int)g_rename_op_count);
-#endif
-                dump_backtrace();
-		return (EFAULT);
+	return (current);
+}
+
+/*
+ * Check whether any of a chain of return addresses is inside a set of
+ * address ranges of the library object.
+ */
+static int faultinject_pcs_in_object(
+    struct fi_object_ranges *ranges, void **pcs, int npcs)
+{
+	uintptr_t pc;
+	int i, j;
+
+	if (ranges == NULL)
+		return (0);
+	for (i = 0; i < npcs; i++) {
+		pc = (uintptr_t)pcs[i];
+		for (j = 0; j < ranges->count; j++)
+			if (pc >= ranges->ranges[j].start &&
+			    pc < ranges->ranges[j].end)
+				return (1);
 	}
 	return (0);
 }
 
-#ifdef HAVE_TRACE
-/* We may want to make this conditional at runtime. */
-static int faultinject_trace_operation(void)
+/*
+ * Split the path filter into patterns and size the descriptor table from the
+ * descriptor limit of the process.
+ */
+static void faultinject_path_filter_init(char *filter)
 {
-	return (1);
+	struct rlimit rl;
+	char *pattern, *save;
+
+	if ((filter = strdup(filter)) == NULL)
+		return;
+	for (pattern = strtok_r(filter, ":", &save); pattern != NULL &&
+	    g_path_pattern_count < FI_MAX_PATH_PATTERNS;
+	    pattern = strtok_r(NULL, ":", &save))
+		g_path_patterns[g_path_pattern_count++] = pattern;
+	if (pattern != NULL)
+		fprintf(stderr, "Ignoring path filter patterns past the first %d\n",
+		    FI_MAX_PATH_PATTERNS);
+
+	g_fd_table_size = FI_MAX_FD_TABLE;
+	if (getrlimit(RLIMIT_NOFILE, &rl) == 0 && rl.rlim_cur != RLIM_INFINITY &&
+	    rl.rlim_cur < FI_MAX_FD_TABLE)
+		g_fd_table_size = (int)rl.rlim_cur;
+	if ((g_fd_table = calloc((size_t)g_fd_table_size, 1)) == NULL)
+		g_fd_table_size = 0;
 }
-#endif
 
-static void dump_backtrace(void)
+/*
+ * Check whether a path matches the path filter. A pattern containing a slash
+ * is matched against the whole path, any other against its last component.
+ * Everything matches when there is no filter, nothing without a path.
+ */
+static int faultinject_path_interesting(const char *path)
 {
+	const char *base;
 	int i;
-	char tmp_file[256];
-	FILE *log_fd;
 
-	/* Log the backtrace */
-	(void)snprintf(tmp_file, 256, "%s/fi_pid_%d_inject_bt.log",
-	    g_library_trace_tmpdir, g_trace_pid);
-	log_fd = (*libc_fopen)(tmp_file, "a");
-        if (log_fd != NULL) {
-		fprintf(log_fd, "Induced fault in following backtrace:\n");
-		for(i = 0; i < g_backtrace_counter; i++)
-			fprintf(log_fd, "%s\n", g_backtrace_info[i]);
-		fprintf(log_fd, "\n");
-		(*libc_fclose)(log_fd);
-	}
+	if (g_path_pattern_count == 0)
+		return (1);
+	if (path == NULL)
+		return (0);
+	if ((base = strrchr(path, '/')) == NULL)
+		base = path;
+	else
+		base++;
+	for (i = 0; i < g_path_pattern_count; i++)
+		if (fnmatch(g_path_patterns[i],
+		    strchr(g_path_patterns[i], '/') == NULL ? base : path,
+		    0) == 0)
+			return (1);
+	return (0);
+}
+
+/* Check whether a descriptor was opened from a path matching the filter. */
+static int faultinject_fd_interesting(int fd)
+{
+	if (g_path_pattern_count == 0)
+		return (1);
+	if (fd < 0 || fd >= g_fd_table_size)
+		return (0);
+	return (FI_ATOMIC_LOAD(g_fd_table[fd]));
+}
+
+/* Remember whether a newly opened descriptor refers to a matching path. */
+static void faultinject_fd_opened(int fd, const char *path)
+{
+	if (fd < 0 || fd >= g_fd_table_size)
+		return;
+	FI_ATOMIC_STORE(g_fd_table[fd],
+	    (uint8_t)faultinject_path_interesting(path));
+}
+
+/* Forget a descriptor that is being closed. */
+static void faultinject_fd_closed(int fd)
+{
+	if (fd < 0 || fd >= g_fd_table_size)
+		return;
+	FI_ATOMIC_STORE(g_fd_table[fd], 0);
 }
 
-static int faultinject_caller_interesting(void)
+static int faultinject_caller_interesting(int func_id)
 {
 	unw_cursor_t cursor;
 	unw_context_t uc;
-	unw_word_t offp;
-	int i, ret;
+	struct fi_object_ranges *ranges;
+	struct timespec start, end;
+	uint64_t entry, hash, key;
+	void *pcs[FI_BACKTRACE_DEPTH + 1];
+	int i, npcs, ret;
 
 	/* Avoid fall-injecting recursively inside this particular function */
-	static int in_fi_func = 0;
-	if (in_fi_func == 1)
+	if (g_in_fi_func == 1) {
+		FI_STATS_INC(func_id, recursed);
 		return (0);
-	in_fi_func = 1;
+	}
+	g_in_fi_func = 1;
+	if (g_stats != NULL)
+		(void)clock_gettime(CLOCK_MONOTONIC, &start);
 
 	ret = 0;
-	if (g_library_trace_substring == NULL) {
+	hash = key = 0;
+	npcs = 0;
+	if (g_library_object == NULL && g_library_trace_substring == NULL) {
 		ret = 1;
 		goto end;
 	}
 
+	/*
+	 * Collecting the raw return addresses is cheap, looking up their
+	 * names or the loaded objects is not: check whether we have seen this
+	 * chain of callers before.
+	 */
+	if (g_library_object != NULL || g_caller_cache_enabled)
+		npcs = unw_backtrace(pcs, FI_BACKTRACE_DEPTH + 1);
+	if (g_caller_cache_enabled) {
+		hash = key = faultinject_hash_pcs(pcs, npcs);
+		if (g_library_object != NULL &&
+		    (ranges = __atomic_load_n(
+		    &g_object_ranges, __ATOMIC_ACQUIRE)) != NULL)
+			key = faultinject_hash_generation(
+			    hash, ranges->generation);
+		entry = FI_ATOMIC_LOAD(g_caller_cache[FI_CALLER_CACHE_SLOT(key)]);
+		if ((entry & ~(uint64_t)1) == key) {
+			(void)FI_ATOMIC_INC(g_caller_cache_hits);
+			ret = (int)(entry & 1);
+			goto end;
+		}
+		(void)FI_ATOMIC_INC(g_caller_cache_misses);
+	}
+
+	if (g_library_object != NULL) {
+		/* No symbol lookups needed, compare raw addresses. */
+		ranges = faultinject_object_ranges();
+		ret = faultinject_pcs_in_object(ranges, pcs, npcs);
+		if (g_caller_cache_enabled && ranges != NULL)
+			faultinject_caller_cache_insert(faultinject_hash_generation(
+			    hash, ranges->generation), ret);
+		goto end;
+	}
+
 	if (0 != unw_getcontext(&uc))
 		goto end;
 
@@ -736,14 +2202,8 @@ static int faultinject_caller_interesting(void)
 	 * library we want to induce fault in
 	 */
 	g_backtrace_counter = 0;
-	while (unw_step(&cursor) > 0 && g_backtrace_counter < 20) {
-		g_backtrace_info[g_backtrace_counter][0] = '\0';
-		if (0 != unw_get_proc_name(&cursor,
-		    g_backtrace_info[g_backtrace_counter], 256, &offp) ||
-		    0 == strlen(g_backtrace_info[g_backtrace_counter]))
-		       break;
-		g_backtrace_counter++;
-	}
+	if (unw_step(&cursor) > 0)
+		faultinject_symbolize_backtrace(&cursor);
 	for (i = 0; i < g_backtrace_counter; i++) {
 		if (strstr(g_backtrace_info[i],
 		    g_library_trace_substring) != NULL) {
@@ -752,8 +2212,21 @@ static int faultinject_caller_interesting(void)
 			}
 	}
 
+	if (g_caller_cache_enabled)
+		faultinject_caller_cache_insert(key, ret);
+
 end:
-	in_fi_func = 0;
+	if (g_stats != NULL) {
+		(void)clock_gettime(CLOCK_MONOTONIC, &end);
+		(void)FI_ATOMIC_INC(g_stats->funcs[func_id].checks);
+		(void)__atomic_add_fetch(&g_stats->funcs[func_id].check_ns,
+		    (uint64_t)(((int64_t)end.tv_sec - start.tv_sec) * 1000000000 +
+		    ((int64_t)end.tv_nsec - start.tv_nsec)), __ATOMIC_RELAXED);
+		if (ret)
+			(void)FI_ATOMIC_INC(g_stats->funcs[func_id].interesting);
+	}
+	g_caller_hash = hash;
+	g_in_fi_func = 0;
 	return (ret);
 }
 
@@ -761,132 +2234,111 @@ end:
 FAULT_INJECT_API int  close(int fd)
 {
     int ret;
-    FILE *log_fd;
-    char tmp_file[256];
-
+#ifdef HAVE_TRACE
+    struct fi_trace_record *trace_rec;
+    uint64_t trace_seq;
+#endif
 
-    if (faultinject_caller_interesting()) {
+    FI_STATS_INC(FI_FUNC_CLOSE, intercepted);
+    if (faultinject_fd_interesting(fd) &&
+        faultinject_caller_interesting(FI_FUNC_CLOSE)) {
+            ret = faultinject_fail_operation(FI_FUNC_CLOSE);
         #ifdef HAVE_TRACE
-            if (faultinject_trace_operation()) {
-                /* Log the operation */
-                (void)snprintf(tmp_file, 256,
-                    "%s/fi_pid_%d_close.log", g_library_trace_tmpdir,
-                    g_trace_pid);
-                log_fd = (*libc_fopen)(tmp_file, "a");
-                if (log_fd != NULL) {
-                    fprintf(log_fd, "Intercepted call to: close(");
-                    
-        fprintf(log_fd, "fd:%d, ", fd);
-                    fprintf(log_fd, ");\n");
-                    (*libc_fclose)(log_fd);
-                }
+            /* Log the operation, once it has been counted */
+            if ((trace_rec = faultinject_trace_begin(
+                FI_FUNC_CLOSE, &trace_seq)) != NULL) {
+                trace_rec->args[0] = (uint64_t)fd;
+                faultinject_trace_commit(trace_rec, trace_seq);
             }
-        #else
-            log_fd = NULL; log_fd = log_fd;
         #endif
-            if ((ret = faultinject_fail_operation()) != 0) {
+            if (ret != 0) {
                 errno = ret;
                 return (-1);
             }
     }
+    faultinject_fd_closed(fd);
     return (*libc_close)(fd);
 }
         
 FAULT_INJECT_API int  closedir(DIR *dirp)
 {
     int ret;
-    FILE *log_fd;
-    char tmp_file[256];
-
+#ifdef HAVE_TRACE
+    struct fi_trace_record *trace_rec;
+    uint64_t trace_seq;
+#endif
 
-    if (faultinject_caller_interesting()) {
+    FI_STATS_INC(FI_FUNC_CLOSEDIR, intercepted);
+    if (faultinject_fd_interesting(dirfd(dirp)) &&
+        faultinject_caller_interesting(FI_FUNC_CLOSEDIR)) {
+            ret = faultinject_fail_operation(FI_FUNC_CLOSEDIR);
         #ifdef HAVE_TRACE
-            if (faultinject_trace_operation()) {
-                /* Log the operation */
-                (void)snprintf(tmp_file, 256,
-                    "%s/fi_pid_%d_closedir.log", g_library_trace_tmpdir,
-                    g_trace_pid);
-                log_fd = (*libc_fopen)(tmp_file, "a");
-                if (log_fd != NULL) {
-                    fprintf(log_fd, "Intercepted call to: closedir(");
-                    
-        fprintf(log_fd, "dirp:DIR *, ");
-                    fprintf(log_fd, ");\n");
-                    (*libc_fclose)(log_fd);
-                }
+            /* Log the operation, once it has been counted */
+            if ((trace_rec = faultinject_trace_begin(
+                FI_FUNC_CLOSEDIR, &trace_seq)) != NULL) {
+                trace_rec->args[0] = (uint64_t)(uintptr_t)dirp;
+                faultinject_trace_commit(trace_rec, trace_seq);
             }
-        #else
-            log_fd = NULL; log_fd = log_fd;
         #endif
-            if ((ret = faultinject_fail_operation()) != 0) {
+            if (ret != 0) {
                 errno = ret;
                 return (-1);
             }
     }
+    faultinject_fd_closed(dirfd(dirp));
     return (*libc_closedir)(dirp);
 }
         
 FAULT_INJECT_API int  fclose(FILE *fp)
 {
     int ret;
-    FILE *log_fd;
-    char tmp_file[256];
-
+#ifdef HAVE_TRACE
+    struct fi_trace_record *trace_rec;
+    uint64_t trace_seq;
+#endif
 
-    if (faultinject_caller_interesting()) {
+    FI_STATS_INC(FI_FUNC_FCLOSE, intercepted);
+    if (faultinject_fd_interesting(fileno(fp)) &&
+        faultinject_caller_interesting(FI_FUNC_FCLOSE)) {
+            ret = faultinject_fail_operation(FI_FUNC_FCLOSE);
         #ifdef HAVE_TRACE
-            if (faultinject_trace_operation()) {
-                /* Log the operation */
-                (void)snprintf(tmp_file, 256,
-                    "%s/fi_pid_%d_fclose.log", g_library_trace_tmpdir,
-                    g_trace_pid);
-                log_fd = (*libc_fopen)(tmp_file, "a");
-                if (log_fd != NULL) {
-                    fprintf(log_fd, "Intercepted call to: fclose(");
-                    
-        fprintf(log_fd, "fp:FILE *, ");
-                    fprintf(log_fd, ");\n");
-                    (*libc_fclose)(log_fd);
-                }
+            /* Log the operation, once it has been counted */
+            if ((trace_rec = faultinject_trace_begin(
+                FI_FUNC_FCLOSE, &trace_seq)) != NULL) {
+                trace_rec->args[0] = (uint64_t)(uintptr_t)fp;
+                faultinject_trace_commit(trace_rec, trace_seq);
             }
-        #else
-            log_fd = NULL; log_fd = log_fd;
         #endif
-            if ((ret = faultinject_fail_operation()) != 0) {
+            if (ret != 0) {
                 errno = ret;
                 return (-1);
             }
     }
+    faultinject_fd_closed(fileno(fp));
     return (*libc_fclose)(fp);
 }
         
 FAULT_INJECT_API int  fsync(int fd)
 {
     int ret;
-    FILE *log_fd;
-    char tmp_file[256];
-
+#ifdef HAVE_TRACE
+    struct fi_trace_record *trace_rec;
+    uint64_t trace_seq;
+#endif
 
-    if (faultinject_caller_interesting()) {
+    FI_STATS_INC(FI_FUNC_FSYNC, intercepted);
+    if (faultinject_fd_interesting(fd) &&
+        faultinject_caller_interesting(FI_FUNC_FSYNC)) {
+            ret = faultinject_fail_operation(FI_FUNC_FSYNC);
         #ifdef HAVE_TRACE
-            if (faultinject_trace_operation()) {
-                /* Log the operation */
-                (void)snprintf(tmp_file, 256,
-                    "%s/fi_pid_%d_fsync.log", g_library_trace_tmpdir,
-                    g_trace_pid);
-                log_fd = (*libc_fopen)(tmp_file, "a");
-                if (log_fd != NULL) {
-                    fprintf(log_fd, "Intercepted call to: fsync(");
-                    
-        fprintf(log_fd, "fd:%d, ", fd);
-                    fprintf(log_fd, ");\n");
-                    (*libc_fclose)(log_fd);
-                }
+            /* Log the operation, once it has been counted */
+            if ((trace_rec = faultinject_trace_begin(
+                FI_FUNC_FSYNC, &trace_seq)) != NULL) {
+                trace_rec->args[0] = (uint64_t)fd;
+                faultinject_trace_commit(trace_rec, trace_seq);
             }
-        #else
-            log_fd = NULL; log_fd = log_fd;
         #endif
-            if ((ret = faultinject_fail_operation()) != 0) {
+            if (ret != 0) {
                 errno = ret;
                 return (-1);
             }
@@ -897,30 +2349,24 @@ FAULT_INJECT_API int  fsync(int fd)
 FAULT_INJECT_API int  fdatasync(int fd)
 {
     int ret;
-    FILE *log_fd;
-    char tmp_file[256];
-
+#ifdef HAVE_TRACE
+    struct fi_trace_record *trace_rec;
+    uint64_t trace_seq;
+#endif
 
-    if (faultinject_caller_interesting()) {
+    FI_STATS_INC(FI_FUNC_FDATASYNC, intercepted);
+    if (faultinject_fd_interesting(fd) &&
+        faultinject_caller_interesting(FI_FUNC_FDATASYNC)) {
+            ret = faultinject_fail_operation(FI_FUNC_FDATASYNC);
         #ifdef HAVE_TRACE
-            if (faultinject_trace_operation()) {
-                /* Log the operation */
-                (void)snprintf(tmp_file, 256,
-                    "%s/fi_pid_%d_fdatasync.log", g_library_trace_tmpdir,
-                    g_trace_pid);
-                log_fd = (*libc_fopen)(tmp_file, "a");
-                if (log_fd != NULL) {
-                    fprintf(log_fd, "Intercepted call to: fdatasync(");
-                    
-        fprintf(log_fd, "fd:%d, ", fd);
-                    fprintf(log_fd, ");\n");
-                    (*libc_fclose)(log_fd);
-                }
+            /* Log the operation, once it has been counted */
+            if ((trace_rec = faultinject_trace_begin(
+                FI_FUNC_FDATASYNC, &trace_seq)) != NULL) {
+                trace_rec->args[0] = (uint64_t)fd;
+                faultinject_trace_commit(trace_rec, trace_seq);
             }
-        #else
-            log_fd = NULL; log_fd = log_fd;
         #endif
-            if ((ret = faultinject_fail_operation()) != 0) {
+            if (ret != 0) {
                 errno = ret;
                 return (-1);
             }
@@ -931,66 +2377,60 @@ FAULT_INJECT_API int  fdatasync(int fd)
 FAULT_INJECT_API FILE * fopen(const char *path, const char *mode)
 {
     int ret;
-    FILE *log_fd;
-    char tmp_file[256];
-
+    FILE * result;
+#ifdef HAVE_TRACE
+    struct fi_trace_record *trace_rec;
+    uint64_t trace_seq;
+#endif
 
-    if (faultinject_caller_interesting()) {
+    FI_STATS_INC(FI_FUNC_FOPEN, intercepted);
+    if (faultinject_path_interesting(path) &&
+        faultinject_caller_interesting(FI_FUNC_FOPEN)) {
+            ret = faultinject_fail_operation(FI_FUNC_FOPEN);
         #ifdef HAVE_TRACE
-            if (faultinject_trace_operation()) {
-                /* Log the operation */
-                (void)snprintf(tmp_file, 256,
-                    "%s/fi_pid_%d_fopen.log", g_library_trace_tmpdir,
-                    g_trace_pid);
-                log_fd = (*libc_fopen)(tmp_file, "a");
-                if (log_fd != NULL) {
-                    fprintf(log_fd, "Intercepted call to: fopen(");
-                    
-        fprintf(log_fd, "path:%s, ", path);
-        fprintf(log_fd, "mode:%s, ", mode);
-                    fprintf(log_fd, ");\n");
-                    (*libc_fclose)(log_fd);
-                }
+            /* Log the operation, once it has been counted */
+            if ((trace_rec = faultinject_trace_begin(
+                FI_FUNC_FOPEN, &trace_seq)) != NULL) {
+                faultinject_trace_string(trace_rec, 0, path);
+                trace_rec->args[0] = (uint64_t)(uintptr_t)path;
+                faultinject_trace_string(trace_rec, 1, mode);
+                trace_rec->args[1] = (uint64_t)(uintptr_t)mode;
+                faultinject_trace_commit(trace_rec, trace_seq);
             }
-        #else
-            log_fd = NULL; log_fd = log_fd;
         #endif
-            if ((ret = faultinject_fail_operation()) != 0) {
+            if (ret != 0) {
                 errno = ret;
                 return (NULL);
             }
     }
-    return (*libc_fopen)(path, mode);
+    result = (*libc_fopen)(path, mode);
+    faultinject_fd_opened(result == NULL ? -1 : fileno(result), path);
+    return (result);
 }
         
 FAULT_INJECT_API int  truncate(const char *path, off_t length)
 {
     int ret;
-    FILE *log_fd;
-    char tmp_file[256];
-
+#ifdef HAVE_TRACE
+    struct fi_trace_record *trace_rec;
+    uint64_t trace_seq;
+#endif
 
-    if (faultinject_caller_interesting()) {
+    FI_STATS_INC(FI_FUNC_TRUNCATE, intercepted);
+    if (faultinject_path_interesting(path) &&
+        faultinject_caller_interesting(FI_FUNC_TRUNCATE)) {
+            ret = faultinject_fail_operation(FI_FUNC_TRUNCATE);
         #ifdef HAVE_TRACE
-            if (faultinject_trace_operation()) {
-                /* Log the operation */
-                (void)snprintf(tmp_file, 256,
-                    "%s/fi_pid_%d_truncate.log", g_library_trace_tmpdir,
-                    g_trace_pid);
-                log_fd = (*libc_fopen)(tmp_file, "a");
-                if (log_fd != NULL) {
-                    fprintf(log_fd, "Intercepted call to: truncate(");
-                    
-        fprintf(log_fd, "path:%s, ", path);
-        fprintf(log_fd, "length:off_t, ");
-                    fprintf(log_fd, ");\n");
-                    (*libc_fclose)(log_fd);
-                }
+            /* Log the operation, once it has been counted */
+            if ((trace_rec = faultinject_trace_begin(
+                FI_FUNC_TRUNCATE, &trace_seq)) != NULL) {
+                faultinject_trace_string(trace_rec, 0, path);
+                trace_rec->args[0] = (uint64_t)(uintptr_t)path;
+                trace_rec->args[1] = (uint64_t)length;
+                faultinject_trace_commit(trace_rec, trace_seq);
             }
-        #else
-            log_fd = NULL; log_fd = log_fd;
         #endif
-            if ((ret = faultinject_fail_operation()) != 0) {
+            if (ret != 0) {
                 errno = ret;
                 return (-1);
             }
@@ -1001,31 +2441,25 @@ FAULT_INJECT_API int  truncate(const char *path, off_t length)
 FAULT_INJECT_API int  ftruncate(int fd, off_t length)
 {
     int ret;
-    FILE *log_fd;
-    char tmp_file[256];
-
+#ifdef HAVE_TRACE
+    struct fi_trace_record *trace_rec;
+    uint64_t trace_seq;
+#endif
 
-    if (faultinject_caller_interesting()) {
+    FI_STATS_INC(FI_FUNC_FTRUNCATE, intercepted);
+    if (faultinject_fd_interesting(fd) &&
+        faultinject_caller_interesting(FI_FUNC_FTRUNCATE)) {
+            ret = faultinject_fail_operation(FI_FUNC_FTRUNCATE);
         #ifdef HAVE_TRACE
-            if (faultinject_trace_operation()) {
-                /* Log the operation */
-                (void)snprintf(tmp_file, 256,
-                    "%s/fi_pid_%d_ftruncate.log", g_library_trace_tmpdir,
-                    g_trace_pid);
-                log_fd = (*libc_fopen)(tmp_file, "a");
-                if (log_fd != NULL) {
-                    fprintf(log_fd, "Intercepted call to: ftruncate(");
-                    
-        fprintf(log_fd, "fd:%d, ", fd);
-        fprintf(log_fd, "length:off_t, ");
-                    fprintf(log_fd, ");\n");
-                    (*libc_fclose)(log_fd);
-                }
+            /* Log the operation, once it has been counted */
+            if ((trace_rec = faultinject_trace_begin(
+                FI_FUNC_FTRUNCATE, &trace_seq)) != NULL) {
+                trace_rec->args[0] = (uint64_t)fd;
+                trace_rec->args[1] = (uint64_t)length;
+                faultinject_trace_commit(trace_rec, trace_seq);
             }
-        #else
-            log_fd = NULL; log_fd = log_fd;
         #endif
-            if ((ret = faultinject_fail_operation()) != 0) {
+            if (ret != 0) {
                 errno = ret;
                 return (-1);
             }
@@ -1036,35 +2470,29 @@ FAULT_INJECT_API int  ftruncate(int fd, off_t length)
 FAULT_INJECT_API void * mmap(void *addr, size_t length, int prot, int flags, int fd, off_t offset)
 {
     int ret;
-    FILE *log_fd;
-    char tmp_file[256];
-
+#ifdef HAVE_TRACE
+    struct fi_trace_record *trace_rec;
+    uint64_t trace_seq;
+#endif
 
-    if (faultinject_caller_interesting()) {
+    FI_STATS_INC(FI_FUNC_MMAP, intercepted);
+    if (faultinject_fd_interesting(fd) &&
+        faultinject_caller_interesting(FI_FUNC_MMAP)) {
+            ret = faultinject_fail_operation(FI_FUNC_MMAP);
         #ifdef HAVE_TRACE
-            if (faultinject_trace_operation()) {
-                /* Log the operation */
-                (void)snprintf(tmp_file, 256,
-                    "%s/fi_pid_%d_mmap.log", g_library_trace_tmpdir,
-                    g_trace_pid);
-                log_fd = (*libc_fopen)(tmp_file, "a");
-                if (log_fd != NULL) {
-                    fprintf(log_fd, "Intercepted call to: mmap(");
-                    
-        fprintf(log_fd, "addr:void *, ");
-        fprintf(log_fd, "length:size_t, ");
-        fprintf(log_fd, "prot:%d, ", prot);
-        fprintf(log_fd, "flags:%d, ", flags);
-        fprintf(log_fd, "fd:%d, ", fd);
-        fprintf(log_fd, "offset:off_t, ");
-                    fprintf(log_fd, ");\n");
-                    (*libc_fclose)(log_fd);
-                }
+            /* Log the operation, once it has been counted */
+            if ((trace_rec = faultinject_trace_begin(
+                FI_FUNC_MMAP, &trace_seq)) != NULL) {
+                trace_rec->args[0] = (uint64_t)(uintptr_t)addr;
+                trace_rec->args[1] = (uint64_t)length;
+                trace_rec->args[2] = (uint64_t)prot;
+                trace_rec->args[3] = (uint64_t)flags;
+                trace_rec->args[4] = (uint64_t)fd;
+                trace_rec->args[5] = (uint64_t)offset;
+                faultinject_trace_commit(trace_rec, trace_seq);
             }
-        #else
-            log_fd = NULL; log_fd = log_fd;
         #endif
-            if ((ret = faultinject_fail_operation()) != 0) {
+            if (ret != 0) {
                 errno = ret;
                 return ((void *)-1);
             }
@@ -1075,31 +2503,25 @@ FAULT_INJECT_API void * mmap(void *addr, size_t length, int prot, int flags, int
 FAULT_INJECT_API int  munmap(void *addr, size_t length)
 {
     int ret;
-    FILE *log_fd;
-    char tmp_file[256];
-
+#ifdef HAVE_TRACE
+    struct fi_trace_record *trace_rec;
+    uint64_t trace_seq;
+#endif
 
-    if (faultinject_caller_interesting()) {
+    FI_STATS_INC(FI_FUNC_MUNMAP, intercepted);
+    if (faultinject_path_interesting(NULL) &&
+        faultinject_caller_interesting(FI_FUNC_MUNMAP)) {
+            ret = faultinject_fail_operation(FI_FUNC_MUNMAP);
         #ifdef HAVE_TRACE
-            if (faultinject_trace_operation()) {
-                /* Log the operation */
-                (void)snprintf(tmp_file, 256,
-                    "%s/fi_pid_%d_munmap.log", g_library_trace_tmpdir,
-                    g_trace_pid);
-                log_fd = (*libc_fopen)(tmp_file, "a");
-                if (log_fd != NULL) {
-                    fprintf(log_fd, "Intercepted call to: munmap(");
-                    
-        fprintf(log_fd, "addr:void *, ");
-        fprintf(log_fd, "length:size_t, ");
-                    fprintf(log_fd, ");\n");
-                    (*libc_fclose)(log_fd);
-                }
+            /* Log the operation, once it has been counted */
+            if ((trace_rec = faultinject_trace_begin(
+                FI_FUNC_MUNMAP, &trace_seq)) != NULL) {
+                trace_rec->args[0] = (uint64_t)(uintptr_t)addr;
+                trace_rec->args[1] = (uint64_t)length;
+                faultinject_trace_commit(trace_rec, trace_seq);
             }
-        #else
-            log_fd = NULL; log_fd = log_fd;
         #endif
-            if ((ret = faultinject_fail_operation()) != 0) {
+            if (ret != 0) {
                 errno = ret;
                 return (-1);
             }
@@ -1110,9 +2532,11 @@ FAULT_INJECT_API int  munmap(void *addr, size_t length)
 FAULT_INJECT_API int  open(const char *pathname, int oflag,...)
 {
     int ret;
-    FILE *log_fd;
-    char tmp_file[256];
-
+    int result;
+#ifdef HAVE_TRACE
+    struct fi_trace_record *trace_rec;
+    uint64_t trace_seq;
+#endif
 
     va_list ap;
     mode_t mode;
@@ -1134,41 +2558,38 @@ FAULT_INJECT_API int  open(const char *pathname, int oflag,...)
         return (-1);
     }
 
-    if (faultinject_caller_interesting()) {
+    FI_STATS_INC(FI_FUNC_OPEN, intercepted);
+    if (faultinject_path_interesting(pathname) &&
+        faultinject_caller_interesting(FI_FUNC_OPEN)) {
+            ret = faultinject_fail_operation(FI_FUNC_OPEN);
         #ifdef HAVE_TRACE
-            if (faultinject_trace_operation()) {
-                /* Log the operation */
-                (void)snprintf(tmp_file, 256,
-                    "%s/fi_pid_%d_open.log", g_library_trace_tmpdir,
-                    g_trace_pid);
-                log_fd = (*libc_fopen)(tmp_file, "a");
-                if (log_fd != NULL) {
-                    fprintf(log_fd, "Intercepted call to: open(");
-                    
-        fprintf(log_fd, "pathname:%s, ", pathname);
-        fprintf(log_fd, "oflag:%d, ", oflag);
-        fprintf(log_fd, "...");
-                    fprintf(log_fd, ");\n");
-                    (*libc_fclose)(log_fd);
-                }
+            /* Log the operation, once it has been counted */
+            if ((trace_rec = faultinject_trace_begin(
+                FI_FUNC_OPEN, &trace_seq)) != NULL) {
+                faultinject_trace_string(trace_rec, 0, pathname);
+                trace_rec->args[0] = (uint64_t)(uintptr_t)pathname;
+                trace_rec->args[1] = (uint64_t)oflag;
+                faultinject_trace_commit(trace_rec, trace_seq);
             }
-        #else
-            log_fd = NULL; log_fd = log_fd;
         #endif
-            if ((ret = faultinject_fail_operation()) != 0) {
+            if (ret != 0) {
                 errno = ret;
                 return (-1);
             }
     }
-    return (*libc_open)(pathname, oflag, mode);
+    result = (*libc_open)(pathname, oflag, mode);
+    faultinject_fd_opened(result, pathname);
+    return (result);
 }
         
 FAULT_INJECT_API int  open64(const char *pathname, int oflag,...)
 {
     int ret;
-    FILE *log_fd;
-    char tmp_file[256];
-
+    int result;
+#ifdef HAVE_TRACE
+    struct fi_trace_record *trace_rec;
+    uint64_t trace_seq;
+#endif
 
     va_list ap;
     mode_t mode;
@@ -1190,99 +2611,86 @@ FAULT_INJECT_API int  open64(const char *pathname, int oflag,...)
         return (-1);
     }
 
-    if (faultinject_caller_interesting()) {
+    FI_STATS_INC(FI_FUNC_OPEN64, intercepted);
+    if (faultinject_path_interesting(pathname) &&
+        faultinject_caller_interesting(FI_FUNC_OPEN64)) {
+            ret = faultinject_fail_operation(FI_FUNC_OPEN64);
         #ifdef HAVE_TRACE
-            if (faultinject_trace_operation()) {
-                /* Log the operation */
-                (void)snprintf(tmp_file, 256,
-                    "%s/fi_pid_%d_open64.log", g_library_trace_tmpdir,
-                    g_trace_pid);
-                log_fd = (*libc_fopen)(tmp_file, "a");
-                if (log_fd != NULL) {
-                    fprintf(log_fd, "Intercepted call to: open64(");
-                    
-        fprintf(log_fd, "pathname:%s, ", pathname);
-        fprintf(log_fd, "oflag:%d, ", oflag);
-        fprintf(log_fd, "...");
-                    fprintf(log_fd, ");\n");
-                    (*libc_fclose)(log_fd);
-                }
+            /* Log the operation, once it has been counted */
+            if ((trace_rec = faultinject_trace_begin(
+                FI_FUNC_OPEN64, &trace_seq)) != NULL) {
+                faultinject_trace_string(trace_rec, 0, pathname);
+                trace_rec->args[0] = (uint64_t)(uintptr_t)pathname;
+                trace_rec->args[1] = (uint64_t)oflag;
+                faultinject_trace_commit(trace_rec, trace_seq);
             }
-        #else
-            log_fd = NULL; log_fd = log_fd;
         #endif
-            if ((ret = faultinject_fail_operation()) != 0) {
+            if (ret != 0) {
                 errno = ret;
                 return (-1);
             }
     }
-    return (*libc_open64)(pathname, oflag, mode);
+    result = (*libc_open64)(pathname, oflag, mode);
+    faultinject_fd_opened(result, pathname);
+    return (result);
 }
         
 FAULT_INJECT_API DIR * opendir(const char *name)
 {
     int ret;
-    FILE *log_fd;
-    char tmp_file[256];
-
+    DIR * result;
+#ifdef HAVE_TRACE
+    struct fi_trace_record *trace_rec;
+    uint64_t trace_seq;
+#endif
 
-    if (faultinject_caller_interesting()) {
+    FI_STATS_INC(FI_FUNC_OPENDIR, intercepted);
+    if (faultinject_path_interesting(name) &&
+        faultinject_caller_interesting(FI_FUNC_OPENDIR)) {
+            ret = faultinject_fail_operation(FI_FUNC_OPENDIR);
         #ifdef HAVE_TRACE
-            if (faultinject_trace_operation()) {
-                /* Log the operation */
-                (void)snprintf(tmp_file, 256,
-                    "%s/fi_pid_%d_opendir.log", g_library_trace_tmpdir,
-                    g_trace_pid);
-                log_fd = (*libc_fopen)(tmp_file, "a");
-                if (log_fd != NULL) {
-                    fprintf(log_fd, "Intercepted call to: opendir(");
-                    
-        fprintf(log_fd, "name:%s, ", name);
-                    fprintf(log_fd, ");\n");
-                    (*libc_fclose)(log_fd);
-                }
+            /* Log the operation, once it has been counted */
+            if ((trace_rec = faultinject_trace_begin(
+                FI_FUNC_OPENDIR, &trace_seq)) != NULL) {
+                faultinject_trace_string(trace_rec, 0, name);
+                trace_rec->args[0] = (uint64_t)(uintptr_t)name;
+                faultinject_trace_commit(trace_rec, trace_seq);
             }
-        #else
-            log_fd = NULL; log_fd = log_fd;
         #endif
-            if ((ret = faultinject_fail_operation()) != 0) {
+            if (ret != 0) {
                 errno = ret;
                 return (NULL);
             }
     }
-    return (*libc_opendir)(name);
+    result = (*libc_opendir)(name);
+    faultinject_fd_opened(result == NULL ? -1 : dirfd(result), name);
+    return (result);
 }
         
 FAULT_INJECT_API ssize_t  pread(int fd, void *buf, size_t count, off_t offset)
 {
     int ret;
-    FILE *log_fd;
-    char tmp_file[256];
-
+#ifdef HAVE_TRACE
+    struct fi_trace_record *trace_rec;
+    uint64_t trace_seq;
+#endif
 
-    if (faultinject_caller_interesting()) {
+    FI_STATS_INC(FI_FUNC_PREAD, intercepted);
+    if (faultinject_fd_interesting(fd) &&
+        faultinject_caller_interesting(FI_FUNC_PREAD)) {
+            ret = faultinject_fail_operation(FI_FUNC_PREAD);
         #ifdef HAVE_TRACE
-            if (faultinject_trace_operation()) {
-                /* Log the operation */
-                (void)snprintf(tmp_file, 256,
-                    "%s/fi_pid_%d_pread.log", g_library_trace_tmpdir,
-                    g_trace_pid);
-                log_fd = (*libc_fopen)(tmp_file, "a");
-                if (log_fd != NULL) {
-                    fprintf(log_fd, "Intercepted call to: pread(");
-                    
-        fprintf(log_fd, "fd:%d, ", fd);
-        fprintf(log_fd, "buf:void *, ");
-        fprintf(log_fd, "count:size_t, ");
-        fprintf(log_fd, "offset:off_t, ");
-                    fprintf(log_fd, ");\n");
-                    (*libc_fclose)(log_fd);
-                }
+            /* Log the operation, once it has been counted */
+            if ((trace_rec = faultinject_trace_begin(
+                FI_FUNC_PREAD, &trace_seq)) != NULL) {
+                trace_rec->args[0] = (uint64_t)fd;
+                trace_rec->args[1] = (uint64_t)(uintptr_t)buf;
+                trace_rec->args[2] = (uint64_t)count;
+                trace_rec->args[3] = (uint64_t)offset;
+                faultinject_trace_commit(trace_rec, trace_seq);
             }
-        #else
-            log_fd = NULL; log_fd = log_fd;
         #endif
-            if ((ret = faultinject_fail_operation()) != 0) {
+            if (ret != 0) {
                 errno = ret;
                 return (-1);
             }
@@ -1293,33 +2701,27 @@ FAULT_INJECT_API ssize_t  pread(int fd, void *buf, size_t count, off_t offset)
 FAULT_INJECT_API ssize_t  pwrite(int fd, const void *buf, size_t count, off_t offset)
 {
     int ret;
-    FILE *log_fd;
-    char tmp_file[256];
-
+#ifdef HAVE_TRACE
+    struct fi_trace_record *trace_rec;
+    uint64_t trace_seq;
+#endif
 
-    if (faultinject_caller_interesting()) {
+    FI_STATS_INC(FI_FUNC_PWRITE, intercepted);
+    if (faultinject_fd_interesting(fd) &&
+        faultinject_caller_interesting(FI_FUNC_PWRITE)) {
+            ret = faultinject_fail_operation(FI_FUNC_PWRITE);
         #ifdef HAVE_TRACE
-            if (faultinject_trace_operation()) {
-                /* Log the operation */
-                (void)snprintf(tmp_file, 256,
-                    "%s/fi_pid_%d_pwrite.log", g_library_trace_tmpdir,
-                    g_trace_pid);
-                log_fd = (*libc_fopen)(tmp_file, "a");
-                if (log_fd != NULL) {
-                    fprintf(log_fd, "Intercepted call to: pwrite(");
-                    
-        fprintf(log_fd, "fd:%d, ", fd);
-        fprintf(log_fd, "buf:const void *, ");
-        fprintf(log_fd, "count:size_t, ");
-        fprintf(log_fd, "offset:off_t, ");
-                    fprintf(log_fd, ");\n");
-                    (*libc_fclose)(log_fd);
-                }
+            /* Log the operation, once it has been counted */
+            if ((trace_rec = faultinject_trace_begin(
+                FI_FUNC_PWRITE, &trace_seq)) != NULL) {
+                trace_rec->args[0] = (uint64_t)fd;
+                trace_rec->args[1] = (uint64_t)(uintptr_t)buf;
+                trace_rec->args[2] = (uint64_t)count;
+                trace_rec->args[3] = (uint64_t)offset;
+                faultinject_trace_commit(trace_rec, trace_seq);
             }
-        #else
-            log_fd = NULL; log_fd = log_fd;
         #endif
-            if ((ret = faultinject_fail_operation()) != 0) {
+            if (ret != 0) {
                 errno = ret;
                 return (-1);
             }
@@ -1330,30 +2732,24 @@ FAULT_INJECT_API ssize_t  pwrite(int fd, const void *buf, size_t count, off_t of
 FAULT_INJECT_API struct dirent * readdir(DIR *dirp)
 {
     int ret;
-    FILE *log_fd;
-    char tmp_file[256];
-
+#ifdef HAVE_TRACE
+    struct fi_trace_record *trace_rec;
+    uint64_t trace_seq;
+#endif
 
-    if (faultinject_caller_interesting()) {
+    FI_STATS_INC(FI_FUNC_READDIR, intercepted);
+    if (faultinject_fd_interesting(dirfd(dirp)) &&
+        faultinject_caller_interesting(FI_FUNC_READDIR)) {
+            ret = faultinject_fail_operation(FI_FUNC_READDIR);
         #ifdef HAVE_TRACE
-            if (faultinject_trace_operation()) {
-                /* Log the operation */
-                (void)snprintf(tmp_file, 256,
-                    "%s/fi_pid_%d_readdir.log", g_library_trace_tmpdir,
-                    g_trace_pid);
-                log_fd = (*libc_fopen)(tmp_file, "a");
-                if (log_fd != NULL) {
-                    fprintf(log_fd, "Intercepted call to: readdir(");
-                    
-        fprintf(log_fd, "dirp:DIR *, ");
-                    fprintf(log_fd, ");\n");
-                    (*libc_fclose)(log_fd);
-                }
+            /* Log the operation, once it has been counted */
+            if ((trace_rec = faultinject_trace_begin(
+                FI_FUNC_READDIR, &trace_seq)) != NULL) {
+                trace_rec->args[0] = (uint64_t)(uintptr_t)dirp;
+                faultinject_trace_commit(trace_rec, trace_seq);
             }
-        #else
-            log_fd = NULL; log_fd = log_fd;
         #endif
-            if ((ret = faultinject_fail_operation()) != 0) {
+            if (ret != 0) {
                 errno = ret;
                 return (NULL);
             }
@@ -1364,30 +2760,25 @@ FAULT_INJECT_API struct dirent * readdir(DIR *dirp)
 FAULT_INJECT_API int  remove(const char *pathname)
 {
     int ret;
-    FILE *log_fd;
-    char tmp_file[256];
-
+#ifdef HAVE_TRACE
+    struct fi_trace_record *trace_rec;
+    uint64_t trace_seq;
+#endif
 
-    if (faultinject_caller_interesting()) {
+    FI_STATS_INC(FI_FUNC_REMOVE, intercepted);
+    if (faultinject_path_interesting(pathname) &&
+        faultinject_caller_interesting(FI_FUNC_REMOVE)) {
+            ret = faultinject_fail_operation(FI_FUNC_REMOVE);
         #ifdef HAVE_TRACE
-            if (faultinject_trace_operation()) {
-                /* Log the operation */
-                (void)snprintf(tmp_file, 256,
-                    "%s/fi_pid_%d_remove.log", g_library_trace_tmpdir,
-                    g_trace_pid);
-                log_fd = (*libc_fopen)(tmp_file, "a");
-                if (log_fd != NULL) {
-                    fprintf(log_fd, "Intercepted call to: remove(");
-                    
-        fprintf(log_fd, "pathname:%s, ", pathname);
-                    fprintf(log_fd, ");\n");
-                    (*libc_fclose)(log_fd);
-                }
+            /* Log the operation, once it has been counted */
+            if ((trace_rec = faultinject_trace_begin(
+                FI_FUNC_REMOVE, &trace_seq)) != NULL) {
+                faultinject_trace_string(trace_rec, 0, pathname);
+                trace_rec->args[0] = (uint64_t)(uintptr_t)pathname;
+                faultinject_trace_commit(trace_rec, trace_seq);
             }
-        #else
-            log_fd = NULL; log_fd = log_fd;
         #endif
-            if ((ret = faultinject_fail_operation()) != 0) {
+            if (ret != 0) {
                 errno = ret;
                 return (-1);
             }
@@ -1398,31 +2789,28 @@ FAULT_INJECT_API int  remove(const char *pathname)
 FAULT_INJECT_API int  rename(const char *oldpath, const char *newpath)
 {
     int ret;
-    FILE *log_fd;
-    char tmp_file[256];
-
+#ifdef HAVE_TRACE
+    struct fi_trace_record *trace_rec;
+    uint64_t trace_seq;
+#endif
 
-    if (faultinject_caller_interesting()) {
+    FI_STATS_INC(FI_FUNC_RENAME, intercepted);
+    if ((faultinject_path_interesting(oldpath) ||
+        faultinject_path_interesting(newpath)) &&
+        faultinject_caller_interesting(FI_FUNC_RENAME)) {
+            ret = faultinject_fail_operation(FI_FUNC_RENAME);
         #ifdef HAVE_TRACE
-            if (faultinject_trace_operation()) {
-                /* Log the operation */
-                (void)snprintf(tmp_file, 256,
-                    "%s/fi_pid_%d_rename.log", g_library_trace_tmpdir,
-                    g_trace_pid);
-                log_fd = (*libc_fopen)(tmp_file, "a");
-                if (log_fd != NULL) {
-                    fprintf(log_fd, "Intercepted call to: rename(");
-                    
-        fprintf(log_fd, "oldpath:%s, ", oldpath);
-        fprintf(log_fd, "newpath:%s, ", newpath);
-                    fprintf(log_fd, ");\n");
-                    (*libc_fclose)(log_fd);
-                }
+            /* Log the operation, once it has been counted */
+            if ((trace_rec = faultinject_trace_begin(
+                FI_FUNC_RENAME, &trace_seq)) != NULL) {
+                faultinject_trace_string(trace_rec, 0, oldpath);
+                trace_rec->args[0] = (uint64_t)(uintptr_t)oldpath;
+                faultinject_trace_string(trace_rec, 1, newpath);
+                trace_rec->args[1] = (uint64_t)(uintptr_t)newpath;
+                faultinject_trace_commit(trace_rec, trace_seq);
             }
-        #else
-            log_fd = NULL; log_fd = log_fd;
         #endif
-            if ((ret = faultinject_fail_operation()) != 0) {
+            if (ret != 0) {
                 errno = ret;
                 return (-1);
             }
@@ -0,0 +1,467 @@
+/*
+ * Interposition overhead benchmark for the fault injection library.
+ *
+ * Each function in dist/function.list is called in batches from a tight
+ * loop until a time budget runs out, and the number of calls made and the
+ * nanoseconds spent in them are printed one function per line:
+ *
+ *	<function> <calls> <nsec>
+ *
+ * Whatever a call needs (a descriptor, a mapping, a file to remove) is set
+ * up outside the timed part of the batch. test/run_bench.py runs this with
+ * and without the library preloaded and in different configurations.
+ *
+ * The benchmark functions are all named fi_bench_<function>, so a library
+ * name filter of "fi_bench_" matches every call made here.
+ */
+#ifndef _GNU_SOURCE
+#define	_GNU_SOURCE
+#endif
+
+#include <sys/types.h>
+#include <sys/mman.h>
+#include <sys/stat.h>
+
+#include <dirent.h>
+#include <errno.h>
+#include <fcntl.h>
+#include <stdint.h>
+#include <stdio.h>
+#include <stdlib.h>
+#include <string.h>
+#include <time.h>
+#include <unistd.h>
+
+#define	FI_BENCH_BATCH		64
+#define	FI_BENCH_DIR_ENTRIES	8
+
+struct fi_bench {
+	char dir[256];			/* Scratch directory */
+	char file[512];			/* Scratch file, one page long */
+	char subdir[512];		/* Directory holding a few entries */
+	int fd;				/* Descriptor open on file */
+};
+
+struct fi_bench_func {
+	const char *name;
+	uint64_t (*run)(struct fi_bench *);
+};
+
+static void
+fi_bench_die(const char *msg)
+{
+	fprintf(stderr, "fi_bench: %s: %s\n", msg, strerror(errno));
+	exit(1);
+}
+
+static uint64_t
+fi_bench_now(void)
+{
+	struct timespec ts;
+
+	(void)clock_gettime(CLOCK_MONOTONIC, &ts);
+	return ((uint64_t)ts.tv_sec * 1000000000 + (uint64_t)ts.tv_nsec);
+}
+
+/*
+ * Each of the following makes FI_BENCH_BATCH calls and returns the time
+ * they took.
+ */
+static uint64_t
+fi_bench_close(struct fi_bench *b)
+{
+	uint64_t start;
+	int fds[FI_BENCH_BATCH], i;
+
+	for (i = 0; i < FI_BENCH_BATCH; i++)
+		if ((fds[i] = dup(b->fd)) < 0)
+			fi_bench_die("dup");
+	start = fi_bench_now();
+	for (i = 0; i < FI_BENCH_BATCH; i++)
+		(void)close(fds[i]);
+	return (fi_bench_now() - start);
+}
+
+static uint64_t
+fi_bench_closedir(struct fi_bench *b)
+{
+	DIR *dirs[FI_BENCH_BATCH];
+	uint64_t start;
+	int i;
+
+	for (i = 0; i < FI_BENCH_BATCH; i++)
+		if ((dirs[i] = opendir(b->subdir)) == NULL)
+			fi_bench_die("opendir");
+	start = fi_bench_now();
+	for (i = 0; i < FI_BENCH_BATCH; i++)
+		(void)closedir(dirs[i]);
+	return (fi_bench_now() - start);
+}
+
+static uint64_t
+fi_bench_fclose(struct fi_bench *b)
+{
+	FILE *fps[FI_BENCH_BATCH];
+	uint64_t start;
+	int i;
+
+	for (i = 0; i < FI_BENCH_BATCH; i++)
+		if ((fps[i] = fopen(b->file, "r")) == NULL)
+			fi_bench_die("fopen");
+	start = fi_bench_now();
+	for (i = 0; i < FI_BENCH_BATCH; i++)
+		(void)fclose(fps[i]);
+	return (fi_bench_now() - start);
+}
+
+static uint64_t
+fi_bench_fsync(struct fi_bench *b)
+{
+	uint64_t start;
+	int i;
+
+	start = fi_bench_now();
+	for (i = 0; i < FI_BENCH_BATCH; i++)
+		(void)fsync(b->fd);
+	return (fi_bench_now() - start);
+}
+
+static uint64_t
+fi_bench_fdatasync(struct fi_bench *b)
+{
+	uint64_t start;
+	int i;
+
+	start = fi_bench_now();
+	for (i = 0; i < FI_BENCH_BATCH; i++)
+		(void)fdatasync(b->fd);
+	return (fi_bench_now() - start);
+}
+
+static uint64_t
+fi_bench_fopen(struct fi_bench *b)
+{
+	FILE *fps[FI_BENCH_BATCH];
+	uint64_t start, stop;
+	int i;
+
+	start = fi_bench_now();
+	for (i = 0; i < FI_BENCH_BATCH; i++)
+		fps[i] = fopen(b->file, "r");
+	stop = fi_bench_now();
+	for (i = 0; i < FI_BENCH_BATCH; i++)
+		if (fps[i] != NULL)
+			(void)fclose(fps[i]);
+	return (stop - start);
+}
+
+static uint64_t
+fi_bench_truncate(struct fi_bench *b)
+{
+	uint64_t start;
+	int i;
+
+	start = fi_bench_now();
+	for (i = 0; i < FI_BENCH_BATCH; i++)
+		(void)truncate(b->file, 4096);
+	return (fi_bench_now() - start);
+}
+
+static uint64_t
+fi_bench_ftruncate(struct fi_bench *b)
+{
+	uint64_t start;
+	int i;
+
+	start = fi_bench_now();
+	for (i = 0; i < FI_BENCH_BATCH; i++)
+		(void)ftruncate(b->fd, 4096);
+	return (fi_bench_now() - start);
+}
+
+static uint64_t
+fi_bench_mmap(struct fi_bench *b)
+{
+	uint64_t start, stop;
+	void *maps[FI_BENCH_BATCH];
+	int i;
+
+	start = fi_bench_now();
+	for (i = 0; i < FI_BENCH_BATCH; i++)
+		maps[i] = mmap(NULL, 4096, PROT_READ, MAP_SHARED, b->fd, 0);
+	stop = fi_bench_now();
+	for (i = 0; i < FI_BENCH_BATCH; i++)
+		if (maps[i] != MAP_FAILED)
+			(void)munmap(maps[i], 4096);
+	return (stop - start);
+}
+
+static uint64_t
+fi_bench_munmap(struct fi_bench *b)
+{
+	uint64_t start;
+	void *maps[FI_BENCH_BATCH];
+	int i;
+
+	for (i = 0; i < FI_BENCH_BATCH; i++)
+		if ((maps[i] = mmap(NULL,
+		    4096, PROT_READ, MAP_SHARED, b->fd, 0)) == MAP_FAILED)
+			fi_bench_die("mmap");
+	start = fi_bench_now();
+	for (i = 0; i < FI_BENCH_BATCH; i++)
+		(void)munmap(maps[i], 4096);
+	return (fi_bench_now() - start);
+}
+
+static uint64_t
+fi_bench_open(struct fi_bench *b)
+{
+	uint64_t start, stop;
+	int fds[FI_BENCH_BATCH], i;
+
+	start = fi_bench_now();
+	for (i = 0; i < FI_BENCH_BATCH; i++)
+		fds[i] = open(b->file, O_RDONLY);
+	stop = fi_bench_now();
+	for (i = 0; i < FI_BENCH_BATCH; i++)
+		if (fds[i] >= 0)
+			(void)close(fds[i]);
+	return (stop - start);
+}
+
+static uint64_t
+fi_bench_open64(struct fi_bench *b)
+{
+	uint64_t start, stop;
+	int fds[FI_BENCH_BATCH], i;
+
+	start = fi_bench_now();
+	for (i = 0; i < FI_BENCH_BATCH; i++)
+		fds[i] = open64(b->file, O_RDONLY);
+	stop = fi_bench_now();
+	for (i = 0; i < FI_BENCH_BATCH; i++)
+		if (fds[i] >= 0)
+			(void)close(fds[i]);
+	return (stop - start);
+}
+
+static uint64_t
+fi_bench_opendir(struct fi_bench *b)
+{
+	DIR *dirs[FI_BENCH_BATCH];
+	uint64_t start, stop;
+	int i;
+
+	start = fi_bench_now();
+	for (i = 0; i < FI_BENCH_BATCH; i++)
+		dirs[i] = opendir(b->subdir);
+	stop = fi_bench_now();
+	for (i = 0; i < FI_BENCH_BATCH; i++)
+		if (dirs[i] != NULL)
+			(void)closedir(dirs[i]);
+	return (stop - start);
+}
+
+static uint64_t
+fi_bench_pread(struct fi_bench *b)
+{
+	uint64_t start;
+	char buf[64];
+	int i;
+
+	start = fi_bench_now();
+	for (i = 0; i < FI_BENCH_BATCH; i++)
+		(void)pread(b->fd, buf, sizeof(buf), 0);
+	return (fi_bench_now() - start);
+}
+
+static uint64_t
+fi_bench_pwrite(struct fi_bench *b)
+{
+	uint64_t start;
+	char buf[64];
+	int i;
+
+	memset(buf, 'a', sizeof(buf));
+	start = fi_bench_now();
+	for (i = 0; i < FI_BENCH_BATCH; i++)
+		(void)pwrite(b->fd, buf, sizeof(buf), 0);
+	return (fi_bench_now() - start);
+}
+
+static uint64_t
+fi_bench_readdir(struct fi_bench *b)
+{
+	DIR *dir;
+	uint64_t start, total;
+	int i;
+
+	if ((dir = opendir(b->subdir)) == NULL)
+		fi_bench_die("opendir");
+	total = 0;
+	for (i = 0; i < FI_BENCH_BATCH;) {
+		/* Start over when the end is reached, outside the clock. */
+		rewinddir(dir);
+		start = fi_bench_now();
+		while (i < FI_BENCH_BATCH) {
+			++i;
+			if (readdir(dir) == NULL)
+				break;
+		}
+		total += fi_bench_now() - start;
+	}
+	(void)closedir(dir);
+	return (total);
+}
+
+static uint64_t
+fi_bench_remove(struct fi_bench *b)
+{
+	char path[FI_BENCH_BATCH][600];
+	uint64_t start;
+	int fd, i;
+
+	for (i = 0; i < FI_BENCH_BATCH; i++) {
+		(void)snprintf(path[i], sizeof(path[i]), "%s/remove.%d", b->dir, i);
+		if ((fd = open(path[i], O_CREAT | O_WRONLY, 0644)) < 0)
+			fi_bench_die("open");
+		(void)close(fd);
+	}
+	start = fi_bench_now();
+	for (i = 0; i < FI_BENCH_BATCH; i++)
+		(void)remove(path[i]);
+	return (fi_bench_now() - start);
+}
+
+static uint64_t
+fi_bench_rename(struct fi_bench *b)
+{
+	char to[600];
+	uint64_t start;
+	int i;
+
+	(void)snprintf(to, sizeof(to), "%s/rename.tmp", b->dir);
+	start = fi_bench_now();
+	for (i = 0; i < FI_BENCH_BATCH; i += 2) {
+		(void)rename(b->file, to);
+		(void)rename(to, b->file);
+	}
+	return (fi_bench_now() - start);
+}
+
+static const struct fi_bench_func fi_bench_funcs[] = {
+	{ "close", fi_bench_close },
+	{ "closedir", fi_bench_closedir },
+	{ "fclose", fi_bench_fclose },
+	{ "fsync", fi_bench_fsync },
+	{ "fdatasync", fi_bench_fdatasync },
+	{ "fopen", fi_bench_fopen },
+	{ "truncate", fi_bench_truncate },
+	{ "ftruncate", fi_bench_ftruncate },
+	{ "mmap", fi_bench_mmap },
+	{ "munmap", fi_bench_munmap },
+	{ "open", fi_bench_open },
+	{ "open64", fi_bench_open64 },
+	{ "opendir", fi_bench_opendir },
+	{ "pread", fi_bench_pread },
+	{ "pwrite", fi_bench_pwrite },
+	{ "readdir", fi_bench_readdir },
+	{ "remove", fi_bench_remove },
+	{ "rename", fi_bench_rename },
+	{ NULL, NULL }
+};
+
+/*
+ * Create the scratch file and directory the benchmarks work on.
+ */
+static void
+fi_bench_setup(struct fi_bench *b, const char *dir)
+{
+	char path[600], page[4096];
+	int fd, i;
+
+	(void)snprintf(b->dir, sizeof(b->dir), "%s", dir);
+	(void)snprintf(b->file, sizeof(b->file), "%s/bench.dat", dir);
+	(void)snprintf(b->subdir, sizeof(b->subdir), "%s/bench.dir", dir);
+
+	if ((b->fd = open(b->file, O_CREAT | O_RDWR | O_TRUNC, 0644)) < 0)
+		fi_bench_die("open");
+	memset(page, 'a', sizeof(page));
+	if (pwrite(b->fd, page, sizeof(page), 0) != (ssize_t)sizeof(page))
+		fi_bench_die("pwrite");
+	if (mkdir(b->subdir, 0755) != 0 && errno != EEXIST)
+		fi_bench_die("mkdir");
+	for (i = 0; i < FI_BENCH_DIR_ENTRIES; i++) {
+		(void)snprintf(path, sizeof(path), "%s/entry.%d", b->subdir, i);
+		if ((fd = open(path, O_CREAT | O_WRONLY, 0644)) < 0)
+			fi_bench_die("open");
+		(void)close(fd);
+	}
+}
+
+static void
+usage(void)
+{
+	fprintf(stderr,
+	    "usage: fi_bench [-l] [-d dir] [-t msec] [function ...]\n"
+	    "\t-d dir\tscratch directory (default /tmp)\n"
+	    "\t-l\tlist the functions benchmarked\n"
+	    "\t-t msec\ttime to spend on each function (default 200)\n");
+	exit(2);
+}
+
+int
+main(int argc, char **argv)
+{
+	struct fi_bench b;
+	const struct fi_bench_func *f;
+	uint64_t budget, calls, elapsed, start;
+	const char *dir;
+	int ch, i;
+
+	dir = "/tmp";
+	budget = 200;
+	while ((ch = getopt(argc, argv, "d:lt:")) != -1)
+		switch (ch) {
+		case 'd':
+			dir = optarg;
+			break;
+		case 'l':
+			for (f = fi_bench_funcs; f->name != NULL; f++)
+				printf("%s\n", f->name);
+			return (0);
+		case 't':
+			budget = strtoull(optarg, NULL, 10);
+			break;
+		default:
+			usage();
+		}
+	argc -= optind;
+	argv += optind;
+
+	/* Budget in nanoseconds */
+	budget *= 1000000;
+	fi_bench_setup(&b, dir);
+
+	for (f = fi_bench_funcs; f->name != NULL; f++) {
+		if (argc > 0) {
+			for (i = 0; i < argc; i++)
+				if (strcmp(argv[i], f->name) == 0)
+					break;
+			if (i == argc)
+				continue;
+		}
+		calls = elapsed = 0;
+		start = fi_bench_now();
+		do {
+			elapsed += f->run(&b);
+			calls += FI_BENCH_BATCH;
+		} while (fi_bench_now() - start < budget);
+		printf("%s %llu %llu\n", f->name,
+		    (unsigned long long)calls, (unsigned long long)elapsed);
+		(void)fflush(stdout);
+	}
+
+	(void)close(b.fd);
+	return (0);
+}
@@ -0,0 +1,224 @@
+#!/usr/bin/env python
+#
+# Public Domain 2014-2017 MongoDB, Inc.
+# Public Domain 2008-2014 WiredTiger, Inc.
+#
+# This is free and unencumbered software released into the public domain.
+#
+# Anyone is free to copy, modify, publish, use, compile, sell, or
+# distribute this software, either in source code form or as a compiled
+# binary, for any purpose, commercial or non-commercial, and by any
+# means.
+#
+# In jurisdictions that recognize copyright laws, the author or authors
+# of this software dedicate any and all copyright interest in the
+# software to the public domain. We make this dedication for the benefit
+# of the public at large and to the detriment of our heirs and
+# successors. We intend this dedication to be an overt act of
+# relinquishment in perpetuity of all present and future rights to this
+# software under copyright law.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS BE LIABLE FOR ANY CLAIM, DAMAGES OR
+# OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE,
+# ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+#
+# fi_control.py
+#      Arm, disarm and reset a running process through the control block
+#      named by FAULTINJECT_CONTROL_SHM, and read back its counters. Can be
+#      imported by a driver, or run from the command line.
+#
+
+import mmap, os, struct, sys
+
+from fi_trace_decode import get_functions
+
+SHM_DIR = '/dev/shm'
+
+# These must match struct fi_control in src/faultinject.c.in.
+CONTROL_MAGIC = 0x4c52544e4f434946
+CONTROL_VERSION = 1
+CONTROL_HEADER_FORMAT = '=QIIQQQQQQQQ'
+CONTROL_FUNC_FORMAT = '=QQ'
+MODE_FAIL = 0
+MODE_COUNT = 1
+MODES = {'fail': MODE_FAIL, 'count': MODE_COUNT}
+MODE_NAMES = dict((v, k) for k, v in MODES.items())
+
+# Offsets of the header fields, each 8 bytes apart after magic and the two
+# 32 bit fields.
+OFF_PID = 16
+OFF_ENABLED = 24
+OFF_MODE = 32
+OFF_OP_COUNT = 40
+OFF_MAX_OP_COUNT = 48
+OFF_FAIL_WINDOW = 56
+OFF_FAIL_EVERY = 64
+OFF_FAILED = 72
+
+def usage():
+    print('Usage:\n\
+  $ python test/fi_control.py name command [ args ]\n\
+\n\
+Commands:\n\
+  create                            create the control block disarmed, before starting the process\n\
+  arm N [ window [ every ] ]        fail from the N+1th interesting operation on, counting from now\n\
+  arm-function fn N                 fail fn from its N+1th interesting call on, counting from now\n\
+  disarm                            let every operation through uncounted\n\
+  enable                            count operations again without changing the fail counts\n\
+  reset                             zero the counters\n\
+  mode fail|count                   inject failures, or only count operations\n\
+  stats                             print the settings and counters\n\
+  remove                            remove the control block\n\
+')
+
+class Control(object):
+    def __init__(self, name, create=False):
+        self.functions = [f[0] for f in get_functions()]
+        self.path = SHM_DIR + '/' + name.lstrip('/')
+        self.size = struct.calcsize(CONTROL_HEADER_FORMAT) + \
+            len(self.functions) * struct.calcsize(CONTROL_FUNC_FORMAT)
+        flags = os.O_RDWR
+        if create:
+            flags |= os.O_CREAT | os.O_EXCL
+        fd = os.open(self.path, flags, 0o600)
+        try:
+            if create:
+                os.ftruncate(fd, self.size)
+            elif os.fstat(fd).st_size != self.size:
+                raise ValueError(self.path + ': not a control block for ' +
+                    str(len(self.functions)) + ' functions')
+            self.map = mmap.mmap(fd, self.size)
+        finally:
+            os.close(fd)
+        if create:
+            # Created disarmed, the process arriving later uses it as is.
+            struct.pack_into(CONTROL_HEADER_FORMAT, self.map, 0, 0,
+                CONTROL_VERSION, len(self.functions), 0, 0, MODE_FAIL, 0, 0,
+                0, 1, 0)
+            self.set(0, CONTROL_MAGIC)
+        magic, version, func_count = struct.unpack_from('=QII', self.map, 0)
+        if magic != CONTROL_MAGIC or version != CONTROL_VERSION or \
+            func_count != len(self.functions):
+            raise ValueError(self.path + ': not a version ' +
+                str(CONTROL_VERSION) + ' control block')
+
+    def set(self, offset, value):
+        # Aligned 8 byte stores, which the library reads with relaxed loads.
+        struct.pack_into('=Q', self.map, offset, value)
+
+    def func_offset(self, function):
+        return struct.calcsize(CONTROL_HEADER_FORMAT) + \
+            self.functions.index(function) * struct.calcsize(CONTROL_FUNC_FORMAT)
+
+    def arm(self, fail_count, fail_window=0, fail_every=1):
+        # Disarm while changing the settings, so an operation that starts
+        # after the enabled flag is cleared isn't counted until all of them
+        # are in place. One that already found the process armed isn't held
+        # back and may be counted or failed under a mix of the old and new
+        # settings.
+        self.set(OFF_ENABLED, 0)
+        self.set(OFF_FAIL_WINDOW, fail_window)
+        self.set(OFF_FAIL_EVERY, fail_every)
+        self.set(OFF_MAX_OP_COUNT, fail_count)
+        self.set(OFF_OP_COUNT, 0)
+        self.set(OFF_MODE, MODE_FAIL)
+        self.set(OFF_ENABLED, 1)
+
+    def arm_function(self, function, fail_count):
+        # Disarmed meanwhile, with the same guarantee as arm().
+        offset = self.func_offset(function)
+        self.set(OFF_ENABLED, 0)
+        self.set(offset, fail_count)
+        self.set(offset + 8, 0)
+        self.set(OFF_MODE, MODE_FAIL)
+        self.set(OFF_ENABLED, 1)
+
+    def disarm(self):
+        self.set(OFF_ENABLED, 0)
+
+    def enable(self):
+        self.set(OFF_ENABLED, 1)
+
+    def reset(self):
+        self.set(OFF_OP_COUNT, 0)
+        self.set(OFF_FAILED, 0)
+        for function in self.functions:
+            self.set(self.func_offset(function) + 8, 0)
+
+    def set_mode(self, mode):
+        self.set(OFF_MODE, MODES[mode])
+
+    def stats(self):
+        fields = struct.unpack_from(CONTROL_HEADER_FORMAT, self.map, 0)
+        stats = {
+            'pid': fields[3],
+            'enabled': fields[4],
+            'mode': MODE_NAMES.get(fields[5], str(fields[5])),
+            'op_count': fields[6],
+            'max_op_count': fields[7],
+            'fail_window': fields[8],
+            'fail_every': fields[9],
+            'failed': fields[10],
+            'functions': {}}
+        for function in self.functions:
+            max_op_count, op_count = struct.unpack_from(CONTROL_FUNC_FORMAT,
+                self.map, self.func_offset(function))
+            stats['functions'][function] = {
+                'max_op_count': max_op_count, 'op_count': op_count}
+        return stats
+
+    def close(self):
+        self.map.close()
+
+    def remove(self):
+        self.close()
+        os.unlink(self.path)
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    if len(args) < 2:
+        usage()
+        sys.exit(2)
+    name = args.pop(0)
+    command = args.pop(0)
+
+    try:
+        control = Control(name, create=(command == 'create'))
+        if command == 'create':
+            pass
+        elif command == 'arm' and len(args) >= 1:
+            control.arm(*[int(a) for a in args[:3]])
+        elif command == 'arm-function' and len(args) == 2:
+            control.arm_function(args[0], int(args[1]))
+        elif command == 'disarm':
+            control.disarm()
+        elif command == 'enable':
+            control.enable()
+        elif command == 'reset':
+            control.reset()
+        elif command == 'mode' and len(args) == 1 and args[0] in MODES:
+            control.set_mode(args[0])
+        elif command == 'stats':
+            stats = control.stats()
+            for key in sorted(stats):
+                if key != 'functions':
+                    print(key + '=' + str(stats[key]))
+            for function in control.functions:
+                counts = stats['functions'][function]
+                if counts['op_count'] != 0 or counts['max_op_count'] != 0:
+                    print(function + '=' + str(counts['op_count']) + '/' +
+                        str(counts['max_op_count']))
+        elif command == 'remove':
+            control.remove()
+            sys.exit(0)
+        else:
+            usage()
+            sys.exit(2)
+        control.close()
+    except (OSError, ValueError) as e:
+        print(str(e))
+        sys.exit(1)
@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+#
+# Public Domain 2014-2017 MongoDB, Inc.
+# Public Domain 2008-2014 WiredTiger, Inc.
+#
+# This is free and unencumbered software released into the public domain.
+#
+# Anyone is free to copy, modify, publish, use, compile, sell, or
+# distribute this software, either in source code form or as a compiled
+# binary, for any purpose, commercial or non-commercial, and by any
+# means.
+#
+# In jurisdictions that recognize copyright laws, the author or authors
+# of this software dedicate any and all copyright interest in the
+# software to the public domain. We make this dedication for the benefit
+# of the public at large and to the detriment of our heirs and
+# successors. We intend this dedication to be an overt act of
+# relinquishment in perpetuity of all present and future rights to this
+# software under copyright law.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS BE LIABLE FOR ANY CLAIM, DAMAGES OR
+# OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE,
+# ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+#
+# fi_stats.py
+#      Print the interception statistics (fi_pid_<pid>_stats.bin) a process
+#      running with FAULTINJECT_STATS keeps, once or sampled every few
+#      seconds while it runs.
+#
+
+import struct, sys, time
+
+from fi_trace_decode import get_functions
+
+# These must match struct fi_stats and struct fi_func_stats in
+# src/faultinject.c.in.
+STATS_MAGIC = 0x0053544154534946
+STATS_VERSION = 1
+STATS_HEADER_FORMAT = '=QIIQ'
+STATS_FUNC_FORMAT = '=QQQQQQ'
+STATS_FIELDS = ['intercepted', 'interesting', 'failed', 'recursed', 'checks', 'check_ns']
+
+def usage():
+    print('Usage:\n\
+  $ python test/fi_stats.py [ options ] stats-file\n\
+\n\
+Options:\n\
+  -i N | --interval N       sample every N seconds until interrupted, printing the change since the last sample\n\
+')
+
+def read_stats(filename):
+    # Return the pid and a {function: {field: count}} map of a stats file.
+    functions = [f[0] for f in get_functions()]
+    with open(filename, 'rb') as f:
+        data = f.read()
+    header_size = struct.calcsize(STATS_HEADER_FORMAT)
+    func_size = struct.calcsize(STATS_FUNC_FORMAT)
+    if len(data) < header_size:
+        raise ValueError(filename + ': too short to be a stats file')
+    magic, version, func_count, pid = struct.unpack_from(STATS_HEADER_FORMAT, data, 0)
+    if magic != STATS_MAGIC or version != STATS_VERSION or \
+        func_count != len(functions) or len(data) < header_size + func_count * func_size:
+        raise ValueError(filename + ': not a version ' + str(STATS_VERSION) +
+            ' stats file')
+    stats = {}
+    for i, function in enumerate(functions):
+        stats[function] = dict(zip(STATS_FIELDS,
+            struct.unpack_from(STATS_FUNC_FORMAT, data, header_size + i * func_size)))
+    return pid, stats
+
+def total_stats(stats):
+    # Sum the counters of every function.
+    return dict((field, sum(s[field] for s in stats.values())) for field in STATS_FIELDS)
+
+def format_stats(stats, elapsed=None):
+    # One line per function that was called, busiest first, then the
+    # totals. With elapsed, the counts are per second.
+    lines = ['%-12s %12s %12s %10s %10s %12s' % ('function', 'intercepted',
+        'interesting', 'failed', 'recursed', 'check usec')]
+    rows = [(f, s) for f, s in stats.items() if s['intercepted'] != 0]
+    rows.sort(key=lambda row: -row[1]['intercepted'])
+    rows.append(('total', total_stats(stats)))
+    for function, s in rows:
+        # Average time per caller check
+        check_usec = s['check_ns'] / 1000.0 / s['checks'] if s['checks'] != 0 else 0.0
+        counts = [s[field] for field in STATS_FIELDS[:4]]
+        if elapsed != None:
+            counts = [int(c / elapsed) for c in counts]
+        lines.append('%-12s %12d %12d %10d %10d %12.2f' % tuple([function] + counts +
+            [check_usec]))
+    return '\n'.join(lines)
+
+def summarize_stats(stats):
+    # One line with the totals and the busiest functions.
+    totals = total_stats(stats)
+    check_usec = totals['check_ns'] / 1000.0 / totals['checks'] if totals['checks'] != 0 else 0.0
+    busiest = sorted([(s['intercepted'], f) for f, s in stats.items() if s['intercepted'] != 0],
+        reverse=True)[:3]
+    return '%d intercepted, %d interesting, %d failed, %d recursed, %.2f usec per check' % \
+        (totals['intercepted'], totals['interesting'], totals['failed'], totals['recursed'],
+        check_usec) + ''.join(', ' + f + ': ' + str(n) for n, f in busiest)
+
+def diff_stats(new, old):
+    return dict((f, dict((field, new[f][field] - old[f][field]) for field in STATS_FIELDS))
+        for f in new)
+
+if __name__ == '__main__':
+    interval = None
+    stats_file = None
+
+    args = sys.argv[1:]
+    while len(args) > 0:
+        arg = args.pop(0)
+
+        # Command line options
+        if arg[0] == '-':
+            option = arg[1:]
+            if option == '-interval' or option == 'i':
+                interval = float(args.pop(0))
+                continue
+            print('unknown arg: ' + arg)
+            usage()
+            sys.exit(2)
+        stats_file = arg
+
+    if stats_file == None:
+        usage()
+        sys.exit(2)
+
+    pid, stats = read_stats(stats_file)
+    print('pid ' + str(pid) + ':')
+    print(format_stats(stats))
+    try:
+        while interval != None:
+            time.sleep(interval)
+            pid, new_stats = read_stats(stats_file)
+            print('\nper second over the last ' + str(interval) + 's:')
+            print(format_stats(diff_stats(new_stats, stats), interval))
+            stats = new_stats
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,203 @@
+#!/usr/bin/env python
+#
+# Public Domain 2014-2017 MongoDB, Inc.
+# Public Domain 2008-2014 WiredTiger, Inc.
+#
+# This is free and unencumbered software released into the public domain.
+#
+# Anyone is free to copy, modify, publish, use, compile, sell, or
+# distribute this software, either in source code form or as a compiled
+# binary, for any purpose, commercial or non-commercial, and by any
+# means.
+#
+# In jurisdictions that recognize copyright laws, the author or authors
+# of this software dedicate any and all copyright interest in the
+# software to the public domain. We make this dedication for the benefit
+# of the public at large and to the detriment of our heirs and
+# successors. We intend this dedication to be an overt act of
+# relinquishment in perpetuity of all present and future rights to this
+# software under copyright law.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS BE LIABLE FOR ANY CLAIM, DAMAGES OR
+# OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE,
+# ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+#
+# fi_trace_decode.py
+#      Decode the binary trace ring buffer (fi_pid_<pid>_trace.bin) written
+#      by a trace enabled fault injection library into the human readable
+#      "Intercepted call to: ..." log format.
+#
+
+import os, re, struct, sys
+
+FUNCTION_LIST_PATH = os.path.dirname(os.path.abspath(__file__)) + '/../dist/function.list'
+
+# These must match struct fi_trace_header and struct fi_trace_record in
+# src/faultinject.c.in.
+TRACE_MAGIC = 0x4543415254494646
+TRACE_VERSION = 1
+TRACE_HEADER_FORMAT = '=QIIQQII24x'
+TRACE_RECORD_FORMAT = '=QIIQQQ6QQ80s80s'
+TRACE_MAX_STRINGS = 2
+
+func_def_parts_re = re.compile(r'(?P<ret_type>.+)\((?P<name>\w+)\)\((?P<args>[^)]*)')
+
+def usage():
+    print('Usage:\n\
+  $ python test/fi_trace_decode.py [ options ] trace-file ...\n\
+\n\
+Options:\n\
+  -o dir | --outdir dir     write one fi_pid_<pid>_<function>.log file per function into dir\n\
+  -r | --raw                prefix each call with its sequence, thread, timestamp, op count and stack hash\n\
+')
+
+def get_functions():
+    # Return a (name, params) list in function.list order, the index is the
+    # function id used in the trace records.
+    functions = []
+    with open(FUNCTION_LIST_PATH, 'r') as f:
+        for line in f:
+            if line.startswith('#'):
+                continue
+            match = func_def_parts_re.match(line)
+            if not match:
+                continue
+            params = []
+            for param in match.group('args').split(','):
+                # Make sure there is a single space between words
+                params.append(' '.join(param.strip().replace('*', ' * ').split()))
+            functions.append((match.group('name'), params))
+    return functions
+
+def to_signed(value, bits):
+    value &= (1 << bits) - 1
+    if value >= 1 << (bits - 1):
+        value -= 1 << bits
+    return value
+
+def format_call(function, record):
+    # Mirror the way the library used to print each argument: strings and
+    # integers by value, everything else by type.
+    name, params = function
+    line = 'Intercepted call to: ' + name + '('
+    arg_slot = 0
+    str_slot = 0
+    for param in params:
+        if param == '...':
+            line += '...'
+            continue
+        pname = param.split()[-1]
+        value = record['args'][arg_slot]
+        arg_slot += 1
+        if param.startswith('char *') or param.startswith('const char *'):
+            # The pointer is recorded too, zero for NULL
+            if str_slot < TRACE_MAX_STRINGS and value != 0:
+                line += pname + ':' + record['str'][str_slot] + ', '
+            else:
+                line += pname + ':' + '(null)' + ', '
+            str_slot += 1
+        elif param.startswith('int'):
+            line += pname + ':' + str(to_signed(value, 32)) + ', '
+        elif param.startswith('long'):
+            line += pname + ':' + str(to_signed(value, 64)) + ', '
+        else:
+            line += pname + ':' + param.rsplit(' ', 1)[0] + ', '
+    return line + ');'
+
+def read_trace(filename):
+    # Return the pid and the committed records of a trace, oldest first.
+    with open(filename, 'rb') as f:
+        data = f.read()
+    header_size = struct.calcsize(TRACE_HEADER_FORMAT)
+    record_size = struct.calcsize(TRACE_RECORD_FORMAT)
+    if len(data) < header_size:
+        raise ValueError(filename + ': too short to be a trace file')
+    magic, version, hdr_record_size, capacity, head, pid, func_count = \
+        struct.unpack_from(TRACE_HEADER_FORMAT, data, 0)
+    if magic != TRACE_MAGIC or version != TRACE_VERSION or \
+        hdr_record_size != record_size:
+        raise ValueError(filename + ': not a version ' + str(TRACE_VERSION) +
+            ' trace file')
+
+    records = []
+    for slot in range(min(capacity, head)):
+        fields = struct.unpack_from(TRACE_RECORD_FORMAT, data,
+            header_size + slot * record_size)
+        seq = fields[0]
+        # Skip slots being written when the trace was read.
+        if seq == 0 or (seq - 1) % capacity != slot:
+            continue
+        records.append({
+            'seq': seq,
+            'func_id': fields[1],
+            'tid': fields[2],
+            'timestamp': fields[3],
+            'op_count': fields[4],
+            'stack_hash': fields[5],
+            'args': fields[6:12],
+            'str': [s.split(b'\0', 1)[0].decode('utf-8', 'replace')
+                for s in fields[13:15]]})
+    records.sort(key=lambda r: r['seq'])
+    if head > capacity:
+        sys.stderr.write(filename + ': ' + str(head - capacity) +
+            ' oldest records were overwritten\n')
+    return pid, records
+
+def decode(filename, functions, outdir, raw):
+    pid, records = read_trace(filename)
+    logs = {}
+    for record in records:
+        if record['func_id'] >= len(functions):
+            sys.stderr.write(filename + ': unknown function id ' +
+                str(record['func_id']) + '\n')
+            continue
+        function = functions[record['func_id']]
+        line = format_call(function, record)
+        if raw:
+            line = '[seq: %d, tid: %d, ts: %d, op_count: %d, stack: %016x] ' % (
+                record['seq'], record['tid'], record['timestamp'],
+                record['op_count'], record['stack_hash']) + line
+        if outdir == None:
+            sys.stdout.write(line + '\n')
+            continue
+        if not function[0] in logs:
+            logs[function[0]] = open(outdir + '/fi_pid_' + str(pid) + '_' +
+                function[0] + '.log', 'a')
+        logs[function[0]].write(line + '\n')
+    for log in logs.values():
+        log.close()
+
+if __name__ == '__main__':
+    outdir = None
+    raw = False
+    trace_files = []
+
+    args = sys.argv[1:]
+    while len(args) > 0:
+        arg = args.pop(0)
+
+        # Command line options
+        if arg[0] == '-':
+            option = arg[1:]
+            if option == '-outdir' or option == 'o':
+                outdir = args.pop(0)
+                continue
+            if option == '-raw' or option == 'r':
+                raw = True
+                continue
+            print('unknown arg: ' + arg)
+            usage()
+            sys.exit(2)
+        trace_files.append(arg)
+
+    if len(trace_files) == 0:
+        usage()
+        sys.exit(2)
+
+    functions = get_functions()
+    for trace_file in trace_files:
+        decode(trace_file, functions, outdir, raw)
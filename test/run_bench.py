@@ -0,0 +1,229 @@
+#!/usr/bin/env python
+#
+# Public Domain 2014-2017 MongoDB, Inc.
+# Public Domain 2008-2014 WiredTiger, Inc.
+#
+# This is free and unencumbered software released into the public domain.
+#
+# Anyone is free to copy, modify, publish, use, compile, sell, or
+# distribute this software, either in source code form or as a compiled
+# binary, for any purpose, commercial or non-commercial, and by any
+# means.
+#
+# In jurisdictions that recognize copyright laws, the author or authors
+# of this software dedicate any and all copyright interest in the
+# software to the public domain. We make this dedication for the benefit
+# of the public at large and to the detriment of our heirs and
+# successors. We intend this dedication to be an overt act of
+# relinquishment in perpetuity of all present and future rights to this
+# software under copyright law.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS BE LIABLE FOR ANY CLAIM, DAMAGES OR
+# OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE,
+# ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+#
+# run_bench.py
+#      Measure the per call overhead of the fault injection library, by
+#      running the fi_bench microbenchmarks with and without the library
+#      preloaded and in each filter configuration, reported as JSON.
+#
+
+import json, os, shutil, sys, tempfile
+from subprocess import Popen, PIPE
+import fi_trace_decode
+
+CUR_DIR = os.getcwd()
+DEF_FI_LIB_PATH = os.path.dirname(os.path.abspath(__file__)) + '/../'
+DEF_BENCH_PATH = CUR_DIR + '/test/fi_bench'
+
+# Benchmark configurations: the environment each is run with, None for
+# running without the library. The benchmark functions are named
+# fi_bench_<function>, and nothing in them comes from libwiredtiger.
+CONFIGS = [
+    ('none', None),
+    ('preload', {}),
+    ('name-match', {'FAULTINJECT_LIBRARY_NAME': 'fi_bench_'}),
+    ('name-nomatch', {'FAULTINJECT_LIBRARY_NAME': '__wt'}),
+    ('name-match-nocache', {'FAULTINJECT_LIBRARY_NAME': 'fi_bench_',
+        'FAULTINJECT_CALLER_CACHE': '0'}),
+    ('name-nomatch-nocache', {'FAULTINJECT_LIBRARY_NAME': '__wt',
+        'FAULTINJECT_CALLER_CACHE': '0'}),
+    ('object-nomatch', {'FAULTINJECT_LIBRARY_OBJECT': 'libwiredtiger'}),
+    ('trace', {'FAULTINJECT_TRACE': '1'}),
+]
+
+def usage():
+    print('Usage:\n\
+  $ cd build_posix\n\
+  $ python FI_LIB/test/run_bench.py [ options ]\n\
+\n\
+Options:\n\
+  -b path | --bench path                        path to the fi_bench program (default test/fi_bench)\n\
+  -B file | --baseline file                     compare against the results of an earlier run\n\
+  -c name,.. | --configs name,..                configurations to run (default all: ' +
+      ','.join(name for name, env in CONFIGS) + ')\n\
+  -f name,.. | --functions name,..              functions to benchmark (default all)\n\
+  -l path | --filibpath path                    path to fault injection library\n\
+  -o file | --output file                       write the results to file instead of stdout\n\
+  -r N | --repeat N                             run each configuration N times and keep the fastest (default 3)\n\
+  -t N | --time N                               milliseconds to spend on each function per run (default 200)\n\
+  -T N | --threshold N                          percentage slowdown against the baseline to report (default 10)\n\
+')
+
+def run_bench(bench_path, env, functions, budget, scratch_dir):
+    # Run the benchmark once and return {function: (calls, nsec)}
+    proc = Popen([bench_path, '-d', scratch_dir, '-t', str(budget)] + functions,
+        stdout=PIPE, stderr=PIPE, env=env)
+    out, err = proc.communicate()
+    if proc.returncode != 0:
+        sys.stderr.write(err.decode('utf-8', 'replace'))
+        raise RuntimeError(bench_path + ' exited with ' + str(proc.returncode))
+    results = {}
+    for line in out.decode('utf-8').splitlines():
+        fields = line.split()
+        if len(fields) == 3:
+            results[fields[0]] = (int(fields[1]), int(fields[2]))
+    return results
+
+def bench_config(bench_path, fi_lib, config_env, functions, budget, repeat):
+    # Return {function: {calls, ns_per_call, calls_per_sec}}, keeping the
+    # fastest of repeat runs.
+    scratch_dir = tempfile.mkdtemp(prefix='fi_bench_')
+    try:
+        env = dict(os.environ)
+        env.pop('LD_PRELOAD', None)
+        if config_env != None:
+            env['LD_PRELOAD'] = fi_lib
+            env['FAULTINJECT_TMP_DIR'] = scratch_dir
+            env.update(config_env)
+        best = {}
+        for i in range(repeat):
+            for function, (calls, nsec) in run_bench(bench_path, env, functions,
+                budget, scratch_dir).items():
+                ns_per_call = float(nsec) / calls
+                if not function in best or ns_per_call < best[function]['ns_per_call']:
+                    best[function] = {'calls': calls, 'ns_per_call': ns_per_call,
+                        'calls_per_sec': 1e9 / ns_per_call if ns_per_call > 0 else 0}
+        if config_env != None and 'FAULTINJECT_TRACE' in config_env and \
+            not any(f.endswith('_trace.bin') for f in os.listdir(scratch_dir)):
+            sys.stderr.write('The library was built without --enable-trace, ' +
+                'the trace configuration measures no tracing\n')
+    finally:
+        shutil.rmtree(scratch_dir)
+    return best
+
+def compare(results, baseline, threshold):
+    # Print the configurations and functions slower than the baseline by
+    # more than threshold percent, return how many there are.
+    regressions = 0
+    for config in sorted(results):
+        for function in sorted(results[config]):
+            try:
+                base = baseline['results'][config][function]['ns_per_call']
+            except KeyError:
+                continue
+            cur = results[config][function]['ns_per_call']
+            change = (cur - base) * 100.0 / base if base > 0 else 0
+            if change > threshold:
+                sys.stderr.write('%-22s %-10s %10.1f ns -> %10.1f ns (+%.1f%%)\n' % (
+                    config, function, base, cur, change))
+                regressions += 1
+    return regressions
+
+if __name__ == '__main__':
+    bench_path = DEF_BENCH_PATH
+    baseline_file = None
+    config_names = [name for name, env in CONFIGS]
+    functions = []
+    fi_lib_path = DEF_FI_LIB_PATH
+    output_file = None
+    repeat = 3
+    budget = 200
+    threshold = 10.0
+
+    args = sys.argv[1:]
+    while len(args) > 0:
+        arg = args.pop(0)
+
+        # Command line options
+        if arg[0] == '-':
+            option = arg[1:]
+            if option == '-bench' or option == 'b':
+                bench_path = os.path.abspath(args.pop(0))
+                continue
+            if option == '-baseline' or option == 'B':
+                baseline_file = args.pop(0)
+                continue
+            if option == '-configs' or option == 'c':
+                config_names = args.pop(0).split(',')
+                continue
+            if option == '-functions' or option == 'f':
+                functions = args.pop(0).split(',')
+                continue
+            if option == '-filibpath' or option == 'l':
+                fi_lib_path = args.pop(0)
+                continue
+            if option == '-output' or option == 'o':
+                output_file = args.pop(0)
+                continue
+            if option == '-repeat' or option == 'r':
+                repeat = int(args.pop(0))
+                continue
+            if option == '-time' or option == 't':
+                budget = int(args.pop(0))
+                continue
+            if option == '-threshold' or option == 'T':
+                threshold = float(args.pop(0))
+                continue
+        print('unknown arg: ' + arg)
+        usage()
+        sys.exit(2)
+
+    configs = dict(CONFIGS)
+    for name in config_names:
+        if not name in configs:
+            print('unknown configuration: ' + name)
+            usage()
+            sys.exit(2)
+    fi_lib = os.path.abspath(fi_lib_path + '/.libs/libfaultinject.so')
+
+    # Every wrapped function should have a benchmark
+    proc = Popen([bench_path, '-l'], stdout=PIPE)
+    benchmarked = proc.communicate()[0].decode('utf-8').split()
+    for name, params in fi_trace_decode.get_functions():
+        if not name in benchmarked:
+            sys.stderr.write('No benchmark for ' + name + '\n')
+
+    results = {}
+    for name in config_names:
+        results[name] = bench_config(bench_path, fi_lib, configs[name],
+            functions, budget, repeat)
+
+    # Express the cost of the library as the time added to each call
+    if 'none' in results:
+        for name in results:
+            if name == 'none':
+                continue
+            for function, result in results[name].items():
+                if function in results['none']:
+                    result['overhead_ns'] = result['ns_per_call'] - \
+                        results['none'][function]['ns_per_call']
+
+    report = {'library': fi_lib, 'bench': bench_path, 'time_ms': budget,
+        'repeat': repeat, 'results': results}
+    output = json.dumps(report, indent=2, sort_keys=True)
+    if output_file == None:
+        print(output)
+    else:
+        with open(output_file, 'w') as f:
+            f.write(output + '\n')
+
+    if baseline_file != None:
+        with open(baseline_file, 'r') as f:
+            baseline = json.load(f)
+        if compare(results, baseline, threshold) > 0:
+            sys.exit(1)
@@ -30,14 +30,27 @@
 #      Command line fault injection test runner
 #
 
-import os, sys, shlex, threading, time, signal, multiprocessing
+import glob, hashlib, json, os, sys, shlex, shutil, socket, tempfile, threading, time, signal, multiprocessing
 from multiprocessing.dummy import Pool as ThreadPool
-from subprocess import Popen, PIPE
-from collections import namedtuple
+from subprocess import Popen, PIPE, STDOUT
+from collections import deque, namedtuple
+import fi_stats, fi_trace_decode
 
 DEF_FAULTINJECT_LIBRARY_NAME = '__wt'
 CUR_DIR = os.getcwd()
 PMP_PATH = os.path.dirname(os.path.abspath(__file__)) + '/pmp.sh'
+# The library dumps the stacks of all threads of a hung process on this
+# signal, pmp.sh is only used if it doesn't answer within BACKTRACE_WAIT
+# seconds.
+BACKTRACE_SIGNAL = signal.SIGUSR2
+BACKTRACE_SAMPLES = 3
+BACKTRACE_INTERVAL = 0.5
+BACKTRACE_WAIT = 5
+# Latency mode runs each command this many times with and without delays.
+LATENCY_RUNS = 3
+LATENCY_DISTS = ['fixed', 'uniform', 'exponential']
+# Fail counts to allow for in the timeout of a fork sweep of unknown length
+FORK_SWEEP_UNBOUNDED_FAIL_COUNTS = 1000
 DEF_FI_LIB_PATH = os.path.dirname(os.path.abspath(__file__)) + '/../'
 DEF_PYTHON_PATH = CUR_DIR + '/../lang/python:'
 DEF_PYTHON_PATH += CUR_DIR + '/lang/python:'
@@ -46,26 +59,46 @@ DEF_PYTHON_TESTSUITE_RUN_CMD = CUR_DIR + '/../test/suite/run.py'
 FI_TMP_DIR = CUR_DIR + '/FI_TEST/'
 WTTEST_DIR = CUR_DIR + '/WT_TEST/'
 CORRUPTION_TEST_PATH = os.path.dirname(os.path.abspath(__file__)) + '/corruption_test.sh'
+# The number of slowest testsets the report summary lists
+REPORT_TOP_TESTSETS = 10
 
 verbose = 0
+discard_output = False
 
 def usage():
     print 'Usage:\n\
   $ cd build_posix\n\
   $ python FI_LIB/test/run_fi.py [ options ] [ tests ]\n\
+  $ python FI_LIB/test/run_fi.py merge [ -C file ] [ -r file ] [ -v N ] shard-journal ..\n\
 \n\
 Options:\n\
   -c file | --config file                       use a config file for controlling tests\n\
+  -B | --backtraces                             have the library take the backtraces of hung processes instead of pmp\n\
   -C file | --configdump file                   dump the test config into the given file\n\
+  -d | --dryrun                                 count interesting operations in a first run, to bound and split fail count ranges\n\
   -x | --corruptiontest                         run fault-injection with corruption test\n\
   -b N | --failcountbeg N                       starting call count to inject faults after every Nth intercepted call\n\
   -e N | --failcountend N                       ending call count to inject faults after every Nth intercepted call\n\
+  -f N | --forksweep N                          cover the fail counts of each command in one run, forking up to N children at a time\n\
   -i N1, N2, .. | --failcountignore N1, N2, ..  list of call counts to NOT start injecting faults at\n\
+  -k N1, N2, .. | --failevery N1, N2, ..        only fail every Nth operation past the fail count, one testset per N\n\
+  -L fn:usec[:dist[:N]],.. | --latency ..       delay operations instead of failing them, and report the runtime change\n\
   -l path | --filibpath                         path to fault injection library\n\
+  -o name | --filibobject name                  only inject faults into calls made from the named shared object\n\
   -p | --proceedonfailure                       continue past first detected failure\n\
+  -P glob1:glob2.. | --pathfilter glob1:glob2.. only inject faults into operations on matching paths\n\
+  -q | --discardoutput                          discard the output of tested commands instead of saving it\n\
+  -r file | --journal file                      record results in file, and reuse the results it already has\n\
+  -R file | --report file                       write a line of JSON per command run to file, and summarize where the time went\n\
+  -s i/n | --shard i/n                          only run the ith of n even shares of the tests, see merge\n\
+  -S | --stats                                  have the library count intercepted, interesting and failed calls\n\
   -t N | --timeout N                            consider the application being tested hung after N seconds\n\
+  -u N | --uniquesites N                        run at most N fail counts injecting at the same call stack (implies -d)\n\
   -j N | --threads N                            run N tests simultaneously\n\
   -v N | --verbose N                            set verboseness to N (0<=N<=2, default=0)\n\
+  -w N1, N2, .. | --failwindow N1, N2, ..       stop failing after N failed operations (0 never stops), one testset per N\n\
+merge combines the journals of the shards of a sweep into one report, -C writes a config to rerun\n\
+each failure with, and -r writes a journal holding all their results.\n\
 '
 
 def exit_abnormal():
@@ -77,9 +110,14 @@ def dbg(level, msg):
 
 class Testsuite(object):
     def __init__(self, corruption_test, proceed_on_failure, fi_lib_name,
-        fi_ld_lib_path, fi_ld_load_loc, fi_python_path):
+        fi_ld_lib_path, fi_ld_load_loc, fi_python_path, fi_lib_object=None,
+        fi_path_filter=None, fi_lib_backtraces=False, fi_lib_stats=False):
 
         self.fi_lib_name = fi_lib_name
+        self.fi_lib_object = fi_lib_object
+        self.fi_path_filter = fi_path_filter
+        self.fi_lib_backtraces = fi_lib_backtraces
+        self.fi_lib_stats = fi_lib_stats
         self.fi_ld_lib_path = fi_ld_lib_path
         self.fi_ld_load_loc =  fi_ld_load_loc
         self.proceed_on_failure = proceed_on_failure
@@ -89,6 +127,13 @@ class Testsuite(object):
         self.test_env = self.generate_global_test_env()
         self.testset_list = []
         self.threads = 1
+        self.fork_sweep = 0
+        self.dry_run = False
+        self.unique_sites = 0
+        self.journal = None
+        self.latency_env = None
+        self.shard = None
+        self.report = None
         self.abort_tests = False
 
     def cleanup_pre(self):
@@ -123,6 +168,14 @@ class Testsuite(object):
         else:
             run_env['PYTHON_PATH'] += ':' + self.fi_python_path
         run_env['FAULTINJECT_LIBRARY_NAME'] = self.fi_lib_name
+        if self.fi_lib_backtraces:
+            run_env['FAULTINJECT_BACKTRACE_SIGNAL'] = str(int(BACKTRACE_SIGNAL))
+        if self.fi_lib_stats:
+            run_env['FAULTINJECT_STATS'] = '1'
+        if self.fi_lib_object != None:
+            run_env['FAULTINJECT_LIBRARY_OBJECT'] = self.fi_lib_object
+        if self.fi_path_filter != None:
+            run_env['FAULTINJECT_PATH_FILTER'] = self.fi_path_filter
         return run_env
 
     def set_testset_list(self, testset_list):
@@ -131,6 +184,35 @@ class Testsuite(object):
     def set_threads(self, threads):
         self.threads = threads
 
+    def set_fork_sweep(self, fork_sweep):
+        self.fork_sweep = fork_sweep
+
+    def set_dry_run(self, dry_run):
+        self.dry_run = dry_run
+
+    def set_unique_sites(self, unique_sites):
+        self.unique_sites = unique_sites
+
+    def set_journal(self, journal):
+        self.journal = journal
+
+    def set_latency_env(self, latency_env):
+        self.latency_env = latency_env
+
+    def set_shard(self, shard):
+        self.shard = shard
+
+    def set_report(self, report):
+        self.report = report
+
+    def get_fingerprint(self, testset):
+        # Results only carry over between runs with the same binaries and
+        # the same options affecting the verdict.
+        config = [self.fi_lib_name, str(self.fi_lib_object), str(self.fi_path_filter),
+            str(self.corruption_test), str(testset.timeout)]
+        lib_dirs = self.fi_ld_lib_path.split(':')
+        return self.journal.fingerprint(testset.cmd, lib_dirs, config)
+
     def get_testset_count(self):
         return len(self.testset_list)
 
@@ -142,72 +224,777 @@ class Testsuite(object):
                 f.write('    failcountbeg=' + str(testset.fail_count_beg) + '\n')
                 f.write('    failcountend=' + str(testset.fail_count_end) + '\n')
                 f.write('    failcountignore=' + ",".join(str(i) for i in testset.fail_count_ignore) + '\n')
+                f.write('    failwindow=' + str(testset.fail_window) + '\n')
+                f.write('    failevery=' + str(testset.fail_every) + '\n')
                 f.write('    timeout=' + str(testset.timeout) + '\n')
 
-    def run_testset(self, testset):
+    def result_details(self, testset, result, pid):
+        # What a journal needs beyond the verdict to rerun a test elsewhere,
+        # and where the files of a failure were saved.
+        details = {'failwindow': testset.fail_window, 'failevery': testset.fail_every,
+            'timeout': testset.timeout}
+        if not result and pid != None:
+            details['host'] = socket.gethostname()
+            details['saved'] = saved_test_dir(pid)
+        return details
+
+    def shard_testsets(self, testset_list, split_units):
+        # Fail count f of the ith testset of the expanded test list belongs
+        # to shard (i + f) % n. That doesn't depend on how many operations
+        # any counting run saw, so the shards cover every unit exactly once
+        # even when their counts differ. Return the testsets with units in
+        # this shard, each with its index in the list. A testset that can't
+        # be split because a single run covers it goes to shard i % n whole,
+        # index None.
+        index, count = self.shard
+        selected = []
+        for i, testset in enumerate(testset_list):
+            if not split_units:
+                if i % count == index - 1:
+                    selected.append((testset, None))
+                continue
+            if testset.fail_count_end == None:
+                selected.append((testset, i))
+                continue
+            # The first fail count of the range in this shard, then every nth
+            failcount = testset.fail_count_beg + \
+                (index - 1 - i - testset.fail_count_beg) % count
+            ignore = set(testset.fail_count_ignore)
+            while failcount <= testset.fail_count_end and failcount in ignore:
+                failcount += count
+            if failcount <= testset.fail_count_end:
+                selected.append((testset, i))
+        return selected
+
+    def record_shard_units(self, testset_list, shards):
+        # Report this shard's share once the ranges that need it are bounded
+        index, count = self.shard
+        units = 0
+        open_ended = 0
+        for testset, shard in zip(testset_list, shards):
+            if testset.fail_count_end == None:
+                open_ended += 1
+                continue
+            state = TestsetState(testset, shard)
+            units += len([f for f in range(testset.fail_count_beg, testset.fail_count_end + 1)
+                if not state.skipped(f)])
+        dbg(0, 'Shard ' + str(index) + '/' + str(count) + ': ' + str(units) +
+            ' fail counts of ' + str(len(testset_list)) + ' testsets, ' + str(open_ended) +
+            ' open ended')
+        if self.journal != None:
+            self.journal.record_shard(index, count, {'host': socket.gethostname(),
+                'units': units, 'testsets': len(testset_list), 'started': time.time()})
+
+    def log_test_result(self, testset, failcount, result, ret_code, cached=False, stats=None):
+        fi_str = '[fi_count: ' + str(failcount)
+        if testset_shape(testset) != '':
+            fi_str += ', ' + testset_shape(testset)
+        fi_str += ', cmd: ' + testset.cmd + ']'
+        dbg(1, 'Exit code:' + str(ret_code) + ' .. ' + fi_str)
+
+        if result:
+            tmp_dbg_str = '[PASS]'
+        else:
+            tmp_dbg_str = '[FAIL]'
+        tmp_dbg_str += '  ..  ' + fi_str
+        if cached:
+            tmp_dbg_str += ' (journal)'
+        dbg(1, tmp_dbg_str)
+        if stats != None:
+            dbg(1, 'Stats: ' + fi_stats.summarize_stats(stats) + ' .. ' + fi_str)
+
+    def collect_fork_sweep_results(self, pid):
+        # Map each fail count the library forked a child for to the child's
+        # pid and exit code.
+        results = {}
+        for res_file in glob.glob(FI_TMP_DIR + 'fi_sweep_' + str(pid) + '_*.res'):
+            child_pid = int(res_file[:-len('.res')].rsplit('_', 1)[1])
+            with open(res_file, 'r') as f:
+                values = dict(line.strip().split('=', 1) for line in f if '=' in line)
+            results[int(values['failcount'])] = (child_pid, int(values['exitcode']))
+        return results
+
+    def count_testset_ops(self, testset):
+        # Run the command once without injecting any faults, and return the
+        # number of interesting operations it performed, None if unknown,
+        # and with unique sites on, a map of each operation to its injection
+        # site.
+        if self.journal != None and self.unique_sites == 0:
+            op_count = self.journal.lookup_op_count(testset.cmd,
+                self.get_fingerprint(testset))
+            if op_count != None:
+                dbg(1, 'Journal has ' + str(op_count) + ' interesting operations .. ' + str(testset))
+                return op_count, None
+        count_env = dict(self.test_env, FAULTINJECT_COUNT_ONLY='1')
+        if self.unique_sites > 0:
+            count_env['FAULTINJECT_SITES'] = '1'
+        proc = Process(testset_cmd(testset), count_env)
+        start = time.time()
+        ret_code = proc.run(testset.timeout)
+        if self.report != None:
+            self.report.record('count', testset, None, {'exitcode': ret_code,
+                'walltime': time.time() - start, 'timedout': proc.timed_out, 'pid': proc.pid})
+        count_file = FI_TMP_DIR + 'fi_pid_' + str(proc.pid) + '_op_count.log'
+        if not os.path.exists(count_file):
+            dbg(0, 'Counting run did not report an operation count .. ' + str(testset))
+            return None, None
+        with open(count_file, 'r') as f:
+            counts = dict(line.strip().split('=', 1) for line in f if '=' in line)
+        dbg(1, 'Counted ' + counts['total'] + ' interesting operations .. ' + str(testset))
+        if self.journal != None:
+            self.journal.record_op_count(testset.cmd, self.get_fingerprint(testset),
+                int(counts['total']))
+        sites = None
+        sites_file = FI_TMP_DIR + 'fi_pid_' + str(proc.pid) + '_sites.log'
+        if os.path.exists(sites_file):
+            with open(sites_file, 'r') as f:
+                sites = dict((int(op), site) for op, site in
+                    (line.split() for line in f if len(line.split()) == 2))
+        return int(counts['total']), sites
+
+    def dedup_sites(self, testset, sites):
+        # Ignore the fail counts injecting at a call stack that has already
+        # been covered unique_sites times. Fail count N fails operation N+1.
+        fail_count_ignore = set(testset.fail_count_ignore)
+        runs = {}
+        skipped = 0
+        for failcount in range(testset.fail_count_beg, testset.fail_count_end + 1):
+            if failcount in fail_count_ignore or not failcount + 1 in sites:
+                continue
+            site = sites[failcount + 1]
+            runs[site] = runs.get(site, 0) + 1
+            if runs[site] > self.unique_sites:
+                fail_count_ignore.add(failcount)
+                skipped += 1
+        dbg(0, 'Injection sites: ' + str(len(set(sites.values()))) + ' unique out of ' +
+            str(len(sites)) + ' operations, skipping ' + str(skipped) +
+            ' fail counts .. ' + testset.cmd)
+        return testset._replace(fail_count_ignore = sorted(fail_count_ignore))
+
+    def bound_testset(self, testset):
+        # Use a counting run to bound the fail count range of the testset:
+        # failing past the last interesting operation injects nothing.
+        op_count, sites = self.count_testset_ops(testset)
+        if op_count == None:
+            return testset
+        fail_count_end = op_count
+        if testset.fail_count_end != None:
+            fail_count_end = min(testset.fail_count_end, op_count)
+        fail_count_end = max(fail_count_end, testset.fail_count_beg)
+        testset = testset._replace(fail_count_end = fail_count_end)
+        if sites != None:
+            testset = self.dedup_sites(testset, sites)
+        return testset
+
+    def run_testset_fork_sweep(self, testset):
+        # A single run of the command covers the whole fail count range: the
+        # library forks a child to fail each interesting operation while the
+        # parent carries on, and records each child's exit code. The
+        # children share the parent's on-disk state, so no corruption test
+        # is run.
         if self.abort_tests:
             return False
-        dbg(1, 'Running test set: ' + str(testset))
-        failcount = testset.fail_count_beg
-        if (failcount == 0):
+        dbg(1, 'Running test set with fork sweep: ' + str(testset))
+        if testset.fail_count_beg == 0:
             dbg(0, 'Aborting .. cmd: ' + testset.cmd + '. failcount cant be 0')
             exit_abnormal()
-        while True:
-            if testset.fail_count_end != None and failcount > testset.fail_count_end:
-                # We are past the last iteration (failcountend) of the test
-                break
-            if not failcount in testset.fail_count_ignore:
-                if self.abort_tests:
-                    return False
+        sweep_env = dict(self.test_env,
+            FAULTINJECT_FORK_SWEEP=str(self.fork_sweep),
+            FAULTINJECT_FORK_SWEEP_TIMEOUT=str(testset.timeout))
+        if testset.fail_count_end != None:
+            sweep_env['FAULTINJECT_FORK_SWEEP_END'] = str(testset.fail_count_end)
 
-                test = Test(testset.cmd, self.test_env, failcount, testset.timeout, testset.dir)
+        # The parent does every operation for real and waits for its
+        # children before exiting. The library gives a child twice the
+        # timeout before killing it, and runs up to fork_sweep at once.
+        timeout = None
+        if testset.timeout != None:
+            fail_counts = FORK_SWEEP_UNBOUNDED_FAIL_COUNTS
+            if testset.fail_count_end != None:
+                fail_counts = testset.fail_count_end - testset.fail_count_beg + 1
+            timeout = testset.timeout * \
+                (2 * ((fail_counts + self.fork_sweep - 1) // self.fork_sweep) + 1)
+        test = Test(testset_cmd(testset), sweep_env, testset.fail_count_beg, timeout,
+            testset.dir, testset.fail_window, testset.fail_every)
+        passed, ret_code = test.run(False)
+        if not passed:
+            dbg(0, '[FAIL]  ..  [fork sweep parent' +
+                (' timed out after ' + str(timeout) + 's' if test.proc.timed_out else '') +
+                ', cmd: ' + testset.cmd + ']')
+        if self.report != None:
+            self.report.record('forksweep', testset, None, test.report_entry())
+
+        results = self.collect_fork_sweep_results(test.proc.pid)
+        for failcount in sorted(results):
+            if failcount in testset.fail_count_ignore:
+                continue
+            child_pid, ret_code = results[failcount]
+            child_test = Test(testset_cmd(testset), self.test_env, failcount, testset.timeout, testset.dir,
+                testset.fail_window, testset.fail_every)
+            result = not child_test.did_test_fail(ret_code)
+            self.log_test_result(testset, failcount, result, ret_code)
+            if self.journal != None:
+                # The children aren't timed individually
+                self.journal.record_result(testset.cmd, testset_shape(testset), failcount,
+                    self.get_fingerprint(testset), result, ret_code, None,
+                    self.result_details(testset, result, child_pid))
+            artifacts = []
+            if not result:
+                artifacts = child_test.save_test_files(child_pid)
+                passed = False
+            if self.report != None:
+                # The children aren't timed individually
+                self.report.record('test', testset, failcount, {'exitcode': ret_code,
+                    'verdict': 'pass' if result else 'fail', 'walltime': None,
+                    'pid': child_pid, 'artifacts': artifacts})
+
+        dbg(1, 'Fork sweep covered ' + str(len(results)) + ' fail counts .. ' + str(testset))
+        if not passed:
+            if not self.proceed_on_failure:
+                dbg(1, 'Aborted testing at the first test failure.')
+                self.abort_tests = True
+            return False
+        dbg(0, '[PASS]  ..  ' + str(testset))
+        return True
+
+    def run_worker(self, scheduler, worker):
+        # Run units until every testset is done. Units of a testset taking its
+        # directory through {dir} can run on several workers at once, so
+        # each worker gets its own directory.
+        while not self.abort_tests:
+            state, failcount = scheduler.get_unit(worker)
+            if state == None:
+                break
+            testset = state.testset
+            cached = None
+            test = None
+            if self.journal != None:
+                fingerprint = self.get_fingerprint(testset)
+                cached = self.journal.lookup_result(testset.cmd, testset_shape(testset),
+                    failcount, fingerprint)
+            if cached != None:
+                # An earlier run with the same binaries has the verdict
+                result, ret_code = cached
+            else:
+                rundir = testset.dir
+                if self.threads > 1 and testset_splits(testset):
+                    rundir += '.' + str(worker + 1)
+                test = Test(testset_cmd(testset, rundir), self.test_env,
+                    failcount, testset.timeout, rundir, testset.fail_window, testset.fail_every)
                 result, ret_code = test.run(self.corruption_test)
-                dbg(1, 'Exit code:' + str(ret_code) + ' .. ' + '[fi_count: ' +
-                    str(failcount) + ', cmd: ' + testset.cmd + ']')
 
-                if result:
-                    tmp_dbg_str = '[PASS]'
-                else:
-                    tmp_dbg_str = '[FAIL]'
-                tmp_dbg_str += '  ..  ' + '[fi_count: ' + str(failcount) + ', cmd: ' + testset.cmd + ']'
-                dbg(1, tmp_dbg_str)
-                if not result and not self.proceed_on_failure:
-                    dbg(1, 'Aborted testing at the first test failure.')
-                    self.abort_tests = True
-                    return False
-                if ret_code == 0:
+            with scheduler.lock:
+                state.running -= 1
+                # A fail count started before an earlier one succeeded
+                # wouldn't have run at all one at a time.
+                dropped = state.stop_failcount != None and failcount > state.stop_failcount
+                if not dropped and not result:
+                    state.result = False
+                    if not self.proceed_on_failure and not self.abort_tests:
+                        dbg(1, 'Aborted testing at the first test failure.')
+                        self.abort_tests = True
+                if not dropped and ret_code == 0 and not testset_recovers(testset):
                     # The application ran successfully,
                     # likely we are injecting faults past where applicaton can fail.
-                    # Let's call it done
+                    # Let's call it done, and cancel the fail counts past this one.
+                    state.stop_failcount = failcount
                     dbg(0, 'Stopping at first success .. ' + '[fi_count: ' + str(failcount) + ', cmd: ' + testset.cmd + ']')
-                    break
-            failcount += 1
-        dbg(0, '[PASS]  ..  ' + str(testset))
-        return True
+                # Log under the lock, so the testset's verdict comes last
+                if dropped:
+                    dbg(1, 'Dropped result past the first success .. [fi_count: ' +
+                        str(failcount) + ', cmd: ' + testset.cmd + ']')
+                    if test != None and len(test.artifacts) > 0:
+                        shutil.rmtree(saved_test_dir(test.proc.pid), True)
+                elif test == None:
+                    self.log_test_result(testset, failcount, result, ret_code, True)
+                    if self.report != None:
+                        self.report.record('test', testset, failcount, {'exitcode': ret_code,
+                            'verdict': 'pass' if result else 'fail', 'walltime': None,
+                            'cached': True})
+                else:
+                    self.log_test_result(testset, failcount, result, ret_code, stats=test.stats)
+                    if self.report != None:
+                        self.report.record('test', testset, failcount, test.report_entry())
+                    if self.journal != None:
+                        self.journal.record_result(testset.cmd, testset_shape(testset), failcount,
+                            fingerprint, result, ret_code, test.walltime,
+                            self.result_details(testset, result, test.proc.pid))
+                finished = state.finished()
+                scheduler.unit_done(self.abort_tests)
+            if finished and state.result:
+                dbg(0, '[PASS]  ..  ' + str(testset))
+
+    def read_delay_log(self, pid):
+        # Return the number of delays a run injected and their total length
+        # in seconds.
+        delays, usec = 0, 0
+        delay_file = FI_TMP_DIR + 'fi_pid_' + str(pid) + '_delay.log'
+        if os.path.exists(delay_file):
+            with open(delay_file, 'r') as f:
+                for line in f:
+                    if '=' in line:
+                        counts = line.strip().split('=', 1)[1].split(',')
+                        delays += int(counts[0])
+                        usec += int(counts[1])
+        return delays, usec / 1000000.0
+
+    def run_testset_latency(self, testset):
+        # Time runs without and with the delays, alternating so that a
+        # change in machine load hits both alike, and compare the medians.
+        walltimes = {False: [], True: []}
+        injected = []
+        for i in range(LATENCY_RUNS):
+            for delayed in [False, True]:
+                run_env = self.test_env
+                if delayed:
+                    run_env = dict(self.test_env, **self.latency_env)
+                proc = Process(testset_cmd(testset), run_env)
+                start = time.time()
+                ret_code = proc.run(testset.timeout)
+                walltimes[delayed].append(time.time() - start)
+                if proc.timed_out or ret_code != 0:
+                    dbg(0, ('Delayed' if delayed else 'Baseline') + ' run exited with ' +
+                        str(ret_code) + (' after timing out' if proc.timed_out else '') +
+                        ' .. cmd: ' + testset.cmd)
+                entry = {'exitcode': ret_code, 'walltime': walltimes[delayed][-1],
+                    'timedout': proc.timed_out, 'pid': proc.pid}
+                if delayed:
+                    injected.append(self.read_delay_log(proc.pid))
+                    entry['delays'], entry['injected'] = injected[-1]
+                if self.report != None:
+                    self.report.record('latency' if delayed else 'baseline', testset, None,
+                        entry)
+                if proc.output_file != None and os.path.exists(proc.output_file):
+                    os.remove(proc.output_file)
+        baseline = sorted(walltimes[False])[LATENCY_RUNS // 2]
+        delayed = sorted(walltimes[True])[LATENCY_RUNS // 2]
+        delays = sum(d for d, t in injected) // LATENCY_RUNS
+        delay_time = sum(t for d, t in injected) / LATENCY_RUNS
+        change = delayed - baseline
+        dbg(0, '[LATENCY]  ..  baseline: %.3fs, delayed: %.3fs, change: %+.3fs (%+.1f%%), '
+            'injected: %.3fs in %d delays  ..  cmd: %s' % (baseline, delayed, change,
+            100.0 * change / baseline if baseline > 0 else 0.0, delay_time, delays,
+            testset.cmd))
+        if self.journal != None:
+            self.journal.record_latency(testset.cmd, self.get_fingerprint(testset),
+                {'baseline': baseline, 'delayed': delayed, 'injected': delay_time,
+                'delays': delays, 'delayenv': self.latency_env})
+
+    def run_units(self, testset_list, shards=None):
+        for testset in testset_list:
+            if testset.fail_count_beg == 0:
+                dbg(0, 'Aborting .. cmd: ' + testset.cmd + '. failcount cant be 0')
+                exit_abnormal()
+        scheduler = Scheduler(testset_list, self.threads, shards)
+        workers = [threading.Thread(target=self.run_worker, args=(scheduler, i))
+            for i in range(self.threads)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        return [state.result for state in scheduler.states]
 
     def run(self):
         dbg(0, 'Running ' + str(self.get_testset_count()) + ' testset with ' +
                 str(self.threads) + ' threads .. ')
         self.cleanup_pre()
+        if self.latency_env != None:
+            testset_list = self.testset_list
+            if self.shard != None:
+                testset_list = [t for t, i in self.shard_testsets(testset_list, False)]
+            # One command at a time, so the runs don't slow each other down.
+            for testset in testset_list:
+                self.run_testset_latency(testset)
+            self.close_records()
+            self.cleanup_post()
+            return
         pool = ThreadPool(self.threads)
-        results = pool.map(self.run_testset, self.testset_list)
+        testset_list = self.testset_list
+        shards = None
+        if self.shard != None:
+            # Pick the shard's testsets first, so only those get counted
+            selected = self.shard_testsets(testset_list, self.fork_sweep == 0)
+            testset_list = [t for t, i in selected]
+            shards = [None if i == None else self.shard + (i,) for t, i in selected]
+        # A success doesn't end a testset whose faults stop, only running
+        # out of operations does. The timeout of a fork sweep parent grows
+        # with the number of fail counts.
+        needs_bound = lambda t: t.fail_count_end == None and \
+            (testset_recovers(t) or (self.fork_sweep > 0 and t.timeout != None))
+        if self.dry_run:
+            testset_list = pool.map(self.bound_testset, testset_list)
+        elif True in [needs_bound(t) for t in testset_list]:
+            dbg(0, 'Counting operations to bound open ended testsets')
+            testset_list = pool.map(lambda t: self.bound_testset(t)
+                if needs_bound(t) else t, testset_list)
+        if self.shard != None:
+            self.record_shard_units(testset_list, shards)
+        if self.fork_sweep > 0:
+            # A single run covers each testset
+            results = pool.map(self.run_testset_fork_sweep, testset_list)
+        else:
+            results = self.run_units(testset_list, shards)
         pool.close()
         pool.join()
+        self.close_records()
         self.cleanup_post()
         if False in results:
             exit_abnormal()
 
-Testset = namedtuple('Testset', ['cmd', 'fail_count_beg', 'fail_count_end', 'fail_count_ignore', 'timeout', 'dir'])
+    def close_records(self):
+        # Summarize the report, and note in the journal that a shard is done
+        if self.report != None:
+            self.report.summarize(self.threads)
+            self.report.close()
+        if self.journal != None:
+            if self.shard != None:
+                self.journal.record_shard(self.shard[0], self.shard[1],
+                    {'finished': time.time(), 'aborted': self.abort_tests})
+            self.journal.close()
+
+class TestsetState(object):
+    # Tracks which fail counts of a testset have been handed out, and when
+    # the testset can stop. With a shard, (index, count, position of the
+    # testset in the expanded test list), only the fail counts that shard
+    # owns are handed out, see shard_testsets.
+    def __init__(self, testset, shard=None):
+        self.testset = testset
+        self.fail_count_ignore = set(testset.fail_count_ignore)
+        self.shard = shard
+        self.next_failcount = testset.fail_count_beg
+        self.stop_failcount = None
+        self.running = 0
+        self.result = True
+        self.reported = False
+
+    def skipped(self, failcount):
+        if failcount in self.fail_count_ignore:
+            return True
+        if self.shard == None:
+            return False
+        index, count, position = self.shard
+        return (position + failcount) % count != index - 1
+
+    def exhausted(self):
+        while self.skipped(self.next_failcount) and \
+            (self.testset.fail_count_end == None or
+            self.next_failcount <= self.testset.fail_count_end):
+            self.next_failcount += 1
+        if self.testset.fail_count_end != None and \
+            self.next_failcount > self.testset.fail_count_end:
+            return True
+        return self.stop_failcount != None and self.next_failcount > self.stop_failcount
+
+    def next_unit(self):
+        if self.exhausted():
+            return None
+        # Without a directory of its own, one fail count at a time
+        if self.running > 0 and not testset_splits(self.testset):
+            return None
+        self.next_failcount += 1
+        self.running += 1
+        return self.next_failcount - 1
+
+    def finished(self):
+        # True exactly once, when the last unit of the testset is done.
+        if self.reported or self.running != 0 or not self.exhausted():
+            return False
+        self.reported = True
+        return True
+
+class Scheduler(object):
+    # Hands out (testset, failcount) units to workers. Each worker owns a
+    # deque of testsets and takes units from the front of its own. A worker
+    # that runs out steals units from the back of another worker's deque, so
+    # a long testset ends up spread over every worker instead of keeping
+    # one busy while the others idle. A testset that can't split runs one
+    # unit at a time, and is passed over while it has one running. A worker
+    # finding nothing to run waits for a running unit to finish, as that may
+    # leave more to hand out, until every testset is done or testing stops.
+    def __init__(self, testset_list, threads, shards=None):
+        self.lock = threading.Lock()
+        self.cond = threading.Condition(self.lock)
+        self.stopped = False
+        if shards == None:
+            shards = [None] * len(testset_list)
+        self.states = [TestsetState(testset, shard)
+            for testset, shard in zip(testset_list, shards)]
+        self.queues = [deque() for i in range(threads)]
+        for i, state in enumerate(self.states):
+            self.queues[i % threads].append(state)
+
+    def get_unit(self, worker):
+        with self.lock:
+            while not self.stopped:
+                for i in range(len(self.queues)):
+                    queue = self.queues[(worker + i) % len(self.queues)]
+                    if i == 0:
+                        states = list(queue)
+                    else:
+                        states = list(reversed(queue))
+                    for state in states:
+                        failcount = state.next_unit()
+                        if failcount != None:
+                            return state, failcount
+                        if state.exhausted():
+                            # Nothing left to hand out for this testset
+                            queue.remove(state)
+                if not True in [state.running > 0 for state in self.states]:
+                    break
+                self.cond.wait()
+        return None, None
+
+    def unit_done(self, stop=False):
+        # Called with the lock held when a unit finishes, wakes the workers
+        # waiting for more units.
+        if stop:
+            self.stopped = True
+        self.cond.notify_all()
+
+class Journal(object):
+    # An append-only file of results, one JSON object per line, keyed by
+    # command, fail count and a fingerprint of the binaries involved. Lines
+    # are flushed as they are written, so a sweep that is interrupted
+    # resumes where it stopped, and changing a binary invalidates exactly
+    # the results of the commands that use it.
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.results = {}
+        self.op_counts = {}
+        self.file_digests = {}
+        self.fingerprints = {}
+        if os.path.exists(path):
+            self.load()
+        self.f = open(path, 'a')
+
+    def load(self):
+        with open(self.path, 'r') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # A line cut short by an interrupted run
+                    continue
+                if 'shard' in entry or 'latency' in entry:
+                    continue
+                if 'opcount' in entry:
+                    self.op_counts[(entry['cmd'], entry['fingerprint'])] = entry['opcount']
+                else:
+                    self.results[(entry['cmd'], entry.get('shape', ''), entry['failcount'],
+                        entry['fingerprint'])] = (entry['verdict'] == 'pass', entry['exitcode'])
+        dbg(1, 'Loaded ' + str(len(self.results)) + ' results from journal ' + self.path)
+
+    def file_digest(self, path):
+        # Hash each file once per run, unless it changes underneath us
+        st = os.stat(path)
+        key = (path, st.st_size, st.st_mtime)
+        if not key in self.file_digests:
+            sha = hashlib.sha1()
+            with open(path, 'rb') as f:
+                for chunk in iter(lambda: f.read(1 << 20), b''):
+                    sha.update(chunk)
+            self.file_digests[key] = sha.hexdigest()
+        return self.file_digests[key]
+
+    def fingerprint(self, cmd, lib_dirs, config):
+        # Hash the executable, every file the command line names and the
+        # shared objects in the library directories the tests run with,
+        # libfaultinject.so among them.
+        with self.lock:
+            key = (cmd, tuple(lib_dirs), tuple(config))
+            if key in self.fingerprints:
+                return self.fingerprints[key]
+            args = shlex.split(cmd)
+            paths = []
+            if len(args) > 0 and not '/' in args[0]:
+                for path_dir in os.environ.get('PATH', '').split(':'):
+                    if os.path.isfile(os.path.join(path_dir, args[0])):
+                        paths.append(os.path.join(path_dir, args[0]))
+                        break
+            paths += [os.path.abspath(arg) for arg in args if os.path.isfile(arg)]
+            for lib_dir in lib_dirs:
+                paths += sorted(glob.glob(lib_dir + '/*.so*'))
+            sha = hashlib.sha1()
+            for item in config:
+                sha.update((item + '\n').encode('utf-8'))
+            for path in paths:
+                sha.update((os.path.basename(path) + ':' + self.file_digest(path) +
+                    '\n').encode('utf-8'))
+            self.fingerprints[key] = sha.hexdigest()
+            return self.fingerprints[key]
+
+    def lookup_result(self, cmd, shape, failcount, fingerprint):
+        # Return (result, exit code) of an earlier run, None if there is none
+        with self.lock:
+            return self.results.get((cmd, shape, failcount, fingerprint))
+
+    def lookup_op_count(self, cmd, fingerprint):
+        with self.lock:
+            return self.op_counts.get((cmd, fingerprint))
+
+    def append(self, entry):
+        self.f.write(json.dumps(entry, sort_keys=True) + '\n')
+        self.f.flush()
+
+    def record_result(self, cmd, shape, failcount, fingerprint, result, ret_code, walltime,
+        details={}):
+        with self.lock:
+            self.results[(cmd, shape, failcount, fingerprint)] = (result, ret_code)
+            self.append(dict(details, cmd=cmd, shape=shape, failcount=failcount,
+                fingerprint=fingerprint, verdict='pass' if result else 'fail',
+                exitcode=ret_code, walltime=walltime, time=time.time()))
+
+    def record_shard(self, index, count, details):
+        # Which shard of a sweep the results that follow belong to, and
+        # later whether it finished.
+        with self.lock:
+            self.append(dict(details, shard=[index, count]))
+
+    def record_latency(self, cmd, fingerprint, latency):
+        # The outcome of a latency run, kept for the record only: it has no
+        # verdict to reuse.
+        with self.lock:
+            self.append({'cmd': cmd, 'fingerprint': fingerprint, 'latency': latency,
+                'time': time.time()})
+
+    def record_op_count(self, cmd, fingerprint, op_count):
+        with self.lock:
+            self.op_counts[(cmd, fingerprint)] = op_count
+            self.append({'cmd': cmd, 'fingerprint': fingerprint, 'opcount': op_count,
+                'time': time.time()})
+
+    def close(self):
+        self.f.close()
+
+class Report(object):
+    # A line of JSON per run of a command, written as each run finishes:
+    # what it ran, how it ended, how long it and its corruption test took,
+    # and the files saved from it. Run times are also added up per testset
+    # and per range of fail counts, to show where the time of a sweep goes.
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.start = time.time()
+        self.kinds = {}
+        self.untimed = {}
+        self.testsets = {}
+        self.ranges = {}
+        self.timeouts = [0, 0.0]
+        self.corruption_time = 0.0
+        self.f = open(path, 'w')
+
+    def record(self, kind, testset, failcount, entry):
+        # Kind is 'test', 'count' for a dry run, 'forksweep' for the parent
+        # of a fork sweep, or 'baseline' and 'latency' for the runs of -L
+        # without and with the delays.
+        entry = dict(entry, kind=kind, cmd=testset.cmd, shape=testset_shape(testset),
+            failcount=failcount, time=time.time())
+        walltime = entry['walltime']
+        with self.lock:
+            self.f.write(json.dumps(entry, sort_keys=True) + '\n')
+            self.f.flush()
+            if walltime == None:
+                # The children of a fork sweep, whose time their parent has
+                self.untimed[kind] = self.untimed.get(kind, 0) + 1
+                return
+            for totals, key in [(self.kinds, kind),
+                (self.testsets, (testset.cmd, testset_shape(testset)))]:
+                total = totals.setdefault(key, [0, 0.0, 0])
+                total[0] += 1
+                total[1] += walltime
+                total[2] += 1 if entry.get('timedout') else 0
+            if failcount != None:
+                # Ranges of fail counts with the same number of digits
+                total = self.ranges.setdefault(len(str(failcount)), [0, 0.0, 0])
+                total[0] += 1
+                total[1] += walltime
+            if entry.get('timedout'):
+                self.timeouts[0] += 1
+                self.timeouts[1] += walltime
+            if entry.get('corruptiontime') != None:
+                self.corruption_time += entry['corruptiontime']
+
+    def summarize(self, threads):
+        with self.lock:
+            runtime = sum(total[1] for total in self.kinds.values())
+            dbg(0, 'Sweep took %.1fs, running commands for %.1fs with %d threads, ' \
+                '%.1fs of it in %d timed out runs and %.1fs in corruption tests' %
+                (time.time() - self.start, runtime, threads, self.timeouts[1],
+                self.timeouts[0], self.corruption_time))
+            for kind in sorted(set(self.kinds) | set(self.untimed)):
+                total = self.kinds.get(kind, [0, 0.0, 0])
+                line = '  %-10s %8.1fs  ..  %d runs' % (kind, total[1], total[0])
+                if kind in self.untimed:
+                    line += ', %d untimed' % self.untimed[kind]
+                dbg(0, line)
+            if len(self.untimed) != 0:
+                dbg(0, 'Untimed runs, the children of fork sweeps, are left out below; ' \
+                    'their time is in that of the forksweep runs')
+            dbg(0, 'Slowest testsets:')
+            slowest = sorted(self.testsets.items(), key=lambda item: -item[1][1])
+            for (cmd, shape), total in slowest[:REPORT_TOP_TESTSETS]:
+                dbg(0, '  %8.1fs  ..  %d runs, %d timed out  ..  %scmd: %s' % (total[1],
+                    total[0], total[2], shape + ', ' if shape != '' else '', cmd))
+            if len(self.ranges) != 0:
+                dbg(0, 'Fail count ranges:')
+            for digits, total in sorted(self.ranges.items()):
+                dbg(0, '  %10s  %8.1fs  ..  %d runs, %.2fs each' % ('%d-%d' %
+                    (10 ** (digits - 1), 10 ** digits - 1), total[1], total[0],
+                    total[1] / total[0]))
+            dbg(0, 'Report of every run in ' + self.path)
+
+    def close(self):
+        self.f.close()
+
+Testset = namedtuple('Testset', ['cmd', 'fail_count_beg', 'fail_count_end', 'fail_count_ignore',
+    'fail_window', 'fail_every', 'timeout', 'dir'])
+
+def testset_shape(testset):
+    # How operations fail past the fail count, empty when they all do
+    if testset.fail_window == 0 and testset.fail_every == 1:
+        return ''
+    return 'failwindow=' + str(testset.fail_window) + ' failevery=' + str(testset.fail_every)
+
+def testset_recovers(testset):
+    # Whether operations succeed again after the fail count
+    return testset.fail_window != 0 or testset.fail_every != 1
+
+def testset_splits(testset):
+    # Only a command taking its directory through {dir} can run several
+    # fail counts at once, each in a directory of its own.
+    return '{dir}' in testset.cmd
+
+def testset_cmd(testset, rundir=None):
+    # The command to run, with the directory in place of {dir}
+    if rundir == None:
+        rundir = testset.dir
+    return testset.cmd.replace('{dir}', rundir)
+
+def saved_test_dir(pid):
+    # Where the files of a failed test are moved to
+    return CUR_DIR + '/FI_TEST.' + str(pid) + '/'
 
 class Test(object):
-    def __init__(self, cmd, global_test_env, failcount, timeout, rundir):
+    def __init__(self, cmd, global_test_env, failcount, timeout, rundir, fail_window=0,
+        fail_every=1):
         self.cmd = cmd
         self.failcount = failcount
+        self.fail_window = fail_window
+        self.fail_every = fail_every
         self.run_env = dict(global_test_env,
-            FAULTINJECT_FAIL_COUNT=str(self.failcount))
+            FAULTINJECT_FAIL_COUNT=str(self.failcount),
+            FAULTINJECT_FAIL_WINDOW=str(self.fail_window),
+            FAULTINJECT_FAIL_EVERY=str(self.fail_every))
         self.timeout = timeout
         self.proc = None
         self.rundir = rundir
+        self.walltime = None
+        self.corruption_time = None
+        self.stats = None
+        self.artifacts = []
+        self.retcode = None
+        self.result = None
 
     def dump_testconfig(self, filename):
         with open(filename, 'w') as f:
@@ -215,24 +1002,32 @@ class Test(object):
             f.write('cmd=' + self.cmd + '\n')
             f.write('    failcountbeg=' + str(self.failcount) + '\n')
             f.write('    failcountend=' + str(self.failcount) + '\n')
+            f.write('    failwindow=' + str(self.fail_window) + '\n')
+            f.write('    failevery=' + str(self.fail_every) + '\n')
             f.write('    timeout=' + str(self.timeout) + '\n')
 
-    def save_test_files(self):
-        # Move core and log files into a separate dir
-        save_dir = CUR_DIR + '/FI_TEST.' + str(self.proc.pid) + '/'
-        dbg(1, 'Pid for the failed process: ' + str(self.proc.pid))
+    def save_test_files(self, pid):
+        # Move core and log files into a separate dir, return the paths of
+        # everything saved there
+        save_dir = saved_test_dir(pid)
+        dbg(1, 'Pid for the failed process: ' + str(pid))
         dbg(0, 'Saving the generated logs and config in dir: ' + save_dir)
-        cmd = 'mkdir ' + save_dir
-        cmd += ' && '
-        cmd += 'mv ' + FI_TMP_DIR + '*' + str(self.proc.pid) + '* '  + save_dir
-        cmd += ' && '
-        cmd += 'mv ' + CUR_DIR + '/core.*.' + str(self.proc.pid) + ' ' + save_dir
-        process = Popen(cmd, stderr=PIPE, shell=True)
-        process.wait()
+        if not os.path.isdir(save_dir):
+            os.mkdir(save_dir)
+        for path in glob.glob(FI_TMP_DIR + '*' + str(pid) + '*') + \
+            glob.glob(CUR_DIR + '/core.*.' + str(pid)):
+            shutil.move(path, save_dir)
+
+        # Turn the binary trace of a trace enabled library into readable logs
+        trace_file = save_dir + 'fi_pid_' + str(pid) + '_trace.bin'
+        if os.path.exists(trace_file):
+            fi_trace_decode.decode(trace_file, fi_trace_decode.get_functions(),
+                save_dir, False)
 
         # Dump config to reproduce
-        conf_file = save_dir + 'config_' + str(self.proc.pid) + '.fi'
+        conf_file = save_dir + 'config_' + str(pid) + '.fi'
         self.dump_testconfig(conf_file)
+        return sorted(glob.glob(save_dir + '*'))
 
     def did_test_fail(self, retcode):
         # Following signals are erroneous exits, but likely generated by the
@@ -255,41 +1050,164 @@ class Test(object):
             return False
 
     def run(self, corruption_test):
+        start = time.time()
         self.proc = Process(self.cmd, self.run_env)
         retcode = self.proc.run(self.timeout)
 
+        # The library's final interception counters, if it kept any
+        stats_file = FI_TMP_DIR + 'fi_pid_' + str(self.proc.pid) + '_stats.bin'
+        if os.path.exists(stats_file):
+            try:
+                self.stats = fi_stats.read_stats(stats_file)[1]
+            except ValueError as e:
+                dbg(1, str(e))
+
         test_failed = self.did_test_fail(retcode)
 
         if not test_failed and corruption_test:
             # In case of successful iteration run corruption test
             tmp_str = '[fi_count: ' + str(self.failcount) + ', cmd: ' + self.cmd + ']'
             dbg(1, 'Running corruption test for ' + tmp_str)
+            corruption_start = time.time()
             result = self.run_corruption_test(self.rundir)
+            self.corruption_time = time.time() - corruption_start
             if result:
                 dbg(1, 'PASSED corruption test for ' + tmp_str)
             else:
                 dbg(0, 'FAILED corruption test for ' + tmp_str)
                 test_failed = True
 
+        self.walltime = time.time() - start
+
         if test_failed:
-            self.save_test_files()
+            self.artifacts = self.save_test_files(self.proc.pid)
+        else:
+            if self.proc.output_file != None:
+                os.remove(self.proc.output_file)
+            if os.path.exists(stats_file):
+                os.remove(stats_file)
 
+        self.retcode = retcode
+        self.result = not test_failed
         return (not test_failed), retcode
 
+    def report_entry(self):
+        # How the run went, for the report
+        entry = {'exitcode': self.retcode, 'verdict': 'pass' if self.result else 'fail',
+            'walltime': self.walltime, 'timedout': self.proc.timed_out,
+            'corruptiontime': self.corruption_time, 'pid': self.proc.pid,
+            'artifacts': self.artifacts}
+        if self.stats != None:
+            entry['stats'] = fi_stats.total_stats(self.stats)
+        return entry
+
+class ProcessMonitor(object):
+    # Waits on every running child from a single thread, instead of a
+    # thread per child. A caller blocks until its child exits or the
+    # child's deadline passes.
+    POLL_INTERVAL = 0.01
+
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.waiting = {}
+        self.thread = None
+
+    def wait(self, process, timeout):
+        # Return False if the process is still running after timeout seconds,
+        # a timeout of None waits for as long as it takes.
+        entry = {'event': threading.Event(), 'exited': False, 'deadline': None}
+        if timeout != None:
+            entry['deadline'] = time.time() + timeout
+        with self.cond:
+            self.waiting[process] = entry
+            if self.thread == None:
+                self.thread = threading.Thread(target=self.loop)
+                self.thread.daemon = True
+                self.thread.start()
+            self.cond.notify()
+        entry['event'].wait()
+        return entry['exited']
+
+    def loop(self):
+        while True:
+            with self.cond:
+                while len(self.waiting) == 0:
+                    self.cond.wait()
+                waiting = list(self.waiting.items())
+            now = time.time()
+            for process, entry in waiting:
+                if process.poll() != None:
+                    entry['exited'] = True
+                elif entry['deadline'] == None or now < entry['deadline']:
+                    continue
+                with self.cond:
+                    del self.waiting[process]
+                entry['event'].set()
+            time.sleep(self.POLL_INTERVAL)
+
+process_monitor = ProcessMonitor()
+
 class Process(object):
     def __init__(self, cmd, run_env):
         self.cmd = cmd
         self.run_env = run_env
         self.process = None
         self.pid = None
+        self.output_file = None
+        self.timed_out = False
+
+    def catches_signal(self, sig):
+        # Whether the process has a handler for sig. Without one, e.g. if
+        # the library isn't loaded into it, the signal could kill it.
+        try:
+            with open('/proc/' + str(self.pid) + '/status', 'r') as f:
+                for line in f:
+                    if line.startswith('SigCgt:'):
+                        return (int(line.split()[1], 16) >> (sig - 1)) & 1 == 1
+        except IOError:
+            pass
+        return False
+
+    def signal_backtraces(self, filename):
+        # Ask the library in the process to append a sample of its threads'
+        # stacks to filename, return the sample or None if none arrived.
+        if not self.catches_signal(int(BACKTRACE_SIGNAL)):
+            return None
+        size = os.path.getsize(filename) if os.path.exists(filename) else 0
+        try:
+            os.kill(self.pid, BACKTRACE_SIGNAL)
+        except OSError:
+            return None
+        deadline = time.time() + BACKTRACE_WAIT
+        while time.time() < deadline:
+            if os.path.exists(filename) and os.path.getsize(filename) > size:
+                with open(filename, 'r') as f:
+                    f.seek(size)
+                    return f.read()
+            time.sleep(0.01)
+        return None
 
     def dump_backtraces(self):
-        # Obtain backtraces for all threads using pmp every few seconds and dump in
-        # a file, might help later to debug
+        # Obtain backtraces for all threads a few times over and dump in a
+        # file, might help later to debug
         dbg(0, 'Collecting backtraces for pid ' + str(self.pid))
         filename = FI_TMP_DIR + '/fi_pid_' + str(self.pid) + '_hung_btt.log'
-        with open(filename, 'w') as f:
-            for i in range(3):
+        for i in range(BACKTRACE_SAMPLES):
+            if i != 0:
+                time.sleep(BACKTRACE_INTERVAL)
+            out = self.signal_backtraces(filename)
+            if out == None:
+                break
+            dbg(0, 'Backtrace:\n' + out)
+        else:
+            return
+
+        # No answer from the library, it may not be loaded or the process
+        # may have its own handler or block the signal: attach a debugger
+        # instead.
+        dbg(0, 'No backtraces from the library, falling back to pmp')
+        with open(filename, 'a') as f:
+            for i in range(BACKTRACE_SAMPLES):
                 pmp_process = Popen([PMP_PATH, str(self.pid)], stdout=PIPE, stderr=PIPE)
                 out = pmp_process.communicate()
                 f.write(out[0] + '\n')
@@ -297,42 +1215,81 @@ class Process(object):
                 time.sleep(1)
 
     def run(self, timeout):
-        def exec_proc():
-            dbg(2, 'Executing command .. ' + self.cmd)
-            if verbose > 1:
-                self.process = Popen(shlex.split(self.cmd), env=self.run_env)
-            else:
-                self.process = Popen(shlex.split(self.cmd),
-                     stdout=PIPE, stderr=PIPE, env=self.run_env)
-            self.process.communicate()
-
-        thread = threading.Thread(target=exec_proc)
-        thread.start()
-
-        thread.join(timeout)
+        # The output goes straight to a file (or nowhere), so it doesn't
+        # pile up in memory however much the command prints.
+        dbg(2, 'Executing command .. ' + self.cmd)
+        output = None
+        tmp_output_file = None
+        if verbose > 1:
+            pass
+        elif discard_output:
+            output = open(os.devnull, 'w')
+        else:
+            fd, tmp_output_file = tempfile.mkstemp(prefix='fi_output_', dir=FI_TMP_DIR)
+            output = os.fdopen(fd, 'w')
+        self.process = Popen(shlex.split(self.cmd), stdout=output,
+            stderr=(STDOUT if output != None else None), env=self.run_env)
         self.pid = self.process.pid
-        if thread.is_alive():
+        if output != None:
+            output.close()
+        if tmp_output_file != None:
+            self.output_file = FI_TMP_DIR + 'fi_pid_' + str(self.pid) + '_output.log'
+            os.rename(tmp_output_file, self.output_file)
+
+        if not process_monitor.wait(self.process, timeout):
             dbg(1, 'Process timed-out, assuming process to be hung, collect backtraces and terminate ..')
+            self.timed_out = True
             # Let's save a few iterations of backtraces for all threads, might help debug
             self.dump_backtraces()
 
             # Kill the process, this should get us core as well
             self.process.send_signal(signal.SIGQUIT)
-            thread.join()
+            process_monitor.wait(self.process, None)
 
         return self.process.returncode
 
 def append_testset_list_from_cmd_list(testset_list, cmd_list, fail_count_beg, fail_count_end,
-    fail_count_ignore, timeout):
+    fail_count_ignore, timeout, fail_shapes=[(0, 1)]):
     if fail_count_end != None and fail_count_beg > fail_count_end:
         dbg(0, 'Fault injection begin count can not be greater than end count')
         exit_abnormal()
     index_itr = len(testset_list) + 1
     for cmd_itr in cmd_list:
-        testset_list.append(Testset(cmd = cmd_itr, fail_count_beg = fail_count_beg,
-            fail_count_end = fail_count_end, fail_count_ignore = fail_count_ignore,
-            timeout = timeout, dir = WTTEST_DIR + 'set' + str(index_itr)))
-        index_itr += 1
+        # A testset for each (fail window, fail every) shape
+        for fail_window, fail_every in fail_shapes:
+            testset_list.append(Testset(cmd = cmd_itr, fail_count_beg = fail_count_beg,
+                fail_count_end = fail_count_end, fail_count_ignore = fail_count_ignore,
+                fail_window = fail_window, fail_every = fail_every,
+                timeout = timeout, dir = WTTEST_DIR + 'set' + str(index_itr)))
+            index_itr += 1
+
+def get_latency_env(latency_spec):
+    # Turn fn:usec[:dist[:N]] entries into the library's delay settings, fn
+    # 'all' sets the default of every function.
+    latency_env = {}
+    for entry in latency_spec.split(','):
+        fields = entry.split(':')
+        if len(fields) < 2 or len(fields) > 4 or \
+            (len(fields) > 2 and not fields[2] in LATENCY_DISTS):
+            dbg(0, 'Latency entries are fn:usec[:dist[:N]], dist one of ' +
+                ', '.join(LATENCY_DISTS) + ': ' + entry)
+            exit_abnormal()
+        prefix = 'FAULTINJECT_'
+        if fields[0] != 'all':
+            prefix += fields[0].upper() + '_'
+        latency_env[prefix + 'DELAY_USEC'] = str(int(fields[1]))
+        if len(fields) > 2:
+            latency_env[prefix + 'DELAY_DIST'] = fields[2]
+        if len(fields) > 3:
+            latency_env[prefix + 'DELAY_EVERY'] = str(int(fields[3]))
+    return latency_env
+
+def get_fail_shapes(fail_windows, fail_everys):
+    for fail_every in fail_everys:
+        if fail_every < 1:
+            dbg(0, 'Fail every count has to be at least 1')
+            exit_abnormal()
+    return [(w, k) for w in fail_windows for k in fail_everys]
 
 def append_testset_list_from_config(testset_list, conf_file):
     with open(conf_file, 'r') as f:
@@ -341,6 +1298,8 @@ def append_testset_list_from_config(testset_list, conf_file):
     fail_count_beg = None
     fail_count_end = None
     fail_count_ignore = []
+    fail_windows = [0]
+    fail_everys = [1]
     timeout = None
     cmd_list = []
 
@@ -351,10 +1310,12 @@ def append_testset_list_from_config(testset_list, conf_file):
                     dbg(0, 'Need to have atleast one cmd found before failcountbeg')
                     exit_abnormal()
                 append_testset_list_from_cmd_list(testset_list, cmd_list, fail_count_beg, fail_count_end,
-                    fail_count_ignore, timeout)
+                    fail_count_ignore, timeout, get_fail_shapes(fail_windows, fail_everys))
                 fail_count_beg = None
                 fail_count_end = None
                 fail_count_ignore = []
+                fail_windows = [0]
+                fail_everys = [1]
                 timeout = None
                 cmd_list = []
 
@@ -369,6 +1330,12 @@ def append_testset_list_from_config(testset_list, conf_file):
         if '    failcountignore=' == line[:len('    failcountignore=')]:
             fail_count_ignore = [int(s) for s in line[len('    failcountignore='):]]
             continue
+        if '    failwindow=' == line[:len('    failwindow=')]:
+            fail_windows = [int(s) for s in line[len('    failwindow='):].split(',')]
+            continue
+        if '    failevery=' == line[:len('    failevery=')]:
+            fail_everys = [int(s) for s in line[len('    failevery='):].split(',')]
+            continue
         if '    timeout=' == line[:len('    timeout=')]:
             timeout = int(line[len('    timeout='):])
             continue
@@ -380,9 +1347,10 @@ def append_testset_list_from_config(testset_list, conf_file):
         dbg(0, 'Did not find failcountbeg for the last cmd to run')
         exit_abnormal()
     append_testset_list_from_cmd_list(testset_list, cmd_list, fail_count_beg, fail_count_end,
-        fail_count_ignore, timeout)
+        fail_count_ignore, timeout, get_fail_shapes(fail_windows, fail_everys))
 
-def auto_discover_testset_list(testset_list, count_beg, count_end, count_ignore, timeout):
+def auto_discover_testset_list(testset_list, count_beg, count_end, count_ignore, timeout,
+    fail_shapes=[(0, 1)]):
     dbg(0, 'Building test list by running python test suite discovery ')
     ld_lib_path = CUR_DIR + '/.libs'
     run_env = dict(os.environ, LD_LIBRARY_PATH=ld_lib_path)
@@ -398,18 +1366,142 @@ def auto_discover_testset_list(testset_list, count_beg, count_end, count_ignore,
 
     index_itr = len(testset_list) + 1
     for test in tests:
-        dir_itr = WTTEST_DIR + 'set' + str(index_itr)
-        cmd_itr = 'python ' + DEF_PYTHON_TESTSUITE_RUN_CMD + ' -v 3 ' + test + ' -D ' + dir_itr
-        testset_list.append(Testset(cmd = cmd_itr, fail_count_beg = count_beg,
-            fail_count_end = count_end, fail_count_ignore = count_ignore,
-            timeout = timeout, dir = dir_itr))
-        index_itr += 1
+        for fail_window, fail_every in fail_shapes:
+            dir_itr = WTTEST_DIR + 'set' + str(index_itr)
+            cmd_itr = 'python ' + DEF_PYTHON_TESTSUITE_RUN_CMD + ' -v 3 ' + test + ' -D {dir}'
+            testset_list.append(Testset(cmd = cmd_itr, fail_count_beg = count_beg,
+                fail_count_end = count_end, fail_count_ignore = count_ignore,
+                fail_window = fail_window, fail_every = fail_every,
+                timeout = timeout, dir = dir_itr))
+            index_itr += 1
+
+def merge_results(result_files, config_file, journal_file):
+    # Combine the journals of the shards of a sweep: report the shards that
+    # are missing or didn't finish, the totals and every failure, and
+    # optionally write a config rerunning the failures and a journal with
+    # every result. A result recorded more than once counts as its latest.
+    results = {}
+    op_counts = {}
+    shards = {}
+    for result_file in result_files:
+        with open(result_file, 'r') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue
+                if 'shard' in entry:
+                    # A shard that is run again starts over
+                    if 'started' in entry:
+                        shards[tuple(entry['shard'])] = entry
+                    else:
+                        shards.setdefault(tuple(entry['shard']), {}).update(entry)
+                elif 'opcount' in entry:
+                    op_counts[(entry['cmd'], entry['fingerprint'])] = entry
+                elif 'latency' in entry:
+                    continue
+                else:
+                    key = (entry['cmd'], entry.get('shape', ''), entry['failcount'])
+                    if not key in results or results[key]['time'] <= entry['time']:
+                        results[key] = entry
+    dbg(0, 'Merged ' + str(len(results)) + ' results from ' + str(len(result_files)) + ' files')
+
+    for count in sorted(set(count for index, count in shards)):
+        missing = [i for i in range(1, count + 1) if not (i, count) in shards]
+        unfinished = [i for i in range(1, count + 1) if (i, count) in shards and
+            (not 'finished' in shards[(i, count)] or shards[(i, count)].get('aborted'))]
+        dbg(0, 'Shards of ' + str(count) + ': ' + str(count - len(missing)) + ' found' +
+            (', missing ' + ','.join(str(i) for i in missing) if missing else '') +
+            (', unfinished ' + ','.join(str(i) for i in unfinished) if unfinished else ''))
+        for i in range(1, count + 1):
+            if (i, count) in shards:
+                shard = shards[(i, count)]
+                dbg(1, 'Shard ' + str(i) + '/' + str(count) + ' on ' + shard.get('host', '?') +
+                    ': ' + str(shard.get('units', '?')) + ' fail counts')
+
+    testsets = {}
+    for key in sorted(results):
+        testsets.setdefault(key[:2], []).append(results[key])
+    failures = [results[key] for key in sorted(results) if results[key]['verdict'] != 'pass']
+    walltime = sum(entry['walltime'] for entry in results.values() if entry['walltime'] != None)
+    dbg(0, 'Testsets: ' + str(len(testsets)) + ', fail counts run: ' + str(len(results)) +
+        ', failed: ' + str(len(failures)) + ', run time: %.1fs' % walltime)
+    for (cmd, shape), entries in sorted(testsets.items()):
+        failed = len([e for e in entries if e['verdict'] != 'pass'])
+        dbg(1, ('[FAIL]' if failed else '[PASS]') + '  ..  ' + str(len(entries)) +
+            ' fail counts from ' + str(min(e['failcount'] for e in entries)) + ' to ' +
+            str(max(e['failcount'] for e in entries)) + ', ' + str(failed) + ' failed  ..  ' +
+            (shape + ', ' if shape != '' else '') + 'cmd: ' + cmd)
+    for entry in failures:
+        fi_str = '[fi_count: ' + str(entry['failcount'])
+        if entry.get('shape', '') != '':
+            fi_str += ', ' + entry['shape']
+        fi_str += ', cmd: ' + entry['cmd'] + ']'
+        saved = ''
+        if 'saved' in entry:
+            saved = ', saved in ' + entry.get('host', '?') + ':' + entry['saved']
+        dbg(0, '[FAIL]  ..  ' + fi_str + '  ..  exit code: ' + str(entry['exitcode']) + saved)
+
+    if config_file != None:
+        with open(config_file, 'w') as f:
+            for entry in failures:
+                # A block per failure, in the format of -c
+                shape = dict(item.split('=', 1) for item in entry.get('shape', '').split())
+                f.write('cmd=' + entry['cmd'] + '\n')
+                f.write('    failcountbeg=' + str(entry['failcount']) + '\n')
+                f.write('    failcountend=' + str(entry['failcount']) + '\n')
+                f.write('    failwindow=' + str(entry.get('failwindow',
+                    shape.get('failwindow', 0))) + '\n')
+                f.write('    failevery=' + str(entry.get('failevery',
+                    shape.get('failevery', 1))) + '\n')
+                if entry.get('timeout') != None:
+                    f.write('    timeout=' + str(entry['timeout']) + '\n')
+        dbg(0, 'Wrote a config rerunning the ' + str(len(failures)) + ' failures to ' + config_file)
+    if journal_file != None:
+        with open(journal_file, 'w') as f:
+            for entry in list(op_counts.values()) + [results[key] for key in sorted(results)]:
+                f.write(json.dumps(entry, sort_keys=True) + '\n')
+    return len(failures) == 0
+
+def merge_main(args):
+    global verbose
+    config_file = None
+    journal_file = None
+    result_files = []
+    while len(args) > 0:
+        arg = args.pop(0)
+        if arg[0] == '-':
+            option = arg[1:]
+            if option == '-configdump' or option == 'C':
+                config_file = args.pop(0)
+                continue
+            if option == '-journal' or option == 'r':
+                journal_file = args.pop(0)
+                continue
+            if option == '-verbose' or option == 'v':
+                verbose = int(args.pop(0))
+                continue
+            dbg(0, 'unknown arg: ' + arg)
+            usage()
+            exit_abnormal()
+        result_files.append(arg)
+    if len(result_files) == 0:
+        dbg(0, 'No shard journals to merge')
+        exit_abnormal()
+    if not merge_results(result_files, config_file, journal_file):
+        exit_abnormal()
 
 if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == 'merge':
+        merge_main(sys.argv[2:])
+        sys.exit(0)
+
     # default parameters
     fail_count_beg = 1
     fail_count_end = None
     fail_count_ignore = []
+    fail_windows = [0]
+    fail_everys = [1]
     proceed_on_failure = False
     read_from_config = False
     dump_config = False
@@ -417,6 +1509,17 @@ if __name__ == '__main__':
     timeout = 300
     threads = multiprocessing.cpu_count()
     fi_lib_path = DEF_FI_LIB_PATH
+    fi_lib_object = None
+    fi_path_filter = None
+    fi_lib_backtraces = False
+    fi_lib_stats = False
+    fork_sweep = 0
+    dry_run = False
+    unique_sites = 0
+    journal_file = None
+    latency_spec = None
+    shard = None
+    report_file = None
 
     # Process arguments passed
     args = sys.argv[1:]
@@ -436,6 +1539,9 @@ if __name__ == '__main__':
                 config_file_dump = args.pop(0)
                 dump_config = True
                 continue
+            if option == '-dryrun' or option == 'd':
+                dry_run = True
+                continue
             if option == '-corruptiontest' or option == 'x':
                 corruption_test = True
                 continue
@@ -445,18 +1551,61 @@ if __name__ == '__main__':
             if option == '-failcountend' or option == 'e':
                 fail_count_end = int(args.pop(0))
                 continue
+            if option == '-forksweep' or option == 'f':
+                fork_sweep = int(args.pop(0))
+                continue
             if option == '-failcountignore' or option == 'i':
                 fail_count_ignore = [int(s) for s in args.pop(0).split(',')]
                 continue
+            if option == '-failevery' or option == 'k':
+                fail_everys = [int(s) for s in args.pop(0).split(',')]
+                continue
+            if option == '-failwindow' or option == 'w':
+                fail_windows = [int(s) for s in args.pop(0).split(',')]
+                continue
             if option == '-filibpath' or option == 'l':
                 fi_lib_path = args.pop(0)
                 continue
+            if option == '-latency' or option == 'L':
+                latency_spec = args.pop(0)
+                continue
+            if option == '-filibobject' or option == 'o':
+                fi_lib_object = args.pop(0)
+                continue
             if option == '-proceedonfailure' or option == 'p':
                 proceed_on_failure = True
                 continue
+            if option == '-pathfilter' or option == 'P':
+                fi_path_filter = args.pop(0)
+                continue
+            if option == '-discardoutput' or option == 'q':
+                discard_output = True
+                continue
+            if option == '-journal' or option == 'r':
+                journal_file = os.path.abspath(args.pop(0))
+                continue
+            if option == '-report' or option == 'R':
+                report_file = args.pop(0)
+                continue
+            if option == '-backtraces' or option == 'B':
+                fi_lib_backtraces = True
+                continue
+            if option == '-stats' or option == 'S':
+                fi_lib_stats = True
+                continue
+            if option == '-shard' or option == 's':
+                shard = tuple(int(s) for s in args.pop(0).split('/'))
+                if len(shard) != 2 or shard[0] < 1 or shard[0] > shard[1]:
+                    dbg(0, 'A shard is i/n, with 1<=i<=n.')
+                    exit_abnormal()
+                continue
             if option == '-timeout' or option == 't':
                 timeout = int(args.pop(0))
                 continue
+            if option == '-uniquesites' or option == 'u':
+                unique_sites = int(args.pop(0))
+                dry_run = True
+                continue
             if option == '-threads' or option == 'j':
                 threads = int(args.pop(0))
                 continue
@@ -471,34 +1620,66 @@ if __name__ == '__main__':
             exit_abnormal() 
         cmd_list.append(arg)
 
+    # Shards running on one machine must not share their directories, and
+    # record their results for merging.
+    if shard != None:
+        shard_suffix = '.shard' + str(shard[0]) + 'of' + str(shard[1])
+        FI_TMP_DIR = CUR_DIR + '/FI_TEST' + shard_suffix + '/'
+        WTTEST_DIR = CUR_DIR + '/WT_TEST' + shard_suffix + '/'
+        if journal_file == None:
+            journal_file = CUR_DIR + '/fi_journal' + shard_suffix
+        dbg(0, 'Recording the results of the shard in ' + journal_file)
+
     # Set various paths for the test env
     ld_lib_path = fi_lib_path + '/.libs'
     ld_lib_path += ':'
     ld_lib_path += CUR_DIR + '/.libs'
     ld_preload = fi_lib_path + '/.libs/libfaultinject.so'
 
+    # A path filter picks the operations by their target, so don't also
+    # limit them to the default library unless asked to with -o.
+    fi_lib_name = DEF_FAULTINJECT_LIBRARY_NAME
+    if fi_path_filter != None:
+        fi_lib_name = ''
+
     testsuite = Testsuite(corruption_test,
         proceed_on_failure,
-        DEF_FAULTINJECT_LIBRARY_NAME,
+        fi_lib_name,
         ld_lib_path,
         ld_preload,
-        DEF_PYTHON_PATH)
+        DEF_PYTHON_PATH,
+        fi_lib_object,
+        fi_path_filter,
+        fi_lib_backtraces,
+        fi_lib_stats)
 
     testset_list = []
     if read_from_config:
         append_testset_list_from_config(testset_list, config_file_read)
+    fail_shapes = get_fail_shapes(fail_windows, fail_everys)
     if len(cmd_list) != 0:
         append_testset_list_from_cmd_list(testset_list, cmd_list, fail_count_beg, fail_count_end,
-            fail_count_ignore, timeout)
+            fail_count_ignore, timeout, fail_shapes)
     if len(testset_list) == 0:
         auto_discover_testset_list(testset_list, fail_count_beg, fail_count_end,
-                fail_count_ignore, timeout)
+                fail_count_ignore, timeout, fail_shapes)
 
     testsuite.set_testset_list(testset_list)
-    if len(testset_list) == 1 and threads != 1:
-        print 'Only one test in the test list, running single threaded.'
+    if len(testset_list) == 1 and testset_list[0].fail_count_end == None and \
+        threads != 1 and not dry_run and shard == None:
+        print 'Only one open ended test in the test list, running single threaded.'
         threads = 1
     testsuite.set_threads(threads)
+    testsuite.set_fork_sweep(fork_sweep)
+    testsuite.set_dry_run(dry_run)
+    testsuite.set_unique_sites(unique_sites)
+    if journal_file != None:
+        testsuite.set_journal(Journal(journal_file))
+    if latency_spec != None:
+        testsuite.set_latency_env(get_latency_env(latency_spec))
+    testsuite.set_shard(shard)
+    if report_file != None:
+        testsuite.set_report(Report(report_file))
 
     if testsuite.get_testset_count() == 0:
         dbg(0, 'No tests specified to run')